@@ -0,0 +1,63 @@
+"""Check parse_a4f_error against the recorded error corpus and time it.
+
+Usage (from the backend directory):
+    python error_classifier_bench.py [iterations]
+
+The corpus itself is checked by tests/test_error_classifier.py; this script
+refuses to time a classifier that disagrees with it (exit status 1). Timings
+are reported for uncached classification (LRU cleared before each call) and
+for memoized repeats of the same bodies.
+"""
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+
+import server
+
+CORPUS_PATH = Path(__file__).parent / "error_corpus.json"
+
+
+def check_corpus(corpus):
+    failures = 0
+    for case in corpus:
+        result = server.parse_a4f_error(case["body"])
+        if result != case["expected"]:
+            failures += 1
+            print(f"❌ {case['name']}: expected {case['expected']['type']}, got {result['type']}")
+            print(f"   expected: {case['expected']}")
+            print(f"   got:      {result}")
+    print(f"Corpus: {len(corpus) - failures}/{len(corpus)} cases match")
+    return failures == 0
+
+
+def bench(label, corpus, iterations, clear_cache):
+    bodies = [case["body"] for case in corpus]
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for body in bodies:
+            if clear_cache:
+                server._parse_a4f_error_text.cache_clear()
+            server.parse_a4f_error(body)
+    elapsed = time.perf_counter() - started
+    calls = iterations * len(bodies)
+    print(f"{label:<10} {calls:>8} calls  {elapsed * 1e6 / calls:8.2f} µs/call")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    logging.getLogger("server").setLevel(logging.ERROR)
+
+    corpus = json.loads(CORPUS_PATH.read_text())
+    if not check_corpus(corpus):
+        return 1
+
+    bench("uncached", corpus, iterations, clear_cache=True)
+    bench("memoized", corpus, iterations, clear_cache=False)
+    print(f"Cache: {server._parse_a4f_error_text.cache_info()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,46 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from gridfs.errors import NoFile
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
+from typing import Callable, List, Optional, Dict, Any, Tuple
 import uuid
+import sys
+import signal
+import socket
+import random
+import mmap
+import struct
+import functools
+import threading
+import traceback
+import bisect
+import inspect
+import contextlib
+from collections import OrderedDict, defaultdict, deque
+from dataclasses import dataclass, field
+from contextvars import ContextVar
 from datetime import datetime, timezone
 import aiohttp
+from multidict import CIMultiDict
+import asyncio
 import json
+import base64
+import gzip
+import hashlib
+import hmac
+import re
+import time
+import zlib
+import numpy as np
+import uvicorn
 
 
 ROOT_DIR = Path(__file__).parent
@@ -45,11 +75,17 @@ class APIKey(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     api_key: str
     provider: str = "a4f"
+    label: Optional[str] = None
+    status: str = "active"  # active, quarantined, disabled
+    quarantined_until: Optional[datetime] = None
+    last_error: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class APIKeyCreate(BaseModel):
     api_key: str
     provider: str = "a4f"
+    label: Optional[str] = None
+    append: Optional[bool] = False  # Add to the provider's key pool instead of replacing it
 
 class ModelRequest(BaseModel):
     model_id: str
@@ -70,6 +106,7 @@ class TextModelRequest(BaseModel):
     presence_penalty: Optional[float] = 0.0
     stream: Optional[bool] = False
     conversation_history: Optional[List[Dict[str, str]]] = []
+    similarity_cache: Optional[bool] = None  # Use the near-duplicate prompt cache (None = server default)
     api_key: Optional[str] = None
 
 class ImageModelRequest(BaseModel):
@@ -84,6 +121,12 @@ class ImageModelRequest(BaseModel):
     cfg_scale: Optional[float] = 7.0  # For Stable Diffusion
     steps: Optional[int] = 20  # Generation steps
     seed: Optional[int] = None
+    n: Optional[int] = 1  # Number of images
+    seeds: Optional[List[int]] = None  # One seed per image; overrides n
+    stream: Optional[bool] = False  # Send each image as soon as it is ready
+    stream_format: Optional[str] = "sse"  # sse, ndjson
+    response_format: Optional[str] = None  # url, b64_json (decoded and served from /api/images); None = server default
+    similarity_cache: Optional[bool] = None  # Use the near-duplicate prompt cache (None = server default)
     api_key: Optional[str] = None
 
 class AudioModelRequest(BaseModel):
@@ -94,6 +137,8 @@ class AudioModelRequest(BaseModel):
     duration: Optional[int] = 30  # Duration in seconds
     format: Optional[str] = "mp3"  # mp3, wav, flac
     speed: Optional[float] = 1.0  # Playback speed
+    language: Optional[str] = None
+    stream: Optional[bool] = False  # Relay audio chunks as they arrive instead of waiting for the whole file
     api_key: Optional[str] = None
 
 class VideoModelRequest(BaseModel):
@@ -136,20 +181,216 @@ async def get_status_checks():
     
     return status_checks
 
+# API key pool
+KEY_POOL_STRATEGY = os.environ.get('KEY_POOL_STRATEGY', 'round_robin')  # round_robin, least_rate_limited
+KEY_POOL_REFRESH_SECONDS = float(os.environ.get('KEY_POOL_REFRESH_SECONDS', '30'))
+
+# Error types that take a key out of rotation for a while (seconds)
+KEY_QUARANTINE_SECONDS = {
+    "rate_limit": float(os.environ.get('KEY_RATE_LIMIT_QUARANTINE_SECONDS', '900')),
+    "insufficient_credits": float(os.environ.get('KEY_CREDITS_QUARANTINE_SECONDS', '3600')),
+}
+
+# Error types that take a key out of rotation until it is reset manually
+KEY_DISABLING_ERRORS = {"auth_error"}
+
+def mask_api_key(api_key: str) -> str:
+    """Mask an API key for display, keeping only the first and last 4 characters"""
+    if not api_key or len(api_key) < 8:
+        return "****"
+    return f"{api_key[:4]}{'*' * (len(api_key) - 8)}{api_key[-4:]}"
+
+class KeyPool:
+    """Stored API keys per provider with load balancing and automatic quarantine.
+
+    Key documents are cached from the api_keys collection and refreshed every
+    KEY_POOL_REFRESH_SECONDS. Health transitions (quarantine, disable, reset) are
+    persisted to MongoDB; per-key usage counters are kept in memory.
+    """
+
+    def __init__(self, strategy: str = "round_robin"):
+        self.strategy = strategy
+        self._keys: Dict[str, List[Dict[str, Any]]] = {}
+        self._loaded_at: Dict[str, float] = {}
+        self._cursor: Dict[str, int] = {}
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        self._lock = asyncio.Lock()
+
+    def invalidate(self, provider: Optional[str] = None):
+        """Force the next lookup to reload keys from MongoDB"""
+        if provider is None:
+            self._loaded_at.clear()
+        else:
+            self._loaded_at.pop(provider, None)
+
+    async def keys(self, provider: str) -> List[Dict[str, Any]]:
+        if time.monotonic() - self._loaded_at.get(provider, 0.0) < KEY_POOL_REFRESH_SECONDS:
+            return self._keys.get(provider, [])
+
+        async with self._lock:
+            if time.monotonic() - self._loaded_at.get(provider, 0.0) < KEY_POOL_REFRESH_SECONDS:
+                return self._keys.get(provider, [])
+            docs = await db.api_keys.find({"provider": provider}, {"_id": 0}).sort("created_at", 1).to_list(1000)
+            self._keys[provider] = docs
+            self._loaded_at[provider] = time.monotonic()
+            return docs
+
+    def stats(self, key_id: str) -> Dict[str, Any]:
+        return self._stats.setdefault(key_id, {
+            "requests": 0,
+            "successes": 0,
+            "failures": 0,
+            "rate_limited": 0,
+            "last_used_at": None,
+            "last_rate_limited_at": None,
+        })
+
+    @staticmethod
+    def health(doc: Dict[str, Any]) -> str:
+        """Current health of a key document, releasing expired quarantines"""
+        status = doc.get("status", "active")
+        if status == "quarantined":
+            until = doc.get("quarantined_until")
+            if isinstance(until, str):
+                until = datetime.fromisoformat(until)
+            if until is None or until <= datetime.now(timezone.utc):
+                return "active"
+        return status
+
+    async def acquire(self, provider: str) -> Optional[Dict[str, Any]]:
+        """Pick the next healthy key for a provider, or None if none is usable"""
+        available = [doc for doc in await self.keys(provider) if self.health(doc) == "active"]
+        if not available:
+            return None
+
+        if self.strategy == "least_rate_limited":
+            # Prefer keys that were rate limited longest ago, then the least used
+            doc = min(available, key=lambda d: (
+                self.stats(d["id"])["last_rate_limited_at"] or "",
+                self.stats(d["id"])["requests"]
+            ))
+        else:
+            cursor = self._cursor.get(provider, 0)
+            doc = available[cursor % len(available)]
+            self._cursor[provider] = cursor + 1
+
+        stats = self.stats(doc["id"])
+        stats["requests"] += 1
+        stats["last_used_at"] = datetime.now(timezone.utc).isoformat()
+        return doc
+
+    async def report(self, key_id: Optional[str], error_type: Optional[str] = None):
+        """Record the outcome of an upstream call made with a pooled key"""
+        if not key_id:
+            return
+
+        stats = self.stats(key_id)
+        if error_type is None:
+            stats["successes"] += 1
+            return
+
+        stats["failures"] += 1
+        update = None
+        if error_type in KEY_DISABLING_ERRORS:
+            update = {"status": "disabled", "quarantined_until": None, "last_error": error_type}
+        elif error_type in KEY_QUARANTINE_SECONDS:
+            now = datetime.now(timezone.utc)
+            stats["rate_limited"] += 1
+            stats["last_rate_limited_at"] = now.isoformat()
+            until = now.timestamp() + KEY_QUARANTINE_SECONDS[error_type]
+            update = {
+                "status": "quarantined",
+                "quarantined_until": datetime.fromtimestamp(until, timezone.utc).isoformat(),
+                "last_error": error_type
+            }
+
+        if update:
+            logger.warning(f"API key {key_id} marked {update['status']} after {error_type}")
+            await self._update(key_id, update)
+
+    async def reset(self, provider: str, key_id: str) -> bool:
+        """Return a quarantined or disabled key of a provider to rotation"""
+        return await self._update(key_id, {"status": "active", "quarantined_until": None, "last_error": None}, provider)
+
+    async def _update(self, key_id: str, update: Dict[str, Any], provider: Optional[str] = None) -> bool:
+        query = {"id": key_id} if provider is None else {"id": key_id, "provider": provider}
+        result = await db.api_keys.update_one(query, {"$set": update})
+        if not result.matched_count:
+            return False
+        for docs in self._keys.values():
+            for doc in docs:
+                if doc["id"] == key_id:
+                    doc.update(update)
+        return True
+
+    async def describe(self, provider: str) -> List[Dict[str, Any]]:
+        """Masked keys with their health and usage, for display"""
+        self.invalidate(provider)
+        return [
+            {
+                "id": doc["id"],
+                "provider": doc["provider"],
+                "label": doc.get("label"),
+                "api_key": mask_api_key(doc["api_key"]),
+                "status": self.health(doc),
+                "quarantined_until": doc.get("quarantined_until"),
+                "last_error": doc.get("last_error"),
+                "created_at": doc.get("created_at"),
+                "usage": self.stats(doc["id"])
+            }
+            for doc in await self.keys(provider)
+        ]
+
+key_pool = KeyPool(KEY_POOL_STRATEGY)
+
+async def resolve_api_key(request_api_key: Optional[str], provider: str = "a4f"):
+    """Return (api_key, key_id) from the request or the provider's key pool.
+
+    key_id is None when the caller supplied its own key, so it is not accounted.
+    """
+    if request_api_key:
+        return request_api_key, None
+    doc = await key_pool.acquire(provider)
+    if doc:
+        return doc["api_key"], doc["id"]
+    return None, None
+
+async def missing_api_key_error(provider: str = "a4f") -> Dict[str, Any]:
+    """Error payload for when no usable API key is available"""
+    if await key_pool.keys(provider):
+        return {
+            "error": {
+                "type": "keys_unavailable",
+                "message": "⏱️ All configured API keys are rate limited, out of credits or disabled.",
+                "suggestion": "Wait for the keys to recover, add another key in Settings, or reset a key.",
+                "action": "wait_or_upgrade"
+            }
+        }
+    return {
+        "error": {
+            "type": "no_api_key",
+            "message": "🔐 No API key configured.",
+            "suggestion": "Please add your A4F API key in Settings to use the models.",
+            "action": "add_api_key"
+        }
+    }
+
 # API Key management endpoints
 @api_router.post("/api-keys", response_model=APIKey)
 async def save_api_key(input: APIKeyCreate):
-    api_key_dict = input.model_dump()
+    api_key_dict = input.model_dump(exclude={"append"})
     api_key_obj = APIKey(**api_key_dict)
     
     # Convert to dict and serialize datetime to ISO string for MongoDB
     doc = api_key_obj.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     
-    # Remove existing API keys for the same provider
-    await db.api_keys.delete_many({"provider": input.provider})
+    # Remove existing API keys for the same provider unless adding to the pool
+    if not input.append:
+        await db.api_keys.delete_many({"provider": input.provider})
     
     _ = await db.api_keys.insert_one(doc)
+    key_pool.invalidate(input.provider)
     return api_key_obj
 
 @api_router.get("/api-keys/{provider}")
@@ -164,8 +405,1363 @@ async def get_api_key(provider: str):
 @api_router.delete("/api-keys/{provider}")
 async def delete_api_key(provider: str):
     result = await db.api_keys.delete_many({"provider": provider})
+    key_pool.invalidate(provider)
+    return {"deleted_count": result.deleted_count}
+
+@api_router.get("/api-keys/{provider}/pool")
+async def get_api_key_pool(provider: str):
+    """List pooled keys for a provider with health and usage (keys are masked)"""
+    keys = await key_pool.describe(provider)
+    return {
+        "provider": provider,
+        "strategy": key_pool.strategy,
+        "total_keys": len(keys),
+        "active_keys": sum(1 for key in keys if key["status"] == "active"),
+        "keys": keys
+    }
+
+@api_router.delete("/api-keys/{provider}/pool/{key_id}")
+async def delete_pooled_api_key(provider: str, key_id: str):
+    result = await db.api_keys.delete_one({"provider": provider, "id": key_id})
+    key_pool.invalidate(provider)
     return {"deleted_count": result.deleted_count}
 
+@api_router.post("/api-keys/{provider}/pool/{key_id}/reset")
+async def reset_pooled_api_key(provider: str, key_id: str):
+    """Clear quarantine or disabled status of a pooled key"""
+    if not await key_pool.reset(provider, key_id):
+        raise HTTPException(status_code=404, detail="API key not found")
+    key_pool.invalidate(provider)
+    return {"id": key_id, "status": "active"}
+
+# Usage ledger
+USAGE_BATCH_SIZE = int(os.environ.get('USAGE_BATCH_SIZE', '200'))
+USAGE_FLUSH_INTERVAL = float(os.environ.get('USAGE_FLUSH_INTERVAL', '5'))
+USAGE_MAX_BUFFER = int(os.environ.get('USAGE_MAX_BUFFER', '10000'))
+
+# Optional per-model prices, e.g. {"gpt-4o": {"per_1k_tokens": 0.005}, "*": {"per_image": 0.04}}
+USAGE_PRICING: Dict[str, Dict[str, float]] = json.loads(os.environ.get('USAGE_PRICING', '{}'))
+
+# Numeric fields summed into the hourly rollups
+USAGE_COUNTERS = (
+    "requests", "errors", "prompt_tokens", "completion_tokens", "total_tokens",
+    "images", "audio_seconds", "video_seconds", "latency_ms", "cost"
+)
+
+# Dimensions usage can be grouped by
+USAGE_DIMENSIONS = ("hour", "model", "provider", "key_id", "modality")
+
+usage_context: ContextVar[Optional[Dict[str, Any]]] = ContextVar("usage_context", default=None)
+
+def annotate_usage(**fields):
+    """Attach details (key_id, provider model ID, ...) to the current request's usage record"""
+    context = usage_context.get()
+    if context is not None:
+        context.update(fields)
+
+def estimate_cost(record: Dict[str, Any]) -> float:
+    """Estimate the cost of a usage record from USAGE_PRICING"""
+    prices = USAGE_PRICING.get(record["model"]) or USAGE_PRICING.get("*") or {}
+    return round(
+        record["total_tokens"] / 1000 * prices.get("per_1k_tokens", 0.0)
+        + record["images"] * prices.get("per_image", 0.0)
+        + record["audio_seconds"] * prices.get("per_audio_second", 0.0)
+        + record["video_seconds"] * prices.get("per_video_second", 0.0),
+        6
+    )
+
+class UsageLedger:
+    """Write-behind buffer of usage records.
+
+    Records are appended in memory and written to usage_records with insert_many,
+    either when USAGE_BATCH_SIZE records are pending or every USAGE_FLUSH_INTERVAL
+    seconds. Each flush also upserts hourly rollups into usage_hourly so reports
+    never scan the raw records.
+
+    The two writes are retried separately so a failure never counts a record
+    twice: raw records use their id as _id, making a repeated insert a duplicate
+    key error that is ignored, and only the rollup updates that failed are kept
+    for the next flush.
+    """
+
+    def __init__(self, batch_size: int = 200, flush_interval: float = 5.0, max_buffer: int = 10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.dropped = 0
+        self._buffer: deque = deque(maxlen=max_buffer)
+        self._rollups: List[UpdateOne] = []  # Rollup updates of already stored records, awaiting a retry
+        self._task: Optional[asyncio.Task] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def record(self, **fields):
+        """Queue a usage record; never touches the database on the request path"""
+        record = {
+            "id": str(uuid.uuid4()),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "model": None,
+            "provider": None,
+            "key_id": None,
+            "modality": None,
+            "status": "success",
+            "latency_ms": 0.0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+            "images": 0,
+            "audio_seconds": 0.0,
+            "video_seconds": 0.0,
+        }
+        record.update(fields)
+        record["cost"] = estimate_cost(record)
+
+        if len(self._buffer) == self.max_buffer:
+            self.dropped += 1  # The deque drops the oldest record
+        self._buffer.append(record)
+
+        if len(self._buffer) >= self.batch_size and (self._flush_task is None or self._flush_task.done()):
+            # Keep a reference so the task isn't garbage collected mid-flush
+            self._flush_task = asyncio.create_task(self.flush())
+
+    @staticmethod
+    def rollups(records: List[Dict[str, Any]]) -> List[UpdateOne]:
+        """Collapse records into one $inc upsert per (hour, model, provider, key, modality)"""
+        buckets: Dict[tuple, Dict[str, float]] = {}
+        for record in records:
+            hour = record["timestamp"][:13] + ":00:00+00:00"
+            bucket_key = (hour, record["model"], record["provider"], record["key_id"], record["modality"])
+            counters = buckets.setdefault(bucket_key, dict.fromkeys(USAGE_COUNTERS, 0))
+            counters["requests"] += 1
+            counters["errors"] += 0 if record["status"] in ("success", "cached") else 1
+            for counter in USAGE_COUNTERS[2:]:
+                counters[counter] += record[counter] or 0
+
+        return [
+            UpdateOne(dict(zip(USAGE_DIMENSIONS, bucket_key)), {"$inc": counters}, upsert=True)
+            for bucket_key, counters in buckets.items()
+        ]
+
+    async def _insert(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Insert raw records; returns those that were not stored"""
+        try:
+            await db.usage_records.insert_many([{"_id": record["id"], **record} for record in records], ordered=False)
+        except BulkWriteError as e:
+            # Duplicate keys were stored by an earlier attempt
+            failed = {error["index"] for error in e.details.get("writeErrors", []) if error.get("code") != 11000}
+            if failed:
+                logger.warning(f"Failed to store {len(failed)} usage records: {str(e)}")
+            return [record for i, record in enumerate(records) if i in failed]
+        except Exception as e:
+            logger.warning(f"Failed to store {len(records)} usage records: {str(e)}")
+            return records
+        return []
+
+    async def _roll_up(self, updates: List[UpdateOne]) -> List[UpdateOne]:
+        """Apply rollup updates; returns those that were not applied"""
+        try:
+            await db.usage_hourly.bulk_write(updates, ordered=False)
+        except BulkWriteError as e:
+            logger.warning(f"Failed to update usage rollups: {str(e)}")
+            return [updates[error["index"]] for error in e.details.get("writeErrors", [])]
+        except Exception as e:
+            # Not knowing which updates were applied, retrying them all may count some twice
+            logger.warning(f"Failed to update usage rollups: {str(e)}")
+            return updates
+        return []
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._buffer and not self._rollups:
+                return
+            records = list(self._buffer)
+            self._buffer.clear()
+
+            failed = await self._insert(records) if records else []
+            stored = records
+            if failed:
+                # Keep the unstored records for the next flush, within the buffer cap
+                retry = failed + list(self._buffer)
+                self.dropped += max(0, len(retry) - self.max_buffer)
+                self._buffer = deque(retry, maxlen=self.max_buffer)
+                failed_ids = {record["id"] for record in failed}
+                stored = [record for record in records if record["id"] not in failed_ids]
+
+            updates = self._rollups + (self.rollups(stored) if stored else [])
+            self._rollups = await self._roll_up(updates) if updates else []
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def start(self):
+        try:
+            await db.usage_hourly.create_index([(dimension, 1) for dimension in USAGE_DIMENSIONS])
+            await db.usage_records.create_index("timestamp")
+        except Exception as e:
+            logger.warning(f"Failed to create usage indexes: {str(e)}")
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+usage_ledger = UsageLedger(USAGE_BATCH_SIZE, USAGE_FLUSH_INTERVAL, USAGE_MAX_BUFFER)
+
+def track_usage(modality: str):
+    """Decorator that emits a usage record for every call of a generation handler"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            context: Dict[str, Any] = {}
+            token = usage_context.set(context)
+            started = time.monotonic()
+            request = kwargs.get("request") or (args[0] if args else None)
+
+            async def record(outcome):
+                usage_ledger.record(
+                    modality=modality,
+                    model=getattr(request, "model_id", None),
+                    provider=context.get("provider"),
+                    key_id=context.get("key_id"),
+                    latency_ms=round((time.monotonic() - started) * 1000, 1),
+                    **usage_from_result(modality, outcome)
+                )
+
+            try:
+                result = await handler(*args, **kwargs)
+            except RequestRejected as e:
+                await record(e.payload)
+                raise
+            except asyncio.CancelledError:
+                await record(CLIENT_DISCONNECTED)
+                raise
+            except BaseException:
+                await record(None)
+                raise
+            finally:
+                usage_context.reset(token)
+
+            if isinstance(result, StreamingResponse):
+                # Streams report their outcome through the context once they finish
+                result.body_iterator = iterate_then(
+                    result.body_iterator, lambda: record(context.get("stream_result", CLIENT_DISCONNECTED))
+                )
+            else:
+                await record(result)
+            return result
+        return wrapper
+    return decorator
+
+def usage_from_result(modality: str, result: Any) -> Dict[str, Any]:
+    """Extract status and consumed units from a handler's response"""
+    if not isinstance(result, dict):
+        return {"status": "exception" if result is None else "success"}
+    if "error" in result:
+        return {"status": result["error"].get("type", "unknown_error")}
+    if result.get("cached"):
+        return {"status": "cached"}
+
+    usage: Dict[str, Any] = {"status": "success"}
+    if modality == "chat":
+        tokens = result.get("usage") or {}
+        usage.update({
+            "prompt_tokens": tokens.get("prompt_tokens") or 0,
+            "completion_tokens": tokens.get("completion_tokens") or 0,
+            "total_tokens": tokens.get("total_tokens") or 0,
+        })
+    elif modality == "image":
+        usage["images"] = len(result.get("images") or ()) or 1
+    elif modality == "audio":
+        usage["audio_seconds"] = result.get("duration") or 0.0
+    elif modality == "video":
+        usage["video_seconds"] = result.get("duration") or 0.0
+    return usage
+
+# Usage reporting endpoints
+@api_router.get("/usage")
+async def get_usage(hours: int = 24, group_by: str = "model"):
+    """Aggregate usage and cost over the last N hours from the hourly rollups"""
+    if group_by not in USAGE_DIMENSIONS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of: {', '.join(USAGE_DIMENSIONS)}")
+
+    since = datetime.fromtimestamp(time.time() - hours * 3600, timezone.utc).isoformat()[:13] + ":00:00+00:00"
+    pipeline = [
+        {"$match": {"hour": {"$gte": since}}},
+        {"$group": {"_id": f"${group_by}", **{field: {"$sum": f"${field}"} for field in USAGE_COUNTERS}}},
+        {"$sort": {"requests": -1}}
+    ]
+    groups = await db.usage_hourly.aggregate(pipeline).to_list(1000)
+    for group in groups:
+        group[group_by] = group.pop("_id")
+        group["avg_latency_ms"] = round(group["latency_ms"] / group["requests"], 1) if group["requests"] else 0.0
+
+    return {
+        "since": since,
+        "group_by": group_by,
+        "groups": groups,
+        "totals": {field: sum(group[field] for group in groups) for field in USAGE_COUNTERS},
+        "pending_records": usage_ledger.pending
+    }
+
+@api_router.get("/usage/records")
+async def get_usage_records(limit: int = 100, model: Optional[str] = None):
+    """Most recent raw usage records"""
+    await usage_ledger.flush()
+    query = {"model": model} if model else {}
+    records = await db.usage_records.find(query, {"_id": 0}).sort("timestamp", -1).to_list(min(limit, 1000))
+    return {"records": records}
+
+# Upstream admission control
+SCHEDULER_MAX_CONCURRENCY = int(os.environ.get('SCHEDULER_MAX_CONCURRENCY', '32'))
+SCHEDULER_MAX_QUEUE = int(os.environ.get('SCHEDULER_MAX_QUEUE', '256'))
+SCHEDULER_QUEUE_TIMEOUT = float(os.environ.get('SCHEDULER_QUEUE_TIMEOUT', '30'))
+
+# Concurrent upstream calls allowed per endpoint (video and image are heavier than chat)
+SCHEDULER_ENDPOINT_LIMITS: Dict[str, int] = {
+    "chat": 24,
+    "image": 8,
+    "audio": 8,
+    "video": 4,
+    **json.loads(os.environ.get('SCHEDULER_ENDPOINT_LIMITS', '{}'))
+}
+
+# Priority classes chosen by the X-Priority header, with their fair-queuing weights
+SCHEDULER_PRIORITY_WEIGHTS: Dict[str, float] = json.loads(
+    os.environ.get('SCHEDULER_PRIORITY_WEIGHTS', '{"interactive": 4, "batch": 1}')
+)
+DEFAULT_PRIORITY = "interactive"
+
+request_priority: ContextVar[str] = ContextVar("request_priority", default=DEFAULT_PRIORITY)
+
+class RequestContextMiddleware:
+    """ASGI middleware that exposes per-request headers to handlers through context variables.
+
+    It also counts requests in and out for the drain controller, for the whole
+    response including streamed bodies, and turns new requests away while
+    the server is draining.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        path = scope["path"]
+        if not drain_controller.admit(path):
+            rejection = ServerDraining()
+            response = JSONResponse(
+                status_code=rejection.status_code,
+                content=rejection.payload,
+                headers={"Retry-After": str(rejection.retry_after), "Connection": "close"}
+            )
+            return await response(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        priority = headers.get(b"x-priority", b"").decode("latin-1").strip().lower()
+        priority_token = request_priority.set(priority if priority in SCHEDULER_PRIORITY_WEIGHTS else DEFAULT_PRIORITY)
+        deadline_token = request_deadline.set(parse_deadline(headers))
+        # Deliberately not reset: the loop monitor reads it from the task's context after
+        # a slow step, which may be the one that finished the request. Each request has its own task.
+        request_route.set(f"{scope['method']} {path}")
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_priority.reset(priority_token)
+            request_deadline.reset(deadline_token)
+            drain_controller.release(path)
+
+class RequestRejected(Exception):
+    """Raised when a request is refused instead of being sent upstream"""
+
+    status_code = 503
+
+    def __init__(self, error_type: str, message: str, suggestion: str, action: str, retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        error = {
+            "type": error_type,
+            "message": message,
+            "suggestion": suggestion,
+            "action": action
+        }
+        if retry_after is not None:
+            error["retry_after"] = retry_after
+        self.payload = {"error": error, "status_code": self.status_code}
+
+class SchedulerRejected(RequestRejected):
+    """Raised when a request is shed by the upstream scheduler"""
+
+    def __init__(self, error_type: str, message: str, retry_after: int):
+        super().__init__(
+            error_type, message, f"The server is busy. Please retry in about {retry_after} seconds.",
+            "retry_later", retry_after
+        )
+
+class _Waiter:
+    __slots__ = ("endpoint", "tag", "future")
+
+    def __init__(self, endpoint: str, tag: float, future: asyncio.Future):
+        self.endpoint = endpoint
+        self.tag = tag
+        self.future = future
+
+class UpstreamScheduler:
+    """Global and per-endpoint concurrency limits with weighted fair queuing.
+
+    Each priority class has its own FIFO queue. Waiters are stamped with a
+    virtual finish tag (previous tag of the class + 1/weight), and a freed slot
+    goes to the waiter with the lowest tag whose endpoint still has capacity,
+    so a class with weight 4 is admitted four times as often as one with weight 1
+    while neither is starved.
+    """
+
+    def __init__(self, max_concurrency: int, endpoint_limits: Dict[str, int], weights: Dict[str, float],
+                 max_queue: int, queue_timeout: float):
+        if DEFAULT_PRIORITY not in weights:
+            raise ValueError(f"Scheduler priority weights must include the default priority '{DEFAULT_PRIORITY}'")
+        if any(weight <= 0 for weight in weights.values()):
+            raise ValueError("Scheduler priority weights must be positive")
+        self.max_concurrency = max_concurrency
+        self.endpoint_limits = endpoint_limits
+        self.weights = weights
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.active_by_endpoint: Dict[str, int] = defaultdict(int)
+        self.queues: Dict[str, deque] = {priority: deque() for priority in weights}
+        self.last_tag: Dict[str, float] = dict.fromkeys(weights, 0.0)
+        self.virtual_time = 0.0
+        self.counters: Dict[str, Dict[str, int]] = {
+            priority: {"admitted": 0, "queued": 0, "shed": 0, "timed_out": 0} for priority in weights
+        }
+        # Called when a request has to wait because every global slot is taken, once per such
+        # request, so holders of idle slots can give one back
+        self.on_saturated: List[Callable[[], None]] = []
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def _has_capacity(self, endpoint: str) -> bool:
+        return (self.active < self.max_concurrency
+                and self.active_by_endpoint[endpoint] < self.endpoint_limits.get(endpoint, self.max_concurrency))
+
+    def _acquire(self, endpoint: str):
+        self.active += 1
+        self.active_by_endpoint[endpoint] += 1
+
+    def _release(self, endpoint: str):
+        self.active -= 1
+        self.active_by_endpoint[endpoint] -= 1
+        self._dispatch()
+
+    def try_acquire(self, endpoint: str, priority: str = DEFAULT_PRIORITY) -> bool:
+        """Take a slot only if one is free right now; the caller must release() it"""
+        if not self._has_capacity(endpoint):
+            return False
+        self._acquire(endpoint)
+        self.counters[priority if priority in self.weights else DEFAULT_PRIORITY]["admitted"] += 1
+        return True
+
+    def release(self, endpoint: str):
+        self._release(endpoint)
+
+    def _dispatch(self):
+        while self.active < self.max_concurrency:
+            best = None
+            for queue in self.queues.values():
+                for waiter in queue:
+                    if waiter.future.done():
+                        continue
+                    if self._has_capacity(waiter.endpoint):
+                        if best is None or waiter.tag < best[1].tag:
+                            best = (queue, waiter)
+                        break
+            if best is None:
+                return
+            queue, waiter = best
+            queue.remove(waiter)
+            self.virtual_time = waiter.tag
+            self._acquire(waiter.endpoint)
+            waiter.future.set_result(True)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, endpoint: str, priority: str = DEFAULT_PRIORITY, timeout: Optional[float] = None):
+        """Hold an upstream slot for the duration of the block, queueing if necessary"""
+        timeout = self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+        if priority not in self.weights:
+            priority = DEFAULT_PRIORITY
+        counters = self.counters[priority]
+
+        if self.queued == 0 and self._has_capacity(endpoint):
+            self._acquire(endpoint)
+        else:
+            if self.queued >= self.max_queue:
+                counters["shed"] += 1
+                raise SchedulerRejected("overloaded", "🚦 Too many requests are waiting for the AI provider.", 5)
+
+            tag = max(self.last_tag[priority], self.virtual_time) + 1.0 / self.weights[priority]
+            self.last_tag[priority] = tag
+            waiter = _Waiter(endpoint, tag, asyncio.get_running_loop().create_future())
+            self.queues[priority].append(waiter)
+            counters["queued"] += 1
+            # Other endpoints' waiters must not hold this one back while its endpoint has capacity
+            self._dispatch()
+            if not waiter.future.done() and self.active >= self.max_concurrency:
+                for callback in self.on_saturated:
+                    callback()
+            try:
+                await asyncio.wait_for(waiter.future, timeout)
+            except BaseException as e:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    # The slot was granted just as we gave up; hand it back
+                    self._release(endpoint)
+                elif waiter in self.queues[priority]:
+                    self.queues[priority].remove(waiter)
+                if isinstance(e, asyncio.TimeoutError):
+                    counters["timed_out"] += 1
+                    raise SchedulerRejected(
+                        "queue_timeout",
+                        f"🚦 Request waited more than {self.queue_timeout:g}s for an upstream slot.",
+                        max(1, int(self.queue_timeout))
+                    )
+                raise
+
+        counters["admitted"] += 1
+        try:
+            yield
+        finally:
+            self._release(endpoint)
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "active_by_endpoint": {
+                endpoint: {"active": self.active_by_endpoint[endpoint], "limit": limit}
+                for endpoint, limit in self.endpoint_limits.items()
+            },
+            "queued": self.queued,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "priorities": {
+                priority: {"weight": self.weights[priority], "queued": len(self.queues[priority]), **self.counters[priority]}
+                for priority in self.weights
+            }
+        }
+
+upstream_scheduler = UpstreamScheduler(
+    SCHEDULER_MAX_CONCURRENCY, SCHEDULER_ENDPOINT_LIMITS, SCHEDULER_PRIORITY_WEIGHTS,
+    SCHEDULER_MAX_QUEUE, SCHEDULER_QUEUE_TIMEOUT
+)
+
+def scheduled(endpoint: str):
+    """Decorator that runs a generation handler inside an upstream scheduler slot.
+
+    Streaming responses keep the slot until the stream is finished or closed.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            remaining = remaining_time()
+            if remaining is not None and remaining <= 0:
+                raise DeadlineExceeded()
+
+            stack = contextlib.AsyncExitStack()
+            try:
+                await stack.enter_async_context(upstream_scheduler.slot(endpoint, request_priority.get(), remaining))
+            except SchedulerRejected:
+                if remaining is not None and remaining_time() <= 0:
+                    raise DeadlineExceeded()
+                raise
+
+            try:
+                result = await handler(*args, **kwargs)
+            except BaseException:
+                await stack.aclose()
+                raise
+
+            if isinstance(result, StreamingResponse):
+                result.body_iterator = iterate_then(result.body_iterator, stack.aclose)
+            else:
+                await stack.aclose()
+            return result
+        return wrapper
+    return decorator
+
+@api_router.get("/scheduler")
+async def get_scheduler_status():
+    """Current upstream concurrency, queue depth and admission counters"""
+    return upstream_scheduler.describe()
+
+# Deadlines and client disconnects
+# Default total timeouts per endpoint until a model has enough latency samples; audio and video get aiohttp's 5-minute session default explicitly
+UPSTREAM_TIMEOUTS: Dict[str, float] = {
+    "chat": 60,
+    "image": 120,
+    "audio": 300,
+    "video": 300,
+}
+
+# Absolute UNIX time by which the current request must be answered, if the client set one
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+# Outcome recorded for requests whose client went away
+CLIENT_DISCONNECTED = {"error": {"type": "client_disconnected"}}
+
+def parse_deadline(headers: Dict[bytes, bytes]) -> Optional[float]:
+    """Read X-Request-Deadline (UNIX seconds) or X-Request-Timeout (seconds from now)"""
+    try:
+        if b"x-request-deadline" in headers:
+            return float(headers[b"x-request-deadline"])
+        if b"x-request-timeout" in headers:
+            return time.time() + float(headers[b"x-request-timeout"])
+    except ValueError:
+        pass
+    return None
+
+def remaining_time() -> Optional[float]:
+    """Seconds left before the request deadline, or None if there is no deadline"""
+    deadline = request_deadline.get()
+    return None if deadline is None else deadline - time.time()
+
+class DeadlineExceeded(RequestRejected):
+    """Raised instead of calling upstream once the client's deadline has passed"""
+
+    status_code = 504
+
+    def __init__(self):
+        super().__init__(
+            "deadline_exceeded",
+            "⏱️ The request deadline passed before the model could respond.",
+            "Please try again with a longer deadline or a faster model.",
+            "retry"
+        )
+
+def upstream_timeout(endpoint: str, model: Optional[str] = None) -> aiohttp.ClientTimeout:
+    """Timeout for an upstream call: the model's adaptive timeout, capped by the request deadline"""
+    timeouts = latency_tracker.timeouts(endpoint, model)
+    total = timeouts["total"]
+    remaining = remaining_time()
+    if remaining is not None:
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        total = min(remaining, total)
+    # No sock_read: it limits every read, so a stream pausing between tokens would fail mid-response.
+    # The TTFB limit is enforced up to the response headers by upstream_request instead.
+    return aiohttp.ClientTimeout(total=total, sock_connect=timeouts["connect"])
+
+async def upstream_request(session: aiohttp.ClientSession, endpoint: str, model: Optional[str], path: str, **kwargs):
+    """POST to the A4F API with the model's adaptive timeouts and endpoint failover.
+
+    The total timeout covers the whole call; the TTFB timeout only bounds the
+    wait for the response headers.
+    """
+    timeout = upstream_timeout(endpoint, model)
+    ttfb = latency_tracker.timeouts(endpoint, model)["ttfb"]
+    request = api_upstream.request(session, "POST", path, timeout=timeout, **kwargs)
+    if ttfb is None:
+        return await request
+    return await asyncio.wait_for(request, ttfb)
+
+@contextlib.asynccontextmanager
+async def upstream_post(session: aiohttp.ClientSession, endpoint: str, model: str, path: str,
+                        record_latency: bool = True, **kwargs):
+    """POST to the A4F API with adaptive timeouts and endpoint failover, recording the call's latency for the model.
+
+    Synthetic calls (health probes) pass record_latency=False so they don't shape real requests' timeouts.
+    """
+    started = time.monotonic()
+    try:
+        async with await upstream_request(session, endpoint, model, path, **kwargs) as response:
+            ttfb = time.monotonic() - started
+            yield response
+            if response.status == 200 and record_latency:
+                latency_tracker.observe(endpoint, model, ttfb, time.monotonic() - started)
+    except asyncio.TimeoutError:
+        if record_latency:
+            latency_tracker.observe_timeout(endpoint, model, time.monotonic() - started)
+        raise
+
+async def iterate_then(iterator, callback):
+    """Yield from an async iterator, then await callback() once it is exhausted or closed"""
+    try:
+        async for chunk in iterator:
+            yield chunk
+    finally:
+        try:
+            await iterator.aclose()
+        finally:
+            await callback()
+
+async def wait_for_disconnect(http_request: Request):
+    while True:
+        message = await http_request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+def cancellable(handler):
+    """Decorator that cancels a handler's upstream work when the client disconnects.
+
+    The wrapped endpoint gets an extra http_request parameter injected by FastAPI.
+    Streaming responses are cancelled by Starlette itself once the client is gone.
+    """
+    signature = inspect.signature(handler)
+
+    @functools.wraps(handler)
+    async def wrapper(*args, http_request: Optional[Request] = None, **kwargs):
+        if http_request is None:
+            return await handler(*args, **kwargs)
+
+        task = asyncio.ensure_future(handler(*args, **kwargs))
+        watcher = asyncio.ensure_future(wait_for_disconnect(http_request))
+        try:
+            done, _ = await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            watcher.cancel()
+
+        if task in done:
+            return task.result()
+
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        logger.info(f"Client disconnected, cancelled {http_request.url.path}")
+        return JSONResponse(status_code=499, content={**CLIENT_DISCONNECTED, "status_code": 499})
+
+    wrapper.__signature__ = signature.replace(parameters=[
+        *signature.parameters.values(),
+        inspect.Parameter("http_request", inspect.Parameter.KEYWORD_ONLY, annotation=Request)
+    ])
+    return wrapper
+
+# Resumable chat streams
+# Streamed chat responses are read from upstream by a background task into a replay buffer, so a
+# client whose connection drops can reconnect with Last-Event-ID and continue where it stopped
+STREAM_REPLAY_TTL = float(os.environ.get('STREAM_REPLAY_TTL', '300'))  # Seconds a finished stream stays resumable
+STREAM_DETACH_TIMEOUT = float(os.environ.get('STREAM_DETACH_TIMEOUT', '10'))  # Upstream kept open this long with no client
+STREAM_REPLAY_MAX_BYTES = int(os.environ.get('STREAM_REPLAY_MAX_BYTES', str(1024 * 1024)))  # Per stream; oldest events dropped past it
+STREAM_REPLAY_TOTAL_BYTES = int(os.environ.get('STREAM_REPLAY_TOTAL_BYTES', str(64 * 1024 * 1024)))  # 0 disables resumption
+STREAM_PUMP_PATH = "stream pumps"  # How running upstream readers are counted by the drain controller
+
+STREAM_EXPIRED = {
+    "error": {
+        "type": "stream_expired",
+        "message": "⌛ This response can no longer be resumed.",
+        "suggestion": "Send the request again without Last-Event-ID to generate a new response.",
+        "action": "retry"
+    }
+}
+
+class ReplayBuffer:
+    """Numbered events of one streamed response and the task reading them from upstream"""
+
+    def __init__(self, registry: "StreamReplays", source):
+        self.id = uuid.uuid4().hex
+        self.registry = registry
+        self.events: deque = deque()  # (seq, frame), seq counting from 1 without gaps
+        self.seq = 0
+        self.bytes = 0
+        self.followers = 0
+        self.started = False
+        self.finished_at: Optional[float] = None
+        self._changed = asyncio.Event()
+        # The upstream call outlives the client's request, so drains wait for it separately
+        drain_controller.track(STREAM_PUMP_PATH)
+        self.task = asyncio.create_task(self._pump(source))
+        # Detached until the response starts; it is never iterated if the client is already gone
+        self._detach_timer: Optional[asyncio.TimerHandle] = None
+        self._schedule_detach()
+
+    async def _pump(self, source):
+        abandoned = False
+        try:
+            async with contextlib.aclosing(source) as frames:
+                async for frame in frames:
+                    self._append(frame)
+        except asyncio.CancelledError:
+            # No client came back in time (or shutdown); closing the source closed the upstream call
+            abandoned = True
+            raise
+        except Exception as e:
+            logger.error(f"Error reading stream {self.id}: {str(e)}")
+            self._append(sse_event({
+                "error": {
+                    "type": "unexpected_error",
+                    "message": f"⚠️ Unexpected error occurred: {str(e)[:100]}",
+                    "suggestion": "Please try again or contact support if the issue persists.",
+                    "action": "retry"
+                }
+            }))
+        finally:
+            self.finished_at = time.monotonic()
+            if self._detach_timer is not None:
+                self._detach_timer.cancel()
+            self.registry.finish(self, abandoned)
+            self._notify()
+            drain_controller.release(STREAM_PUMP_PATH)
+
+    def _append(self, frame: str):
+        self.seq += 1
+        self.events.append((self.seq, frame))
+        self.bytes += len(frame)
+        while self.bytes > self.registry.max_stream_bytes and len(self.events) > 1:
+            _, dropped = self.events.popleft()
+            self.bytes -= len(dropped)
+            self.registry.bytes -= len(dropped)
+        self.registry.reserve(len(frame))
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _schedule_detach(self):
+        self._detach_timer = asyncio.get_running_loop().call_later(self.registry.detach_timeout, self.task.cancel)
+
+    @property
+    def detached(self) -> bool:
+        """Still reading from upstream although the client that started it went away"""
+        return self.started and not self.followers and self.finished_at is None
+
+    def can_resume(self, after: int) -> bool:
+        """Whether every event after seq `after` is still buffered"""
+        return 0 <= after <= self.seq and self.seq - after <= len(self.events)
+
+    async def follow(self, after: int):
+        """Yield the events after seq `after` with their IDs, then new ones until the stream ends"""
+        self.followers += 1
+        self.started = True
+        if self._detach_timer is not None:
+            self._detach_timer.cancel()
+            self._detach_timer = None
+        try:
+            while True:
+                changed = self._changed
+                missed = self.seq - after
+                if missed > len(self.events):
+                    # Fell behind the buffer window, or the buffer was evicted
+                    yield sse_event(STREAM_EXPIRED)
+                    return
+                # Index from the right: a follower that keeps up only looks at the newest events
+                batch = [self.events[-i] for i in range(missed, 0, -1)]
+                for seq, frame in batch:
+                    yield f"id: {self.id}:{seq}\n{frame}"
+                after += len(batch)
+                if self.finished_at is not None and after >= self.seq:
+                    return
+                await changed.wait()
+        finally:
+            self.followers -= 1
+            if not self.followers and self.finished_at is None:
+                if drain_controller.draining:
+                    # Reconnects would be turned away while draining
+                    self.task.cancel()
+                else:
+                    self._schedule_detach()
+
+    def response(self, after: int) -> StreamingResponse:
+        return StreamingResponse(
+            self.follow(after),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Stream-ID": self.id}
+        )
+
+class StreamReplays:
+    """Replay buffers of streamed responses by stream ID.
+
+    Each event is sent with the ID "<stream id>:<seq>". A client reconnecting
+    with that ID in Last-Event-ID gets the events it missed and then follows the
+    live stream, without a new upstream call. While no client is attached the
+    upstream stream keeps being read for detach_timeout seconds before it is
+    closed, and its scheduler slot with it. The oldest detached stream is
+    closed at once when a request has to queue because every global slot is
+    taken, and all of them when the server starts draining, so the linger
+    never costs live traffic. Finished buffers stay resumable for ttl seconds. Past max_bytes in
+    total, finished buffers are evicted oldest first, and new streams that
+    don't fit are sent unbuffered, exactly as they would be without resumption.
+    Buffers live in this process, so a resume must reach the same worker.
+    """
+
+    def __init__(self, ttl: float, detach_timeout: float, max_stream_bytes: int, max_bytes: int):
+        self.ttl = ttl
+        self.detach_timeout = detach_timeout
+        self.max_stream_bytes = max_stream_bytes
+        self.max_bytes = max_bytes
+        self.buffers: Dict[str, ReplayBuffer] = {}
+        self.finished: "OrderedDict[str, ReplayBuffer]" = OrderedDict()  # In order of finishing
+        self.bytes = 0
+        self.counters = defaultdict(int)
+
+    def _remove(self, buffer: ReplayBuffer):
+        self.buffers.pop(buffer.id, None)
+        self.finished.pop(buffer.id, None)
+        self.bytes -= buffer.bytes
+        buffer.events.clear()
+        buffer.bytes = 0
+
+    def _expire(self):
+        now = time.monotonic()
+        while self.finished:
+            buffer = next(iter(self.finished.values()))
+            if now - buffer.finished_at < self.ttl:
+                break
+            self._remove(buffer)
+            self.counters["expired"] += 1
+
+    def _evict(self, limit: int):
+        while self.bytes > limit and self.finished:
+            self._remove(next(iter(self.finished.values())))
+            self.counters["evicted"] += 1
+
+    def reserve(self, size: int):
+        """Count size more bytes, evicting finished buffers to stay under max_bytes"""
+        self.bytes += size
+        self._evict(self.max_bytes)
+
+    def finish(self, buffer: ReplayBuffer, abandoned: bool):
+        if abandoned:
+            self._remove(buffer)
+            self.counters["abandoned"] += 1
+        elif buffer.id in self.buffers:
+            self.finished[buffer.id] = buffer
+
+    def buffered(self, response: StreamingResponse) -> StreamingResponse:
+        """Move a streaming response's body into a replay buffer and stream it from there"""
+        self._expire()
+        self._evict(self.max_bytes - 1)
+        if self.bytes >= self.max_bytes:
+            self.counters["unbuffered"] += 1
+            return response
+        buffer = ReplayBuffer(self, response.body_iterator)
+        self.buffers[buffer.id] = buffer
+        self.counters["buffered"] += 1
+        response.body_iterator = buffer.follow(0)
+        response.headers["X-Stream-ID"] = buffer.id
+        return response
+
+    def resume(self, last_event_id: str) -> Response:
+        """Response continuing the stream after the event ID, or 410 if it is gone"""
+        self._expire()
+        stream_id, _, seq = last_event_id.strip().rpartition(":")
+        buffer = self.buffers.get(stream_id)
+        if buffer is None or not seq.isdigit() or not buffer.can_resume(int(seq)):
+            self.counters["expired_resumes"] += 1
+            return JSONResponse(status_code=410, content={**STREAM_EXPIRED, "status_code": 410})
+        self.counters["resumed"] += 1
+        return buffer.response(int(seq))
+
+    def _detached(self) -> List[ReplayBuffer]:
+        """Streams no client is following, oldest first, skipping those already being closed"""
+        return [
+            buffer for buffer in self.buffers.values()
+            if buffer.detached and not buffer.task.done() and not buffer.task.cancelling()
+        ]
+
+    def cancel_detached(self):
+        """Close the upstream calls of all streams no client is following"""
+        for buffer in self._detached():
+            buffer.task.cancel()
+            self.counters["detached_cancelled"] += 1
+
+    def yield_slot(self):
+        """Close the oldest detached stream, handing its scheduler slot to a waiting request"""
+        detached = self._detached()
+        if detached:
+            detached[0].task.cancel()
+            self.counters["detached_cancelled"] += 1
+
+    async def stop(self):
+        tasks = [buffer.task for buffer in self.buffers.values() if buffer.finished_at is None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def describe(self) -> Dict[str, Any]:
+        self._expire()
+        return {
+            "streams": len(self.buffers),
+            "running": len(self.buffers) - len(self.finished),
+            "detached": sum(1 for b in self.buffers.values() if b.detached),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "max_stream_bytes": self.max_stream_bytes,
+            "ttl": self.ttl,
+            "detach_timeout": self.detach_timeout,
+            **self.counters
+        }
+
+stream_replays = StreamReplays(STREAM_REPLAY_TTL, STREAM_DETACH_TIMEOUT, STREAM_REPLAY_MAX_BYTES, STREAM_REPLAY_TOTAL_BYTES)
+upstream_scheduler.on_saturated.append(stream_replays.yield_slot)
+
+def resumable(handler):
+    """Decorator that makes a handler's streaming responses resumable with Last-Event-ID.
+
+    Goes above cancellable and shares its http_request parameter. Calls without
+    one (WebSocket sessions, job workers) stream directly, as before.
+    """
+    @functools.wraps(handler)
+    async def wrapper(*args, http_request: Optional[Request] = None, **kwargs):
+        if http_request is None:
+            return await handler(*args, **kwargs)
+        last_event_id = http_request.headers.get("last-event-id")
+        if last_event_id:
+            return stream_replays.resume(last_event_id)
+        result = await handler(*args, http_request=http_request, **kwargs)
+        if isinstance(result, StreamingResponse):
+            return stream_replays.buffered(result)
+        return result
+    return wrapper
+
+@api_router.get("/chat/streams/{stream_id}")
+async def resume_chat_stream(stream_id: str, http_request: Request):
+    """Replay a buffered chat stream (after Last-Event-ID, if sent) and follow it; for EventSource clients"""
+    last_event_id = http_request.headers.get("last-event-id") or f"{stream_id}:0"
+    if last_event_id.rpartition(":")[0] != stream_id:
+        raise HTTPException(status_code=400, detail="Last-Event-ID belongs to a different stream")
+    return stream_replays.resume(last_event_id)
+
+@api_router.get("/debug/streams")
+async def get_stream_replays():
+    """Replay buffer usage of resumable chat streams"""
+    return stream_replays.describe()
+
+# Adaptive upstream timeouts
+ADAPTIVE_TIMEOUT_MARGIN = float(os.environ.get('ADAPTIVE_TIMEOUT_MARGIN', '1.5'))
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = int(os.environ.get('ADAPTIVE_TIMEOUT_MIN_SAMPLES', '20'))
+ADAPTIVE_CONNECT_TIMEOUT = float(os.environ.get('ADAPTIVE_CONNECT_TIMEOUT', '10'))
+LATENCY_WINDOW = int(os.environ.get('LATENCY_WINDOW', '1000'))  # Histograms are halved past this many samples
+LATENCY_PERSIST = os.environ.get('LATENCY_PERSIST', 'false').lower() == 'true'
+LATENCY_PERSIST_INTERVAL = float(os.environ.get('LATENCY_PERSIST_INTERVAL', '60'))
+
+# (min, max) total timeout per endpoint in seconds
+ADAPTIVE_TIMEOUT_BOUNDS: Dict[str, tuple] = {
+    "chat": (5, 180),
+    "image": (15, 300),
+    "audio": (10, 300),
+    "video": (30, 900),
+}
+
+# Histogram bucket upper bounds: 50ms growing by 25% per bucket up to ~15 minutes
+LATENCY_BUCKETS = [0.05 * 1.25 ** i for i in range(45)]
+
+class LatencyHistogram:
+    """Log-bucketed latency histogram for total time and time to first byte"""
+
+    __slots__ = ("total", "ttfb", "timeouts")
+
+    def __init__(self, total: Optional[List[float]] = None, ttfb: Optional[List[float]] = None, timeouts: int = 0):
+        self.total = total or [0.0] * len(LATENCY_BUCKETS)
+        self.ttfb = ttfb or [0.0] * len(LATENCY_BUCKETS)
+        self.timeouts = timeouts
+
+    @staticmethod
+    def _bucket(seconds: float) -> int:
+        return min(bisect.bisect_left(LATENCY_BUCKETS, seconds), len(LATENCY_BUCKETS) - 1)
+
+    @property
+    def samples(self) -> float:
+        return sum(self.total)
+
+    def add(self, ttfb: Optional[float], total: float):
+        if self.samples >= LATENCY_WINDOW:
+            # Decay old samples so the timeouts follow changes in model latency
+            self.total = [count / 2 for count in self.total]
+            self.ttfb = [count / 2 for count in self.ttfb]
+        self.total[self._bucket(total)] += 1
+        if ttfb is not None:
+            self.ttfb[self._bucket(ttfb)] += 1
+
+    @staticmethod
+    def percentile(counts: List[float], q: float) -> Optional[float]:
+        total = sum(counts)
+        if not total:
+            return None
+        threshold = total * q
+        cumulative = 0.0
+        for bound, count in zip(LATENCY_BUCKETS, counts):
+            cumulative += count
+            if cumulative >= threshold:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+class LatencyTracker:
+    """Per-model latency histograms driving adaptive connect, TTFB and total timeouts.
+
+    Until a model has ADAPTIVE_TIMEOUT_MIN_SAMPLES observations the endpoint
+    defaults from UPSTREAM_TIMEOUTS are used. Afterwards the total timeout is
+    p99 × ADAPTIVE_TIMEOUT_MARGIN clamped to ADAPTIVE_TIMEOUT_BOUNDS, and the
+    TTFB timeout (the wait for response headers) is derived the same way from
+    time to first byte.
+    Timed-out calls are recorded at the elapsed time so timeouts that are too
+    tight grow back.
+    """
+
+    def __init__(self):
+        self.histograms: Dict[tuple, LatencyHistogram] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def _histogram(self, endpoint: str, model: Optional[str]) -> LatencyHistogram:
+        return self.histograms.setdefault((endpoint, model), LatencyHistogram())
+
+    def observe(self, endpoint: str, model: Optional[str], ttfb: Optional[float], total: float):
+        self._histogram(endpoint, model).add(ttfb, total)
+
+    def observe_timeout(self, endpoint: str, model: Optional[str], elapsed: float):
+        histogram = self._histogram(endpoint, model)
+        histogram.timeouts += 1
+        histogram.add(None, elapsed)
+
+    def timeouts(self, endpoint: str, model: Optional[str]) -> Dict[str, Optional[float]]:
+        default = UPSTREAM_TIMEOUTS.get(endpoint, 300)
+        lower, upper = ADAPTIVE_TIMEOUT_BOUNDS.get(endpoint, (default, default))
+        histogram = self.histograms.get((endpoint, model))
+        if histogram is None or histogram.samples < ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+            return {"connect": ADAPTIVE_CONNECT_TIMEOUT, "ttfb": None, "total": default, "adaptive": False}
+
+        total = min(max(histogram.percentile(histogram.total, 0.99) * ADAPTIVE_TIMEOUT_MARGIN, lower), upper)
+        ttfb = None
+        if sum(histogram.ttfb) >= ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+            ttfb = min(max(histogram.percentile(histogram.ttfb, 0.99) * ADAPTIVE_TIMEOUT_MARGIN, lower), total)
+        return {"connect": ADAPTIVE_CONNECT_TIMEOUT, "ttfb": ttfb, "total": total, "adaptive": True}
+
+    def describe(self) -> List[Dict[str, Any]]:
+        views = []
+        for (endpoint, model), histogram in sorted(self.histograms.items(), key=lambda item: (item[0][0], item[0][1] or "")):
+            views.append({
+                "endpoint": endpoint,
+                "model": model,
+                "samples": round(histogram.samples),
+                "timeouts_observed": histogram.timeouts,
+                "p50": histogram.percentile(histogram.total, 0.5),
+                "p90": histogram.percentile(histogram.total, 0.9),
+                "p99": histogram.percentile(histogram.total, 0.99),
+                "ttfb_p99": histogram.percentile(histogram.ttfb, 0.99),
+                "timeout": self.timeouts(endpoint, model)
+            })
+        return views
+
+    async def load(self):
+        try:
+            async for doc in db.latency_histograms.find({}, {"_id": 0}):
+                self.histograms[(doc["endpoint"], doc["model"])] = LatencyHistogram(doc["total"], doc["ttfb"], doc.get("timeouts", 0))
+        except Exception as e:
+            logger.warning(f"Failed to load latency histograms: {str(e)}")
+
+    async def persist(self):
+        operations = [
+            UpdateOne(
+                {"endpoint": endpoint, "model": model},
+                {"$set": {"total": histogram.total, "ttfb": histogram.ttfb, "timeouts": histogram.timeouts}},
+                upsert=True
+            )
+            for (endpoint, model), histogram in self.histograms.items()
+        ]
+        if operations:
+            try:
+                await db.latency_histograms.bulk_write(operations, ordered=False)
+            except Exception as e:
+                logger.warning(f"Failed to persist latency histograms: {str(e)}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(LATENCY_PERSIST_INTERVAL)
+            await self.persist()
+
+    async def start(self):
+        if LATENCY_PERSIST and self._task is None:
+            await self.load()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+            await self.persist()
+
+latency_tracker = LatencyTracker()
+
+@api_router.get("/debug/timeouts")
+async def get_model_timeouts():
+    """Current latency percentiles and adaptive timeouts per endpoint and model"""
+    return {
+        "margin": ADAPTIVE_TIMEOUT_MARGIN,
+        "min_samples": ADAPTIVE_TIMEOUT_MIN_SAMPLES,
+        "bounds": ADAPTIVE_TIMEOUT_BOUNDS,
+        "defaults": UPSTREAM_TIMEOUTS,
+        "models": latency_tracker.describe()
+    }
+
+# Graceful drain
+DRAIN_GRACE_PERIOD = float(os.environ.get('DRAIN_GRACE_PERIOD', '30'))
+DRAIN_RETRY_AFTER = int(os.environ.get('DRAIN_RETRY_AFTER', '5'))
+# Starting or cancelling a drain needs this in X-Drain-Token; without it only direct loopback clients may
+DRAIN_TOKEN = os.environ.get('DRAIN_TOKEN', '')
+LOOPBACK_HOSTS = {"127.0.0.1", "::1"}
+
+# Paths still served while draining, so probes and operators can watch the drain
+DRAIN_EXEMPT_PATHS = {"/api/", "/api/drain", "/healthz", "/readyz", "/api/healthz", "/api/readyz"}
+
+class ServerDraining(RequestRejected):
+    """Raised for new requests once the server has started shutting down"""
+
+    def __init__(self):
+        super().__init__(
+            "server_draining",
+            "🔄 This server is restarting.",
+            "Please retry in a few seconds; another instance will take the request.",
+            "retry",
+            retry_after=DRAIN_RETRY_AFTER
+        )
+
+class DrainController:
+    """Counts in-flight HTTP requests (including streamed bodies) and drains them on shutdown"""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.by_path: Dict[str, int] = defaultdict(int)
+        self.draining = False
+        self.drain_started: Optional[float] = None
+        self.stopping = False
+        self.drain_task: Optional[asyncio.Task] = None
+        self.rejected = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def admit(self, path: str) -> bool:
+        """Count a new request in; False if it must be rejected because we are draining"""
+        if self.draining and path not in DRAIN_EXEMPT_PATHS:
+            self.rejected += 1
+            return False
+        self.track(path)
+        return True
+
+    def track(self, path: str):
+        """Count work in that has already been accepted, e.g. a stream that outlives its request"""
+        self.in_flight += 1
+        self.by_path[path] += 1
+        self._idle.clear()
+
+    def release(self, path: str):
+        self.in_flight -= 1
+        self.by_path[path] -= 1
+        if not self.by_path[path]:
+            del self.by_path[path]
+        if not self.in_flight:
+            self._idle.set()
+
+    def begin(self):
+        if not self.draining:
+            self.draining = True
+            self.drain_started = time.time()
+            logger.info(f"Draining: {self.in_flight} requests in flight")
+            # Nobody could resume a detached stream here any more
+            stream_replays.cancel_detached()
+
+    def cancel(self) -> bool:
+        """Take new work again after a manual drain; False once the process is shutting down"""
+        if self.stopping:
+            return False
+        if self.draining:
+            self.draining = False
+            self.drain_started = None
+            logger.info("Drain cancelled, accepting requests again")
+        return True
+
+    async def drain(self, grace_period: float) -> int:
+        """Stop admitting requests and wait up to grace_period for in-flight ones; returns how many were left"""
+        self.begin()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=grace_period)
+        except asyncio.TimeoutError:
+            logger.warning(f"Drain grace period of {grace_period}s expired with {self.in_flight} requests in flight")
+        return self.in_flight
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "draining": self.draining,
+            "drain_started": self.drain_started,
+            "stopping": self.stopping,
+            "grace_period": DRAIN_GRACE_PERIOD,
+            "in_flight": self.in_flight,
+            "in_flight_by_path": dict(self.by_path),
+            "rejected": self.rejected
+        }
+
+drain_controller = DrainController()
+
+class DrainingServer(uvicorn.Server):
+    """uvicorn server that drains on SIGTERM while it still accepts connections, then exits.
+
+    uvicorn closes its listeners as soon as its exit handler runs, so draining from the shutdown
+    event alone would be too late for readiness to fail and for new requests to get a retryable
+    503 instead of a refused connection. A second SIGTERM, or SIGINT, exits straight away.
+    """
+
+    # Set once a process is serving through this class; startup warns when it is not
+    signals_installed = False
+
+    def install_signal_handlers(self):
+        super().install_signal_handlers()
+        DrainingServer.signals_installed = threading.current_thread() is threading.main_thread()
+
+    def handle_exit(self, sig, frame):
+        if sig != signal.SIGTERM or drain_controller.stopping:
+            super().handle_exit(sig, frame)
+            return
+        drain_controller.stopping = True
+        drain_controller.drain_task = asyncio.get_running_loop().create_task(self._drain_then_exit(sig, frame))
+
+    async def _drain_then_exit(self, sig, frame):
+        try:
+            await drain_controller.drain(DRAIN_GRACE_PERIOD)
+        finally:
+            super().handle_exit(sig, frame)
+
+def require_drain_access(request: Request):
+    """Drain control takes X-Drain-Token when DRAIN_TOKEN is set, otherwise only direct loopback clients"""
+    if DRAIN_TOKEN:
+        if hmac.compare_digest(request.headers.get("X-Drain-Token", ""), DRAIN_TOKEN):
+            return
+    elif request.client and request.client.host in LOOPBACK_HOSTS and "x-forwarded-for" not in request.headers:
+        # A forwarded request came through a local proxy, not from a pre-stop hook
+        return
+    raise HTTPException(status_code=403, detail="Drain control needs a valid X-Drain-Token or a loopback client")
+
+@api_router.get("/drain")
+async def get_drain_status():
+    """In-flight request counts and whether the server is draining"""
+    return drain_controller.describe()
+
+@api_router.post("/drain")
+async def start_drain(request: Request):
+    """Stop taking new work ahead of a shutdown, e.g. from a pre-stop hook"""
+    require_drain_access(request)
+    drain_controller.begin()
+    return drain_controller.describe()
+
+@api_router.delete("/drain")
+async def cancel_drain(request: Request):
+    """Undo a manual drain, e.g. after an aborted rollout"""
+    require_drain_access(request)
+    if not drain_controller.cancel():
+        raise HTTPException(status_code=409, detail="The server is shutting down")
+    return drain_controller.describe()
+
 # A4F Models endpoints
 @api_router.get("/models/{plan}")
 async def get_models(plan: str):
@@ -188,242 +1784,705 @@ async def get_models(plan: str):
 
         # Use A4F public endpoint for model listing
         
-        url = f"https://www.a4f.co/api/get-display-models?plan={plan}"
+        path = f"/api/get-display-models?plan={plan}"
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data
-                else:
-                    raise HTTPException(status_code=response.status, detail="Failed to fetch models from A4F API")
+        async with await catalog_upstream.request(http_session(), "GET", path, headers=headers) as response:
+            if response.status == 200:
+                data = await response.json()
+                return data
+            else:
+                raise HTTPException(status_code=response.status, detail="Failed to fetch models from A4F API")
     
     except Exception as e:
         logger.error(f"Error fetching models: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching models: {str(e)}")
 
-@api_router.get("/models")
-async def get_all_models():
-    """Fetch all models from all plans"""
-    try:
-        all_models = []
-        plans = ["free", "basic", "pro"]
-        
-        for plan in plans:
+# Model catalog
+MODEL_PLANS = ["free", "basic", "pro"]
+CATALOG_SNAPSHOT_PATH = Path(os.environ.get('CATALOG_SNAPSHOT_PATH', str(ROOT_DIR / 'catalog_snapshot.json')))
+CATALOG_REFRESH_INTERVAL = float(os.environ.get('CATALOG_REFRESH_INTERVAL', '600'))
+CATALOG_MAX_AGE = float(os.environ.get('CATALOG_MAX_AGE', '3600'))
+
+def categorize_model(model: Dict[str, Any]) -> str:
+    """Category (text, image, audio, video, other) of a catalog model"""
+    model_type = model.get("type", "").lower()
+    model_name = model.get("name", "").lower()
+
+    if "chat" in model_type or "completion" in model_type or "text" in model_type:
+        return "text"
+    elif "image" in model_type or "vision" in model_type or "dall" in model_name or "imagen" in model_name:
+        return "image"
+    elif "audio" in model_type or "speech" in model_type or "whisper" in model_name:
+        return "audio"
+    elif "video" in model_type or "sora" in model_name:
+        return "video"
+    return "other"
+
+MODEL_CATEGORIES = ("text", "image", "audio", "video", "other")
+
+def _json_bytes(value: Any) -> bytes:
+    """Serialize the way FastAPI's JSONResponse does"""
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+@dataclass(frozen=True, slots=True)
+class CatalogModel:
+    """One catalog entry, parsed once per refresh.
+
+    Strings that repeat across models are interned, and raw is the entry's
+    serialized JSON (the upstream record plus its plan), so responses are
+    assembled from bytes without touching the original dicts again.
+    """
+
+    name: str
+    type: str
+    plan: str
+    category: str
+    provider_ids: Tuple[str, ...]
+    raw: bytes = field(repr=False)
+
+    @classmethod
+    def parse(cls, model: Dict[str, Any], plan: str) -> "CatalogModel":
+        record = {**model, "plan": plan}
+        return cls(
+            name=sys.intern(model.get("name") or ""),
+            type=sys.intern(model.get("type") or ""),
+            plan=sys.intern(plan),
+            category=sys.intern(categorize_model(model)),
+            provider_ids=tuple(
+                sys.intern(provider["id"]) for provider in model.get("proxy_providers") or [] if provider.get("id")
+            ),
+            raw=_json_bytes(record)
+        )
+
+class ModelCatalog:
+    """Last good A4F model catalog, persisted to a local snapshot file.
+
+    On startup the snapshot is loaded from disk so the catalog and model
+    resolution are available without network I/O; the upstream catalog is then
+    refreshed in the background. When a refresh fails the previous data keeps
+    being served and the catalog is reported as stale.
+
+    Models are held as CatalogModel records, and the JSON for the /models
+    response is assembled once per refresh, so serving it only appends the
+    small status object.
+    """
+
+    # The /models response before any catalog is installed
+    EMPTY_RESPONSE_PREFIX = b'{"total_models":0,"models":[],"categorized":{%s},"catalog":' % b",".join(
+        b'"%s":[]' % category.encode() for category in MODEL_CATEGORIES
+    )
+
+    def __init__(self, snapshot_path: Path):
+        self.snapshot_path = snapshot_path
+        self.plans: Dict[str, Tuple[CatalogModel, ...]] = {}
+        self.fetched_at: Optional[float] = None
+        self.source: Optional[str] = None
+        self.last_error: Optional[str] = None
+        self._index: Dict[str, CatalogModel] = {}
+        self.health: Dict[str, bytes] = {}
+        self._version = 0
+        self._response_prefix = self.EMPTY_RESPONSE_PREFIX
+        self._refresh_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def loaded(self) -> bool:
+        return bool(self._index)
+
+    @property
+    def version(self) -> Optional[int]:
+        """Changes whenever the /models response does"""
+        return self._version
+
+    @property
+    def stale(self) -> bool:
+        if self.fetched_at is None:
+            return True
+        return self.last_error is not None or time.time() - self.fetched_at > CATALOG_MAX_AGE
+
+    @staticmethod
+    def _parse(plan: str, models: List[Dict[str, Any]]) -> Tuple[CatalogModel, ...]:
+        return tuple(CatalogModel.parse(model, plan) for model in models)
+
+    def _install(self, plans: Dict[str, Tuple[CatalogModel, ...]], fetched_at: float, source: str):
+        index: Dict[str, CatalogModel] = {}
+        for plan in MODEL_PLANS:
+            for model in plans.get(plan, ()):
+                index.setdefault(model.name, model)
+        self.plans = plans
+        self.fetched_at = fetched_at
+        self.source = source
+        self._index = index
+        self._publish()
+
+    def _entry(self, model: CatalogModel) -> bytes:
+        """A model's JSON for the /models response, with its health spliced in if known"""
+        health = self.health.get(model.name)
+        if health is None:
+            return model.raw
+        separator = b"," if len(model.raw) > 2 else b""
+        return model.raw[:-1] + separator + b'"health":' + health + b"}"
+
+    def _publish(self):
+        """Rebuild the prebuilt /models response from the installed models and health"""
+        categorized: Dict[str, List[bytes]] = {category: [] for category in MODEL_CATEGORIES}
+        models: List[bytes] = []
+        for plan in MODEL_PLANS:
+            for model in self.plans.get(plan, ()):
+                entry = self._entry(model)
+                categorized[model.category].append(entry)
+                models.append(entry)
+
+        categorized_json = b",".join(
+            b'"%s":[%s]' % (category.encode(), b",".join(entries)) for category, entries in categorized.items()
+        )
+        self._response_prefix = b'{"total_models":%d,"models":[%s],"categorized":{%s},"catalog":' % (
+            len(models), b",".join(models), categorized_json
+        )
+        self._version += 1
+
+    def set_health(self, health: Dict[str, Dict[str, Any]]):
+        """Attach health summaries (by model name) to the /models entries"""
+        health = {name: _json_bytes(summary) for name, summary in health.items()}
+        if health == self.health:
+            # Rebuilding would bump the version, invalidating caches keyed on it (and remapping workers)
+            return
+        self.health = health
+        if self.loaded:
+            self._publish()
+
+    def load_snapshot(self) -> bool:
+        """Load the last good catalog from disk; returns False if there is none"""
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                snapshot = json.loads(f.read())
+            plans = {plan: self._parse(plan, models) for plan, models in snapshot["plans"].items()}
+            self._install(plans, snapshot["fetched_at"], "snapshot")
+            logger.info(f"Loaded model catalog snapshot from {self.snapshot_path} ({len(self._index)} models)")
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable catalog snapshot {self.snapshot_path}: {str(e)}")
+            return False
+
+    def _write_snapshot(self):
+        tmp_path = self.snapshot_path.with_suffix(".tmp")
+        plans = b",".join(
+            b'"%s":[%s]' % (plan.encode(), b",".join(model.raw for model in models))
+            for plan, models in self.plans.items()
+        )
+        with open(tmp_path, "wb") as f:
+            f.write(b'{"fetched_at":%s,"plans":{%s}}' % (_json_bytes(self.fetched_at), plans))
+        os.replace(tmp_path, self.snapshot_path)
+
+    async def refresh(self) -> bool:
+        """Fetch all plans from A4F; keeps the previous data for plans that fail"""
+        async with self._refresh_lock:
+            results = await asyncio.gather(*(get_models(plan) for plan in MODEL_PLANS), return_exceptions=True)
+
+            plans: Dict[str, Tuple[CatalogModel, ...]] = {}
+            errors = []
+            for plan, result in zip(MODEL_PLANS, results):
+                if isinstance(result, BaseException) or not result or "models" not in result:
+                    logger.warning(f"Failed to fetch {plan} models: {str(result)}")
+                    errors.append(plan)
+                    plans[plan] = self.plans.get(plan, ())
+                else:
+                    plans[plan] = self._parse(plan, result["models"])
+
+            if len(errors) == len(MODEL_PLANS):
+                self.last_error = "A4F catalog unreachable"
+                return False
+
+            self._install(plans, time.time(), "upstream")
+            self.last_error = f"Failed to refresh plans: {', '.join(errors)}" if errors else None
             try:
-                plan_data = await get_models(plan)
-                if plan_data and "models" in plan_data:
-                    for model in plan_data["models"]:
-                        model["plan"] = plan  # Add plan info to each model
-                        all_models.append(model)
+                await asyncio.to_thread(self._write_snapshot)
             except Exception as e:
-                logger.warning(f"Failed to fetch {plan} models: {str(e)}")
-                continue
-        
-        # Categorize models by type
-        categorized = {
-            "text": [],
-            "image": [],
-            "audio": [],
-            "video": [],
-            "other": []
-        }
-        
-        for model in all_models:
-            model_type = model.get("type", "").lower()
-            model_name = model.get("name", "").lower()
-            
-            if "chat" in model_type or "completion" in model_type or "text" in model_type:
-                categorized["text"].append(model)
-            elif "image" in model_type or "vision" in model_type or "dall" in model_name or "imagen" in model_name:
-                categorized["image"].append(model)
-            elif "audio" in model_type or "speech" in model_type or "whisper" in model_name:
-                categorized["audio"].append(model)
-            elif "video" in model_type or "sora" in model_name:
-                categorized["video"].append(model)
-            else:
-                categorized["other"].append(model)
-        
+                logger.warning(f"Failed to write catalog snapshot: {str(e)}")
+            return True
+
+    async def ensure_loaded(self):
+        """Make sure there is some catalog to serve, fetching it if nothing was loaded"""
+        if not self.loaded:
+            await self.refresh()
+
+    def find(self, model_name: str) -> Optional[CatalogModel]:
+        return self._index.get(model_name)
+
+    def models(self) -> List[CatalogModel]:
+        return [model for plan in MODEL_PLANS for model in self.plans.get(plan, ())]
+
+    def response_body(self) -> bytes:
+        """The /models response: the prebuilt catalog JSON plus the current status"""
+        return self._response_prefix + _json_bytes(self.status()) + b"}"
+
+    def status(self) -> Dict[str, Any]:
         return {
-            "total_models": len(all_models),
-            "models": all_models,
-            "categorized": categorized
+            "source": self.source,
+            "fetched_at": datetime.fromtimestamp(self.fetched_at, timezone.utc).isoformat() if self.fetched_at else None,
+            "age_seconds": round(time.time() - self.fetched_at) if self.fetched_at else None,
+            "stale": self.stale,
+            "last_error": self.last_error
         }
+
+    async def _run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(CATALOG_REFRESH_INTERVAL)
+
+    def start(self):
+        self.load_snapshot()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+# Shared catalog for multi-worker deployments
+# standalone: every process fetches its own catalog; refresher: fetch and publish
+# to CATALOG_SHARED_PATH; worker: map the published file and never fetch
+CATALOG_ROLE = os.environ.get('CATALOG_ROLE', 'standalone').lower()
+CATALOG_SHARED_PATH = Path(os.environ.get('CATALOG_SHARED_PATH', str(ROOT_DIR / 'catalog.shared')))
+CATALOG_SHARED_POLL = float(os.environ.get('CATALOG_SHARED_POLL', '1'))
+
+class SharedCatalogFile:
+    """Versioned, memory-mapped catalog written by the refresher and read by workers.
+
+    Layout: a fixed header, the metadata JSON, the prebuilt /models response
+    prefix, the model records (fields joined by 0x1f) and an index of
+    (crc32(name), record offset, record length) sorted by hash. Lookups binary
+    search the index in place, so workers only copy the record they return.
+    A new version is written beside the file and renamed over it; readers
+    notice the new inode, map it and close their old mapping. The response
+    prefix is copied out once per version, since every /models request needs it.
+    """
+
+    MAGIC = b"A4FCAT01"
+    HEADER = struct.Struct("<8sIIII")  # magic, meta length, body length, records length, index count
+    ENTRY = struct.Struct("<III")  # name hash, record offset, record length
+    SEPARATOR = b"\x1f"
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.meta: Dict[str, Any] = {}
+        self._mm: Optional[mmap.mmap] = None
+        self._identity: Optional[tuple] = None
+        self._prefix = ModelCatalog.EMPTY_RESPONSE_PREFIX
+        self._records = 0
+        self._index = 0
+        self._count = 0
+
+    @classmethod
+    def write(cls, path: Path, catalog: "ModelCatalog"):
+        records, entries, offset = [], [], 0
+        for name, model in catalog._index.items():
+            record = cls.SEPARATOR.join(
+                value.encode("utf-8") for value in (model.name, model.type, model.plan, model.category, *model.provider_ids)
+            )
+            entries.append((zlib.crc32(name.encode("utf-8")), offset, len(record)))
+            records.append(record)
+            offset += len(record)
+        entries.sort()
+
+        meta = _json_bytes({
+            "version": time.time_ns(),
+            "fetched_at": catalog.fetched_at,
+            "source": catalog.source,
+            "last_error": catalog.last_error,
+            "pid": os.getpid()
+        })
+        body = catalog._response_prefix
+        records_blob = b"".join(records)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(meta), len(body), len(records_blob), len(entries)))
+            f.write(meta)
+            f.write(body)
+            f.write(records_blob)
+            f.write(b"".join(cls.ENTRY.pack(*entry) for entry in entries))
+        os.replace(tmp_path, path)
+
+    def refresh(self) -> bool:
+        """Map the current file if it changed since the last call; returns True on a swap"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if identity == self._identity:
+            return False
+
+        with open(self.path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, meta_len, body_len, records_len, count = self.HEADER.unpack_from(mm, 0)
+        if magic != self.MAGIC:
+            mm.close()
+            raise ValueError(f"{self.path} is not a shared catalog file")
+        start = self.HEADER.size
+        meta = json.loads(mm[start:start + meta_len])
+
+        # Swap in the new mapping; lookups copy out of it, so nothing refers to the old one
+        old = self._mm
+        body = start + meta_len
+        self._prefix = mm[body:body + body_len]
+        self._records = start + meta_len + body_len
+        self._index = self._records + records_len
+        self._count = count
+        self.meta = meta
+        self._mm = mm
+        self._identity = identity
+        if old is not None:
+            old.close()
+        return True
+
+    @property
+    def attached(self) -> bool:
+        return self._mm is not None
+
+    def response_prefix(self) -> bytes:
+        return self._prefix
+
+    def _record(self, offset: int, length: int) -> CatalogModel:
+        start = self._records + offset
+        name, model_type, plan, category, *provider_ids = self._mm[start:start + length].decode("utf-8").split("\x1f")
+        return CatalogModel(name, model_type, plan, category, tuple(provider_ids), b"")
+
+    def models(self) -> List[CatalogModel]:
+        """Every model in the order it was published, copied out of the mapping"""
+        if self._mm is None:
+            return []
+        mm, entry = self._mm, self.ENTRY
+        records = sorted(entry.unpack_from(mm, self._index + position * entry.size)[1:] for position in range(self._count))
+        return [self._record(offset, length) for offset, length in records]
+
+    def find(self, name: str) -> Optional[CatalogModel]:
+        if self._mm is None:
+            return None
+        mm, entry = self._mm, self.ENTRY
+        target = zlib.crc32(name.encode("utf-8"))
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if entry.unpack_from(mm, self._index + middle * entry.size)[0] < target:
+                low = middle + 1
+            else:
+                high = middle
+        encoded = name.encode("utf-8") + self.SEPARATOR
+        for position in range(low, self._count):
+            name_hash, offset, length = entry.unpack_from(mm, self._index + position * entry.size)
+            if name_hash != target:
+                break
+            start = self._records + offset
+            if mm[start:start + len(encoded)] == encoded:
+                return self._record(offset, length)
+        return None
+
+class PublishingModelCatalog(ModelCatalog):
+    """The refresher's catalog: also publishes every installed version to the shared file"""
+
+    def __init__(self, snapshot_path: Path, shared_path: Path):
+        super().__init__(snapshot_path)
+        self.shared_path = shared_path
+
+    def _publish(self):
+        super()._publish()
+        try:
+            SharedCatalogFile.write(self.shared_path, self)
+        except Exception as e:
+            logger.warning(f"Failed to publish shared catalog {self.shared_path}: {str(e)}")
+
+class SharedModelCatalog(ModelCatalog):
+    """A worker's catalog: reads the refresher's shared file and never calls A4F"""
+
+    def __init__(self, shared_path: Path):
+        super().__init__(CATALOG_SNAPSHOT_PATH)
+        self.shared = SharedCatalogFile(shared_path)
+
+    def _attach(self) -> bool:
+        try:
+            if self.shared.refresh():
+                meta = self.shared.meta
+                self.fetched_at = meta.get("fetched_at")
+                self.source = "shared"
+                self.last_error = meta.get("last_error")
+            return self.shared.attached
+        except Exception as e:
+            logger.warning(f"Failed to map shared catalog {self.shared.path}: {str(e)}")
+            return False
+
+    @property
+    def loaded(self) -> bool:
+        return self.shared.attached
+
+    @property
+    def version(self) -> Optional[int]:
+        return self.shared.meta.get("version")
+
+    async def refresh(self) -> bool:
+        return self._attach()
+
+    def find(self, model_name: str) -> Optional[CatalogModel]:
+        return self.shared.find(model_name)
+
+    def models(self) -> List[CatalogModel]:
+        return self.shared.models()
+
+    def response_body(self) -> bytes:
+        return self.shared.response_prefix() + _json_bytes(self.status()) + b"}"
+
+    def status(self) -> Dict[str, Any]:
+        status = super().status()
+        status["version"] = self.shared.meta.get("version")
+        return status
+
+    async def _run(self):
+        while True:
+            self._attach()
+            await asyncio.sleep(CATALOG_SHARED_POLL)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+def create_model_catalog() -> ModelCatalog:
+    if CATALOG_ROLE == "worker":
+        return SharedModelCatalog(CATALOG_SHARED_PATH)
+    if CATALOG_ROLE == "refresher":
+        return PublishingModelCatalog(CATALOG_SNAPSHOT_PATH, CATALOG_SHARED_PATH)
+    return ModelCatalog(CATALOG_SNAPSHOT_PATH)
+
+model_catalog = create_model_catalog()
+
+@api_router.get("/models")
+async def get_all_models():
+    """Fetch all models from all plans"""
+    try:
+        await model_catalog.ensure_loaded()
+        # Models and their categorized view are serialized once per catalog refresh
+        return Response(content=model_catalog.response_body(), media_type="application/json")
     
     except Exception as e:
         logger.error(f"Error fetching all models: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching all models: {str(e)}")
 
-def parse_a4f_error(error_response: str) -> Dict[str, Any]:
-    """Parse A4F API error response and return structured user-friendly message"""
-    try:
-        if isinstance(error_response, str):
-            error_data = json.loads(error_response)
+# Upstream error classification
+ERROR_CACHE_SIZE = int(os.environ.get('ERROR_CACHE_SIZE', '1024'))
+
+# Structured responses per error type; {param} and {error_message} come from the upstream error
+ERROR_RESPONSES: Dict[str, Dict[str, str]] = {
+    "model_not_found": {
+        "message": "❌ Model '{param}' not found or unavailable.",
+        "suggestion": "Please select a different model from the dropdown.",
+        "action": "switch_model"
+    },
+    "rate_limit": {
+        "message": "⏱️ Daily usage limit reached for this model.",
+        "suggestion": "Try again tomorrow, upgrade your A4F plan, or switch to a different model.",
+        "action": "wait_or_upgrade"
+    },
+    "model_unavailable": {
+        "message": "🚫 This model is temporarily unavailable or under maintenance.",
+        "suggestion": "Please try a different model or check back later.",
+        "action": "switch_model"
+    },
+    "auth_error": {
+        "message": "🔐 Authentication failed. Your API key is invalid or expired.",
+        "suggestion": "Please update your API key in Settings.",
+        "action": "update_api_key"
+    },
+    "insufficient_credits": {
+        "message": "💳 Insufficient credits or payment required.",
+        "suggestion": "Please add credits to your A4F account or upgrade your plan.",
+        "action": "add_credits"
+    },
+    "access_denied": {
+        "message": "🔒 Access denied to this model.",
+        "suggestion": "You may need to upgrade your A4F plan to use this model.",
+        "action": "upgrade_plan"
+    },
+    "server_error": {
+        "message": "🔧 A4F service is experiencing issues.",
+        "suggestion": "Please try again in a few minutes.",
+        "action": "retry_later"
+    },
+    "context_limit": {
+        "message": "📝 Your prompt is too long for this model.",
+        "suggestion": "Please shorten your prompt or use a model with larger context window.",
+        "action": "shorten_prompt"
+    },
+    "invalid_parameters": {
+        "message": "⚙️ Invalid parameters in your request.",
+        "suggestion": "Please check your settings and try again.",
+        "action": "check_parameters"
+    },
+    "unknown_error": {
+        "message": "⚠️ Error: {error_message}",
+        "suggestion": "Please try again or contact support if the issue persists.",
+        "action": "retry"
+    },
+}
+
+# Ordered classification rules for A4F "detail.error" objects; the first match wins.
+# Each condition is (field, needles): all needles must occur in the lowercased field.
+# The "type=" field compares the whole error type instead of searching it.
+ERROR_RULES: List[tuple] = [
+    ("model_not_found", [("code", ("provider_prefix_missing_or_model_not_found",))]),
+    ("rate_limit", [("code", ("rate_limit",)), ("message", ("quota",)), ("message", ("requests per day",))]),
+    ("model_unavailable", [("message", ("unavailable",)), ("message", ("down",)), ("message", ("maintenance",))]),
+    ("auth_error", [("type", ("unauthorized",)), ("code", ("auth",)), ("code", ("invalid_api_key",))]),
+    ("insufficient_credits", [
+        ("message", ("credit",)), ("message", ("payment",)), ("message", ("billing",)),
+        ("code", ("insufficient_quota",))
+    ]),
+    ("access_denied", [("message", ("access",)), ("message", ("permission",)), ("message", ("plan",))]),
+    ("server_error", [("code", ("internal_server_error",)), ("type=", ("api_error",)), ("code", ("server_error",))]),
+    # Checked before invalid_parameters: context overflows arrive as invalid_request_error
+    ("context_limit", [("message", ("context_length",)), ("message", ("context length",)), ("message", ("token", "limit"))]),
+    ("invalid_parameters", [("type", ("invalid_request_error",)), ("message", ("parameter",))]),
+]
+
+class ErrorClassifier:
+    """ERROR_RULES flattened once into an ordered tuple of conditions.
+
+    A rule matches when any of its conditions does, so the rules are expanded
+    into one (field index, needles, exact, error type) entry per condition in
+    rule order, and the first matching entry decides. Classifying an error
+    lowers each field once and runs plain substring tests up to that entry.
+    """
+
+    # Position of each rule field in the tuple the conditions are tested against
+    FIELD_INDEX = {"code": 0, "message": 1, "type": 2, "type=": 3}
+
+    def __init__(self, rules: List[tuple]):
+        self.rules = rules
+        conditions = []
+        for error_type, rule in rules:
+            for rule_field, needles in rule:
+                if rule_field == "type=":
+                    # Exact comparisons test the needle tuple for membership
+                    conditions.append((self.FIELD_INDEX[rule_field], tuple(needles), True, error_type))
+                else:
+                    # A single needle is stored bare so the common case is one "in" test
+                    conditions.append((self.FIELD_INDEX[rule_field], needles[0] if len(needles) == 1 else tuple(needles), False, error_type))
+        self._conditions = tuple(conditions)
+
+    def classify(self, code: str, message: str, error_type: str) -> str:
+        fields = (code.lower(), message.lower(), error_type.lower(), error_type)
+        for index, needle, exact, result in self._conditions:
+            value = fields[index]
+            if exact:
+                if value in needle:
+                    return result
+            elif isinstance(needle, str):
+                if needle in value:
+                    return result
+            elif all(part in value for part in needle):
+                return result
+        return "unknown_error"
+
+error_classifier = ErrorClassifier(ERROR_RULES)
+
+# Ready-made responses for the types whose message has no placeholders
+STATIC_ERROR_RESPONSES = {
+    error_type: {"type": error_type, **template}
+    for error_type, template in ERROR_RESPONSES.items()
+    if "{" not in template["message"]
+}
+
+def error_response(error_type: str, **values) -> Dict[str, str]:
+    static = STATIC_ERROR_RESPONSES.get(error_type)
+    if static is not None:
+        return dict(static)
+    template = ERROR_RESPONSES[error_type]
+    return {
+        "type": error_type,
+        "message": template["message"].format(**values),
+        "suggestion": template["suggestion"],
+        "action": template["action"]
+    }
+
+def classify_a4f_error(error_data: Any, raw: Optional[str] = None) -> Dict[str, Any]:
+    """Classify a decoded A4F error body; raw is the original text, used in fallback messages"""
+    detail = error_data.get("detail") if isinstance(error_data, dict) else None
+
+    # Handle different A4F error types
+    if isinstance(detail, dict) and isinstance(detail.get("error"), dict):
+        error_info = detail["error"]
+        error_code = str(error_info.get("code") or "")
+        error_message = str(error_info.get("message") or "")
+        error_type = error_classifier.classify(error_code, error_message, str(error_info.get("type") or ""))
+        return error_response(error_type, param=error_info.get("param", "unknown"), error_message=error_message)
+
+    # Handle HTTP status errors
+    if isinstance(error_data, dict) and "error" in error_data:
+        error_msg = error_data.get("error", {})
+        if isinstance(error_msg, dict):
+            message = error_msg.get("message", str(error_data))
         else:
-            error_data = error_response
-            
-        # Handle different A4F error types
-        if "detail" in error_data and "error" in error_data["detail"]:
-            error_info = error_data["detail"]["error"]
-            error_code = error_info.get("code", "")
-            error_message = error_info.get("message", "")
-            error_type = error_info.get("type", "")
-            
-            # Model not found or invalid
-            if "provider_prefix_missing_or_model_not_found" in error_code:
-                return {
-                    "type": "model_not_found",
-                    "message": f"❌ Model '{error_info.get('param', 'unknown')}' not found or unavailable.",
-                    "suggestion": "Please select a different model from the dropdown.",
-                    "action": "switch_model"
-                }
-                
-            # Rate limiting / Daily quota exceeded
-            elif "rate_limit" in error_code.lower() or "quota" in error_message.lower() or "requests per day" in error_message.lower():
-                return {
-                    "type": "rate_limit",
-                    "message": "⏱️ Daily usage limit reached for this model.",
-                    "suggestion": "Try again tomorrow, upgrade your A4F plan, or switch to a different model.",
-                    "action": "wait_or_upgrade"
-                }
-                
-            # Model unavailable/maintenance
-            elif "unavailable" in error_message.lower() or "down" in error_message.lower() or "maintenance" in error_message.lower():
-                return {
-                    "type": "model_unavailable", 
-                    "message": "🚫 This model is temporarily unavailable or under maintenance.",
-                    "suggestion": "Please try a different model or check back later.",
-                    "action": "switch_model"
-                }
-                
-            # Authentication errors
-            elif "unauthorized" in error_type.lower() or "auth" in error_code.lower() or "invalid_api_key" in error_code:
-                return {
-                    "type": "auth_error",
-                    "message": "🔐 Authentication failed. Your API key is invalid or expired.",
-                    "suggestion": "Please update your API key in Settings.",
-                    "action": "update_api_key"
-                }
-                
-            # Insufficient credits/payment required
-            elif "credit" in error_message.lower() or "payment" in error_message.lower() or "billing" in error_message.lower() or "insufficient_quota" in error_code:
-                return {
-                    "type": "insufficient_credits",
-                    "message": "💳 Insufficient credits or payment required.",
-                    "suggestion": "Please add credits to your A4F account or upgrade your plan.",
-                    "action": "add_credits"
-                }
-                
-            # Model access restricted (plan limitation)
-            elif "access" in error_message.lower() or "permission" in error_message.lower() or "plan" in error_message.lower():
-                return {
-                    "type": "access_denied",
-                    "message": "🔒 Access denied to this model.",
-                    "suggestion": "You may need to upgrade your A4F plan to use this model.",
-                    "action": "upgrade_plan"
-                }
-                
-            # Server errors / A4F issues
-            elif "internal_server_error" in error_code or error_type == "api_error" or "server_error" in error_code:
-                return {
-                    "type": "server_error",
-                    "message": "🔧 A4F service is experiencing issues.",
-                    "suggestion": "Please try again in a few minutes.",
-                    "action": "retry_later"
-                }
-                
-            # Invalid parameters
-            elif "invalid_request_error" in error_type or "parameter" in error_message.lower():
-                return {
-                    "type": "invalid_parameters",
-                    "message": "⚙️ Invalid parameters in your request.",
-                    "suggestion": "Please check your settings and try again.",
-                    "action": "check_parameters"
-                }
-                
-            # Context length exceeded
-            elif "context_length" in error_message.lower() or "token" in error_message.lower() and "limit" in error_message.lower():
-                return {
-                    "type": "context_limit",
-                    "message": "📝 Your prompt is too long for this model.",
-                    "suggestion": "Please shorten your prompt or use a model with larger context window.",
-                    "action": "shorten_prompt"
-                }
-                
-            # Generic error with original message
-            else:
-                return {
-                    "type": "unknown_error",
-                    "message": f"⚠️ Error: {error_message}",
-                    "suggestion": "Please try again or contact support if the issue persists.",
-                    "action": "retry"
-                }
-        
-        # Handle HTTP status errors
-        elif "error" in error_data:
-            error_msg = error_data.get("error", {})
-            if isinstance(error_msg, dict):
-                message = error_msg.get("message", str(error_data))
-            else:
-                message = str(error_msg)
-                
-            return {
-                "type": "http_error",
-                "message": f"❌ API Error: {message}",
-                "suggestion": "Please try again or check your request parameters.",
-                "action": "retry"
-            }
-        
-        # Fallback for unknown error format
+            message = str(error_msg)
+
         return {
-            "type": "unknown_error",
-            "message": f"❌ Unexpected error: {str(error_response)[:200]}",
-            "suggestion": "Please try again or contact support if the issue persists.",
+            "type": "http_error",
+            "message": f"❌ API Error: {message}",
+            "suggestion": "Please try again or check your request parameters.",
             "action": "retry"
         }
-        
-    except Exception as e:
+
+    # Fallback for unknown error format
+    return {
+        "type": "unknown_error",
+        "message": f"❌ Unexpected error: {(raw if raw is not None else str(error_data))[:200]}",
+        "suggestion": "Please try again or contact support if the issue persists.",
+        "action": "retry"
+    }
+
+@functools.lru_cache(maxsize=ERROR_CACHE_SIZE)
+def _parse_a4f_error_text(error_response: str) -> Dict[str, Any]:
+    try:
+        error_data = json.loads(error_response)
+    except ValueError as e:
         logger.warning(f"Error parsing A4F error response: {str(e)}")
         return {
             "type": "parsing_error",
-            "message": f"❌ Error processing response: {str(error_response)[:100]}",
+            "message": f"❌ Error processing response: {error_response[:100]}",
             "suggestion": "Please try again or contact support.",
             "action": "retry"
         }
 
+    return classify_a4f_error(error_data, error_response)
+
+def parse_a4f_error(error_response: str) -> Dict[str, Any]:
+    """Parse A4F API error response and return structured user-friendly message.
+
+    Raw error bodies repeat heavily while upstream is struggling, so results for
+    string bodies are memoized (ERROR_CACHE_SIZE entries).
+    """
+    if isinstance(error_response, str):
+        return dict(_parse_a4f_error_text(error_response))
+    return classify_a4f_error(error_response)
+
 async def get_full_model_id(model_name: str, provider_id: str = None):
-    """Get the full model ID with provider prefix from A4F API"""
+    """Get the full model ID with provider prefix from the model catalog"""
     try:
         # If provider_id is already provided and looks like a full ID (contains /), use it directly
         if provider_id and "/" in provider_id:
             return provider_id
             
-        # First try to fetch all models to find the correct provider prefix
-        plans = ["free", "basic", "pro"]
-        for plan in plans:
-            url = f"https://www.a4f.co/api/get-display-models?plan={plan}"
-            headers = {
-                'accept': '*/*',
-                'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36'
-            }
+        await model_catalog.ensure_loaded()
+        model = model_catalog.find(model_name)
+        if model and model.provider_ids:
+            # If specific provider_id requested, try to find it
+            if provider_id:
+                for full_id in model.provider_ids:
+                    if full_id == provider_id or full_id.startswith(provider_id):
+                        return full_id
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if "models" in data:
-                            for model in data["models"]:
-                                if model.get("name") == model_name:
-                                    # If specific provider_id requested, try to find it
-                                    if provider_id and model.get("proxy_providers"):
-                                        for provider in model["proxy_providers"]:
-                                            if provider.get("id") == provider_id or provider.get("id", "").startswith(provider_id):
-                                                return provider.get("id")
-                                    
-                                    # Return the first available provider if no specific one requested
-                                    if model.get("proxy_providers"):
-                                        provider_id_found = model["proxy_providers"][0]["id"]
-                                        return provider_id_found
+            # Return the first available provider if no specific one requested
+            return model.provider_ids[0]
         
         # If no provider found, try the name as-is (might already have prefix)
         return model_name
@@ -433,469 +2492,3374 @@ async def get_full_model_id(model_name: str, provider_id: str = None):
         # Fallback to the original name
         return model_name
 
-@api_router.post("/chat")
-async def chat_with_model(request: TextModelRequest):
-    """Chat with a text model with enhanced options"""
-    try:
-        # Get API key from request or stored keys
-        api_key = request.api_key
-        if not api_key:
-            stored_key = await db.api_keys.find_one({"provider": "a4f"}, {"_id": 0})
-            if stored_key:
-                api_key = stored_key["api_key"]
-        
-        if not api_key:
-            return {
-                "error": {
-                    "type": "no_api_key",
-                    "message": "🔐 No API key configured.",
-                    "suggestion": "Please add your A4F API key in Settings to use the models.",
-                    "action": "add_api_key"
-                }
-            }
-        
-        # Get the full model ID with provider prefix
-        full_model_id = await get_full_model_id(request.model_id, request.provider_id)
-        
-        # Build messages array with conversation history and system prompt
-        messages = []
-        
-        # Add system prompt if provided
-        if request.system_prompt:
-            messages.append({"role": "system", "content": request.system_prompt})
-        
-        # Add conversation history if provided
-        if request.conversation_history:
-            messages.extend(request.conversation_history)
-        
-        # Add current user message
-        messages.append({"role": "user", "content": request.prompt})
-        
-        # Make real API call to A4F
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "model": full_model_id,
-            "messages": messages,
-            "temperature": request.temperature,
-            "max_tokens": request.max_tokens,
-            "top_p": request.top_p,
-            "frequency_penalty": request.frequency_penalty,
-            "presence_penalty": request.presence_penalty,
-            "stream": request.stream
-        }
-        
+# Shared upstream HTTP session
+UPSTREAM_CONNECTION_LIMIT = int(os.environ.get('UPSTREAM_CONNECTION_LIMIT', '100'))
+UPSTREAM_KEEPALIVE_TIMEOUT = float(os.environ.get('UPSTREAM_KEEPALIVE_TIMEOUT', '30'))  # Idle seconds before a pooled connection closes
+
+_http_session: Optional[aiohttp.ClientSession] = None
+
+def http_session() -> aiohttp.ClientSession:
+    """Shared client session, so upstream connections are pooled and kept alive.
+
+    With UPSTREAM_CASSETTE_MODE set, this is a CassetteSession that records
+    the live traffic or replays it without any network access.
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        if UPSTREAM_CASSETTE_MODE == "replay":
+            upstream_cassette.load()
+            _http_session = CassetteSession(upstream_cassette)
+        else:
+            _http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=UPSTREAM_CONNECTION_LIMIT, ttl_dns_cache=300, keepalive_timeout=UPSTREAM_KEEPALIVE_TIMEOUT
+                )
+            )
+            if UPSTREAM_CASSETTE_MODE == "record":
+                _http_session = CassetteSession(upstream_cassette, _http_session)
+    return _http_session
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+# Upstream endpoints
+# Comma-separated base URLs in order of preference, each optionally weighted: "https://a|2,https://b|1"
+UPSTREAM_BASE_URLS = os.environ.get('UPSTREAM_BASE_URLS', 'https://api.a4f.co')
+UPSTREAM_CATALOG_URLS = os.environ.get('UPSTREAM_CATALOG_URLS', 'https://www.a4f.co')
+UPSTREAM_ROUTING = os.environ.get('UPSTREAM_ROUTING', 'latency')  # latency, ordered or weighted
+UPSTREAM_FAILOVER_ATTEMPTS = int(os.environ.get('UPSTREAM_FAILOVER_ATTEMPTS', '3'))  # Endpoints tried per call
+UPSTREAM_FAILURE_THRESHOLD = int(os.environ.get('UPSTREAM_FAILURE_THRESHOLD', '3'))  # Consecutive failures before ejection
+UPSTREAM_EJECT_SECONDS = float(os.environ.get('UPSTREAM_EJECT_SECONDS', '30'))  # Doubles with each ejection in a row
+UPSTREAM_PROBE_INTERVAL = float(os.environ.get('UPSTREAM_PROBE_INTERVAL', '10'))
+UPSTREAM_PROBE_TIMEOUT = float(os.environ.get('UPSTREAM_PROBE_TIMEOUT', '3'))
+
+class UpstreamEndpoint:
+    __slots__ = ("url", "weight", "rtt", "consecutive_failures", "ejections", "ejected_until", "requests", "failures")
+
+    def __init__(self, url: str, weight: float = 1.0):
+        self.url = url.rstrip("/")
+        self.weight = weight
+        self.rtt: Optional[float] = None  # Smoothed round trip of the health probes, in seconds
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    def ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def succeeded(self):
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+    def failed(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= UPSTREAM_FAILURE_THRESHOLD:
+            self.ejected_until = time.monotonic() + UPSTREAM_EJECT_SECONDS * 2 ** min(self.ejections, 5)
+            self.ejections += 1
+            self.consecutive_failures = 0
+            logger.warning(f"Ejected upstream {self.url} for {self.ejected_until - time.monotonic():.0f}s")
+
+class UpstreamPool:
+    """Several base URLs for the same upstream API, with health tracking and failover.
+
+    Calls go to the best endpoint that is not ejected: the one with the
+    lowest probe round trip divided by its weight (latency routing), the
+    first in configured order (ordered), or a weighted random pick
+    (weighted). Only failures to connect and 5xx responses count against an
+    endpoint; a read timeout says more about the model than the endpoint.
+    Calls that never reached the upstream are retried on the next endpoint,
+    within the original timeout, as are GETs that failed in any way. A POST
+    that may have been received is never sent again, since the generation
+    could already be running (and billed). Repeated failures eject an
+    endpoint for a growing period; a background task probes every endpoint,
+    over its own session, so latencies stay current and ejected endpoints
+    come back as soon as they answer.
+    """
+
+    # The request was not sent: no connection could be opened in time
+    NOT_SENT_ERRORS = (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError)
+
+    def __init__(self, name: str, spec: str, routing: str = UPSTREAM_ROUTING):
+        self.name = name
+        self.routing = routing
+        self.endpoints: List[UpstreamEndpoint] = []
+        for entry in filter(None, (part.strip() for part in spec.split(","))):
+            url, _, weight = entry.partition("|")
+            self.endpoints.append(UpstreamEndpoint(url, float(weight or 1)))
+        self.failovers = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def primary(self) -> str:
+        return self.candidates()[0].url
+
+    def candidates(self) -> List[UpstreamEndpoint]:
+        """Endpoints in the order they should be tried; ejected ones last, soonest back first"""
+        now = time.monotonic()
+        available = [endpoint for endpoint in self.endpoints if not endpoint.ejected(now)]
+        ejected = sorted((endpoint for endpoint in self.endpoints if endpoint.ejected(now)), key=lambda e: e.ejected_until)
+        if self.routing == "latency":
+            # Unprobed endpoints keep their configured order behind the measured ones
+            available.sort(key=lambda e: e.rtt / e.weight if e.rtt is not None else float("inf"))
+        elif self.routing == "weighted":
+            available.sort(key=lambda e: random.random() ** (1 / e.weight), reverse=True)
+        return available + ejected
+
+    async def request(self, session, method: str, path: str, timeout: Optional[aiohttp.ClientTimeout] = None, **kwargs):
+        """Send a request to the best endpoint, failing over when it could not have been received"""
+        started = time.monotonic()
+        candidates = self.candidates()[:max(1, UPSTREAM_FAILOVER_ATTEMPTS)]
+        send = session.get if method == "GET" else session.post
+        for attempt, endpoint in enumerate(candidates):
+            attempt_timeout = timeout
+            if attempt and timeout is not None and timeout.total:
+                # Later attempts only get what is left of the caller's timeout
+                attempt_timeout = aiohttp.ClientTimeout(
+                    total=timeout.total - (time.monotonic() - started),
+                    sock_connect=timeout.sock_connect, sock_read=timeout.sock_read
+                )
+            endpoint.requests += 1
+            try:
+                response = await send(endpoint.url + path, timeout=attempt_timeout, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                not_sent = isinstance(e, self.NOT_SENT_ERRORS)
+                if not_sent:
+                    endpoint.failed()
+                out_of_time = timeout is not None and timeout.total and time.monotonic() - started >= timeout.total
+                if attempt == len(candidates) - 1 or out_of_time or not (not_sent or method == "GET"):
+                    raise
+                self.failovers += 1
+                logger.warning(f"Upstream {endpoint.url} failed ({type(e).__name__}), failing over to {candidates[attempt + 1].url}")
+                continue
+            if response.status >= 500:
+                endpoint.failed()
+            else:
+                endpoint.succeeded()
+            return response
+
+    async def probe(self, session: aiohttp.ClientSession, endpoint: UpstreamEndpoint):
+        started = time.monotonic()
+        try:
+            # Any HTTP response means DNS, TCP and TLS to the endpoint work
+            async with session.get(
+                endpoint.url, allow_redirects=False, timeout=aiohttp.ClientTimeout(total=UPSTREAM_PROBE_TIMEOUT)
+            ):
+                pass
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            endpoint.failed()
+            return
+        rtt = time.monotonic() - started
+        endpoint.rtt = rtt if endpoint.rtt is None else 0.7 * endpoint.rtt + 0.3 * rtt
+        endpoint.succeeded()
+
+    async def _probe_forever(self):
+        # Not http_session(): probes stay out of its connection pool and out of recorded cassettes
         async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://api.a4f.co/v1/chat/completions", 
-                headers=headers, 
-                json=payload,
-                timeout=aiohttp.ClientTimeout(total=60)  # Longer timeout for complex requests
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if "choices" in data and len(data["choices"]) > 0:
-                        return {
-                            "success": True,
-                            "response": data["choices"][0]["message"]["content"],
-                            "model": request.model_id,
-                            "usage": data.get("usage", {
-                                "prompt_tokens": len(request.prompt.split()),
-                                "completion_tokens": 50,
-                                "total_tokens": len(request.prompt.split()) + 50
-                            }),
-                            "finish_reason": data["choices"][0].get("finish_reason", "stop")
-                        }
-                    else:
-                        return {
-                            "error": {
-                                "type": "no_response",
-                                "message": "🤔 No response received from the model.",
-                                "suggestion": "Please try again or use a different model.",
-                                "action": "retry"
-                            }
-                        }
-                else:
-                    error_text = await response.text()
-                    error_info = parse_a4f_error(error_text)
-                    return {"error": error_info, "status_code": response.status}
-    
-    except aiohttp.ClientError as e:
-        logger.error(f"Network error in chat: {str(e)}")
+            while True:
+                await asyncio.gather(*(self.probe(session, endpoint) for endpoint in self.endpoints))
+                await asyncio.sleep(UPSTREAM_PROBE_INTERVAL)
+
+    def describe(self) -> Dict[str, Any]:
+        now = time.monotonic()
         return {
-            "error": {
-                "type": "network_error",
-                "message": "🌐 Network connection failed.",
-                "suggestion": "Please check your internet connection and try again.",
-                "action": "check_connection"
-            }
+            "routing": self.routing,
+            "probing": self._task is not None,
+            "failovers": self.failovers,
+            "endpoints": [
+                {
+                    "url": endpoint.url,
+                    "weight": endpoint.weight,
+                    "status": "ejected" if endpoint.ejected(now) else "healthy",
+                    "rtt_ms": round(endpoint.rtt * 1000, 1) if endpoint.rtt is not None else None,
+                    "ejected_for": round(endpoint.ejected_until - now, 1) if endpoint.ejected(now) else None,
+                    "requests": endpoint.requests,
+                    "failures": endpoint.failures
+                }
+                for endpoint in self.candidates()
+            ]
         }
-    except Exception as e:
-        logger.error(f"Error in chat: {str(e)}")
+
+    def start(self):
+        # A single endpoint has nothing to route between; replayed cassettes have no network
+        if len(self.endpoints) > 1 and UPSTREAM_CASSETTE_MODE != "replay" and self._task is None:
+            self._task = asyncio.create_task(self._probe_forever())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            # Let the probe session close
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+api_upstream = UpstreamPool("api", UPSTREAM_BASE_URLS)
+catalog_upstream = UpstreamPool("catalog", UPSTREAM_CATALOG_URLS)
+
+@api_router.get("/debug/upstreams")
+async def get_upstream_endpoints():
+    """Health, probe latency and failover counts of every upstream base URL"""
+    return {pool.name: pool.describe() for pool in (api_upstream, catalog_upstream)}
+
+# Upstream cassettes
+UPSTREAM_CASSETTE_MODE = os.environ.get('UPSTREAM_CASSETTE_MODE', 'off').lower()  # off, record, replay
+UPSTREAM_CASSETTE_PATH = Path(os.environ.get('UPSTREAM_CASSETTE_PATH', str(ROOT_DIR / 'cassettes' / 'upstream.jsonl')))
+UPSTREAM_CASSETTE_TIMING = os.environ.get('UPSTREAM_CASSETTE_TIMING', 'recorded').lower()  # recorded, fast
+
+CASSETTE_REDACTED_HEADERS = {"authorization", "cookie", "x-api-key"}
+
+def _encode_chunk(offset: float, chunk: bytes) -> list:
+    try:
+        return [round(offset, 4), "t", chunk.decode("utf-8")]
+    except UnicodeDecodeError:
+        return [round(offset, 4), "b", base64.b64encode(chunk).decode("ascii")]
+
+def _decode_chunk(chunk: list) -> tuple:
+    offset, encoding, data = chunk
+    return offset, data.encode("utf-8") if encoding == "t" else base64.b64decode(data)
+
+class Cassette:
+    """Upstream interactions stored one JSON object per line.
+
+    Each interaction holds the request (with credentials redacted), the
+    response status and headers, the time to first byte and every body chunk
+    with its offset from the start of the request, so SSE and audio streams
+    replay with their original pacing. Replay matches on method, URL and JSON
+    body, falling back to method and URL; repeated requests are served in
+    recorded order, the last one repeating once they run out.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        self._exact: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._loose: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._served: Dict[str, int] = defaultdict(int)
+
+    @staticmethod
+    def keys(method: str, url: str, body: Any) -> tuple:
+        loose = f"{method} {url}"
+        return f"{loose} {json.dumps(body, sort_keys=True)}", loose
+
+    def load(self):
+        self._exact.clear()
+        self._loose.clear()
+        self._served.clear()
+        with open(self.path) as f:
+            for line in f:
+                if line.strip():
+                    interaction = json.loads(line)
+                    exact, loose = self.keys(interaction["method"], interaction["url"], interaction.get("body"))
+                    self._exact[exact].append(interaction)
+                    self._loose[loose].append(interaction)
+        logger.info(f"Replaying upstream traffic from {self.path} ({sum(map(len, self._exact.values()))} interactions)")
+
+    def append(self, interaction: Dict[str, Any]):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(interaction, separators=(",", ":")) + "\n")
+        self.recorded += 1
+
+    def next(self, method: str, url: str, body: Any) -> Optional[Dict[str, Any]]:
+        exact, loose = self.keys(method, url, body)
+        for key, candidates in ((exact, self._exact.get(exact)), (loose, self._loose.get(loose))):
+            if candidates:
+                index = self._served[key]
+                self._served[key] += 1
+                self.replayed += 1
+                return candidates[min(index, len(candidates) - 1)]
+        self.misses += 1
+        return None
+
+    def describe(self) -> Dict[str, Any]:
         return {
-            "error": {
-                "type": "unexpected_error",
-                "message": f"⚠️ Unexpected error occurred: {str(e)[:100]}",
-                "suggestion": "Please try again or contact support if the issue persists.",
-                "action": "retry"
-            }
+            "mode": UPSTREAM_CASSETTE_MODE,
+            "path": str(self.path),
+            "timing": UPSTREAM_CASSETTE_TIMING,
+            "recorded": self.recorded,
+            "replayed": self.replayed,
+            "misses": self.misses,
+            "interactions": sum(map(len, self._exact.values()))
         }
 
-def aspect_ratio_to_size(aspect_ratio: str, base_size: str = "1024x1024") -> str:
-    """Convert aspect ratio to appropriate size"""
-    aspect_ratios = {
-        "1:1": "1024x1024",
-        "16:9": "1792x1024", 
-        "9:16": "1024x1792",
-        "4:3": "1536x1152",
-        "3:4": "1152x1536",
-        "3:2": "1536x1024",
-        "2:3": "1024x1536"
-    }
-    return aspect_ratios.get(aspect_ratio, base_size)
+class _RecordingContent:
+    """response.content that records each chunk the caller reads"""
 
-@api_router.post("/generate-image")
-async def generate_image(request: ImageModelRequest):
-    """Generate image with enhanced options"""
-    try:
-        # Get API key from request or stored keys
-        api_key = request.api_key
-        if not api_key:
-            stored_key = await db.api_keys.find_one({"provider": "a4f"}, {"_id": 0})
-            if stored_key:
-                api_key = stored_key["api_key"]
-        
-        if not api_key:
-            return {
-                "error": {
-                    "type": "no_api_key",
-                    "message": "🔐 No API key configured.",
-                    "suggestion": "Please add your A4F API key in Settings to use the models.",
-                    "action": "add_api_key"
-                }
-            }
-        
-        # Get the full model ID with provider prefix
-        full_model_id = await get_full_model_id(request.model_id, request.provider_id)
-        
-        # Convert aspect ratio to size if needed
-        if request.aspect_ratio and request.aspect_ratio != "custom":
-            size = aspect_ratio_to_size(request.aspect_ratio, request.size)
+    def __init__(self, response: "_RecordingResponse"):
+        self._response = response
+
+    async def _record(self, chunks):
+        async for chunk in chunks:
+            self._response.chunk(chunk)
+            yield chunk
+
+    def __aiter__(self):
+        return self._record(self._response.response.content).__aiter__()
+
+    def iter_chunked(self, n: int):
+        return self._record(self._response.response.content.iter_chunked(n))
+
+class _RecordingResponse:
+    """Wraps a live aiohttp response and writes it to the cassette when released"""
+
+    def __init__(self, cassette: Cassette, response: aiohttp.ClientResponse, interaction: Dict[str, Any], started: float):
+        self.cassette = cassette
+        self.response = response
+        self.interaction = interaction
+        self.started = started
+        self.status = response.status
+        self.headers = response.headers
+        self.content = _RecordingContent(self)
+        self._saved = False
+
+    def chunk(self, data: bytes):
+        self.interaction["chunks"].append(_encode_chunk(time.monotonic() - self.started, data))
+
+    async def read(self) -> bytes:
+        body = await self.response.read()
+        self.chunk(body)
+        return body
+
+    async def text(self) -> str:
+        return (await self.read()).decode(self.response.get_encoding())
+
+    async def json(self, **kwargs) -> Any:
+        return json.loads(await self.read())
+
+    def release(self):
+        self.response.release()
+        if not self._saved:
+            self._saved = True
+            self.cassette.append(self.interaction)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+class _ReplayContent:
+    def __init__(self, response: "_ReplayResponse"):
+        self._response = response
+
+    async def __aiter__(self):
+        buffer = b""
+        async for chunk in self._response.chunks():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                yield line + b"\n"
+        if buffer:
+            yield buffer
+
+    async def iter_chunked(self, n: int):
+        async for chunk in self._response.chunks():
+            for start in range(0, len(chunk), n):
+                yield chunk[start:start + n]
+
+class _ReplayResponse:
+    """A recorded response, its body chunks delivered at their recorded offsets"""
+
+    def __init__(self, interaction: Dict[str, Any], started: float):
+        self.status = interaction["status"]
+        self.headers = CIMultiDict(interaction["headers"])
+        self.content = _ReplayContent(self)
+        self._chunks = [_decode_chunk(chunk) for chunk in interaction["chunks"]]
+        self._started = started
+
+    async def chunks(self):
+        for offset, data in self._chunks:
+            if UPSTREAM_CASSETTE_TIMING == "recorded":
+                await asyncio.sleep(max(0.0, self._started + offset - time.monotonic()))
+            yield data
+
+    async def read(self) -> bytes:
+        return b"".join([chunk async for chunk in self.chunks()])
+
+    async def text(self) -> str:
+        return (await self.read()).decode("utf-8")
+
+    async def json(self, **kwargs) -> Any:
+        return json.loads(await self.read())
+
+    def release(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+class _CassetteRequest:
+    """Awaitable and async context manager, like aiohttp's session.get/post"""
+
+    def __init__(self, session: "CassetteSession", method: str, url: str, kwargs: Dict[str, Any]):
+        self.session = session
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self.response = None
+
+    def __await__(self):
+        return self.session.request(self.method, self.url, self.kwargs).__await__()
+
+    async def __aenter__(self):
+        self.response = await self
+        return self.response
+
+    async def __aexit__(self, *exc_info):
+        self.response.release()
+
+class CassetteSession:
+    """Stands in for the shared aiohttp session while recording or replaying upstream traffic"""
+
+    def __init__(self, cassette: Cassette, session: Optional[aiohttp.ClientSession] = None):
+        self.cassette = cassette
+        self.session = session
+
+    @property
+    def closed(self) -> bool:
+        return self.session is not None and self.session.closed
+
+    def get(self, url: str, **kwargs) -> _CassetteRequest:
+        return _CassetteRequest(self, "GET", url, kwargs)
+
+    def post(self, url: str, **kwargs) -> _CassetteRequest:
+        return _CassetteRequest(self, "POST", url, kwargs)
+
+    async def request(self, method: str, url: str, kwargs: Dict[str, Any]):
+        if self.session is None:
+            return await self.replay(method, url, kwargs)
+        return await self.record(method, url, kwargs)
+
+    async def record(self, method: str, url: str, kwargs: Dict[str, Any]) -> _RecordingResponse:
+        interaction = {
+            "method": method,
+            "url": url,
+            "body": kwargs.get("json"),
+            "request_headers": {
+                name: "REDACTED" if name.lower() in CASSETTE_REDACTED_HEADERS else value
+                for name, value in (kwargs.get("headers") or {}).items()
+            }
+        }
+        started = time.monotonic()
+        try:
+            response = await self.session.request(method, url, **kwargs)
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            interaction.update({
+                "error": "timeout" if isinstance(e, asyncio.TimeoutError) else "client_error",
+                "ttfb": round(time.monotonic() - started, 4)
+            })
+            self.cassette.append(interaction)
+            raise
+        interaction.update({
+            "status": response.status,
+            "headers": dict(response.headers),
+            "ttfb": round(time.monotonic() - started, 4),
+            "chunks": []
+        })
+        return _RecordingResponse(self.cassette, response, interaction, started)
+
+    async def replay(self, method: str, url: str, kwargs: Dict[str, Any]) -> _ReplayResponse:
+        started = time.monotonic()
+        interaction = self.cassette.next(method, url, kwargs.get("json"))
+        if interaction is None:
+            raise aiohttp.ClientConnectionError(f"No recorded upstream interaction for {method} {url}")
+        if UPSTREAM_CASSETTE_TIMING == "recorded":
+            await asyncio.sleep(interaction["ttfb"])
+        if interaction.get("error") == "timeout":
+            raise asyncio.TimeoutError()
+        if interaction.get("error"):
+            raise aiohttp.ClientConnectionError(f"Recorded connection error for {method} {url}")
+        return _ReplayResponse(interaction, started)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+upstream_cassette = Cassette(UPSTREAM_CASSETTE_PATH)
+
+@api_router.get("/debug/cassette")
+async def get_cassette_status():
+    """Upstream record/replay mode and how many interactions were recorded or served"""
+    return upstream_cassette.describe()
+
+def sse_event(data: Dict[str, Any]) -> str:
+    return f"data: {json.dumps(data)}\n\n"
+
+# Generation pipeline
+class GenerationContext:
+    """State of one generation request as it moves through the pipeline stages"""
+
+    __slots__ = ("adapter", "request", "api_key", "key_id", "model_id", "headers", "payload", "state", "timings")
+
+    def __init__(self, adapter: "ModalityAdapter", request: BaseModel):
+        self.adapter = adapter
+        self.request = request
+        self.api_key: Optional[str] = None
+        self.key_id: Optional[str] = None
+        self.model_id: Optional[str] = None
+        self.headers: Dict[str, str] = {}
+        self.payload: Dict[str, Any] = {}
+        self.state: Dict[str, Any] = {}  # Adapter-specific values shared between build and parse
+        self.timings: Dict[str, float] = {}
+
+class ModalityAdapter:
+    """Translates one modality's requests and responses for the generation pipeline"""
+
+    endpoint = ""  # Scheduler, timeout and usage key
+    path = ""  # Upstream API path
+    label = ""  # Used in log messages
+    network_error_message = "🌐 Network connection failed."
+    similarity_cacheable = False  # Whether near-duplicate prompts may share a cached result
+
+    def build_payload(self, ctx: GenerationContext) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    async def parse_response(self, ctx: GenerationContext, response: aiohttp.ClientResponse) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def streams(self, ctx: GenerationContext) -> bool:
+        return False
+
+    async def stream(self, ctx: GenerationContext):
+        raise NotImplementedError
+
+    def fans_out(self, ctx: GenerationContext) -> bool:
+        """Whether the request needs several upstream calls rather than one"""
+        return False
+
+    async def fan_out(self, ctx: GenerationContext) -> Dict[str, Any]:
+        raise NotImplementedError
+
+class ChatAdapter(ModalityAdapter):
+    endpoint = "chat"
+    path = "/v1/chat/completions"
+    label = "chat"
+    similarity_cacheable = True
+
+    def build_payload(self, ctx: GenerationContext) -> Dict[str, Any]:
+        request = ctx.request
+
+        # Build messages array with conversation history and system prompt
+        messages = []
+        if request.system_prompt:
+            messages.append({"role": "system", "content": request.system_prompt})
+        if request.conversation_history:
+            messages.extend(request.conversation_history)
+        messages.append({"role": "user", "content": request.prompt})
+
+        return {
+            "model": ctx.model_id,
+            "messages": messages,
+            "temperature": request.temperature,
+            "max_tokens": request.max_tokens,
+            "top_p": request.top_p,
+            "frequency_penalty": request.frequency_penalty,
+            "presence_penalty": request.presence_penalty,
+            "stream": request.stream
+        }
+
+    async def parse_response(self, ctx: GenerationContext, response: aiohttp.ClientResponse) -> Dict[str, Any]:
+        request = ctx.request
+        data = await response.json()
+        if "choices" in data and len(data["choices"]) > 0:
+            return {
+                "success": True,
+                "response": data["choices"][0]["message"]["content"],
+                "model": request.model_id,
+                "usage": data.get("usage", {
+                    "prompt_tokens": len(request.prompt.split()),
+                    "completion_tokens": 50,
+                    "total_tokens": len(request.prompt.split()) + 50
+                }),
+                "finish_reason": data["choices"][0].get("finish_reason", "stop")
+            }
+        return {
+            "error": {
+                "type": "no_response",
+                "message": "🤔 No response received from the model.",
+                "suggestion": "Please try again or use a different model.",
+                "action": "retry"
+            }
+        }
+
+    def streams(self, ctx: GenerationContext) -> bool:
+        return bool(ctx.request.stream)
+
+    async def stream(self, ctx: GenerationContext):
+        """Start a streaming chat completion and relay it to the client as server-sent events"""
+        started = time.monotonic()
+        try:
+            response = await upstream_request(
+                http_session(), self.endpoint, ctx.model_id, self.path,
+                headers=ctx.headers,
+                json=ctx.payload
+            )
+        except asyncio.TimeoutError:
+            latency_tracker.observe_timeout(self.endpoint, ctx.model_id, time.monotonic() - started)
+            raise
+
+        if response.status != 200:
+            error_text = await response.text()
+            response.release()
+            error_info = parse_a4f_error(error_text)
+            await key_pool.report(ctx.key_id, error_info["type"])
+            return {"error": error_info, "status_code": response.status}
+
+        await key_pool.report(ctx.key_id)
+        return StreamingResponse(
+            self.relay(ctx, response, usage_context.get(), started, time.monotonic() - started),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    async def relay(self, ctx: GenerationContext, response: aiohttp.ClientResponse,
+                    context: Optional[Dict[str, Any]], started: float, ttfb: float):
+        """Relay upstream SSE chunks as {"delta": ...} events, ending with a summary event"""
+        request = ctx.request
+        completion_words = 0
+        finish_reason = None
+        usage = None
+        try:
+            async for raw_line in response.content:
+                line = raw_line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    continue
+
+                usage = chunk.get("usage") or usage
+                for choice in chunk.get("choices") or []:
+                    delta = (choice.get("delta") or {}).get("content")
+                    if delta:
+                        completion_words += len(delta.split())
+                        yield sse_event({"delta": delta})
+                    finish_reason = choice.get("finish_reason") or finish_reason
+
+            result = {
+                "success": True,
+                "model": request.model_id,
+                "usage": usage or {
+                    "prompt_tokens": len(request.prompt.split()),
+                    "completion_tokens": completion_words,
+                    "total_tokens": len(request.prompt.split()) + completion_words
+                },
+                "finish_reason": finish_reason or "stop"
+            }
+            latency_tracker.observe(self.endpoint, ctx.model_id, ttfb, time.monotonic() - started)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Stream error in chat: {str(e)}")
+            result = {
+                "error": {
+                    "type": "network_error",
+                    "message": "🌐 Connection to the model was lost while streaming.",
+                    "suggestion": "Please try again.",
+                    "action": "retry"
+                }
+            }
+        finally:
+            response.release()
+
+        if context is not None:
+            context["stream_result"] = result
+        yield sse_event({"done": True, **result} if "success" in result else result)
+
+# Image storage
+# Images requested as b64_json are decoded to disk here and served from /api/images
+IMAGE_RESPONSE_FORMAT = os.environ.get('IMAGE_RESPONSE_FORMAT', 'url')  # Default for requests that don't choose: url, b64_json
+IMAGE_STORE_DIR = Path(os.environ.get('IMAGE_STORE_DIR', str(ROOT_DIR / 'image_store')))
+IMAGE_STORE_MAX_BYTES = int(os.environ.get('IMAGE_STORE_MAX_BYTES', str(1024 * 1024 * 1024)))
+IMAGE_PUBLIC_BASE_URL = os.environ.get('IMAGE_PUBLIC_BASE_URL', '').rstrip('/')  # Prefix for stored image URLs
+IMAGE_DECODE_CHUNK = int(os.environ.get('IMAGE_DECODE_CHUNK', str(64 * 1024)))
+# Job workers may run on other machines than the API, so their images go to this GridFS bucket instead
+IMAGE_GRIDFS_BUCKET = os.environ.get('IMAGE_GRIDFS_BUCKET', 'images')
+
+# Leading bytes of the image types providers return, with their extension and media type
+IMAGE_SIGNATURES = (
+    (b"\x89PNG", "png", "image/png"),
+    (b"\xff\xd8\xff", "jpg", "image/jpeg"),
+    (b"GIF8", "gif", "image/gif"),
+    (b"RIFF", "webp", "image/webp"),
+)
+IMAGE_MEDIA_TYPES = {extension: media_type for _, extension, media_type in IMAGE_SIGNATURES}
+IMAGE_NAME_PATTERN = re.compile(r"^[0-9a-f]{32}\.(png|jpg|gif|webp)$")
+
+class _StoredImage:
+    """One base64 string being decoded into a .part file"""
+
+    def __init__(self, store: "ImageStore"):
+        self.id = uuid.uuid4().hex
+        self.store = store
+        self.pending = b""  # Base64 characters not yet decoded (fewer than 4), or a trailing backslash
+        self.head = b""
+        self.file = None
+
+    async def write(self, encoded: bytes):
+        encoded = self.pending + encoded
+        if encoded.endswith(b"\\"):
+            encoded, self.pending = encoded[:-1], b"\\"
+        else:
+            self.pending = b""
+        if b"\\" in encoded:
+            # JSON may escape "/" and wrap base64 with "\n"; neither is part of the data
+            encoded = encoded.replace(b"\\/", b"/").replace(b"\\n", b"").replace(b"\\r", b"")
+        usable = len(encoded) - len(encoded) % 4
+        encoded, self.pending = encoded[:usable], encoded[usable:] + self.pending
+        if not encoded:
+            return
+        decoded = base64.b64decode(encoded, validate=True)
+        if self.file is None:
+            self.head = decoded[:12]
+            self.file = await asyncio.to_thread(self.store.open, self.id)
+        await asyncio.to_thread(self.file.write, decoded)
+
+    async def finish(self) -> str:
+        """Commit the file and return its public URL"""
+        if self.pending.strip(b"="):
+            raise ValueError("Truncated base64 image data")
+        if self.file is None:
+            raise ValueError("Empty base64 image data")
+        name = await asyncio.to_thread(self.store.commit, self.file, self.id, self.head)
+        await self.store.publish(name)
+        return f"{IMAGE_PUBLIC_BASE_URL}/api/images/{name}"
+
+    def discard(self):
+        if self.file is not None:
+            ImageStore.discard(self.file)
+
+class ImageStore:
+    """Generated images on disk, so clients never depend on expiring provider URLs.
+
+    b64_json responses are parsed as they arrive: everything except the
+    base64 strings is kept as a small JSON skeleton, while each string is
+    decoded a chunk at a time into a .part file that is renamed into place
+    once complete. Neither the full base64 text nor the decoded image is
+    ever held in memory. The directory is trimmed oldest-first to
+    IMAGE_STORE_MAX_BYTES.
+    """
+
+    B64_FIELD = re.compile(rb'"b64_json"\s*:\s*"')
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stored = 0
+        self.bytes_written = 0
+
+    def open(self, image_id: str):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        return open(self.directory / f"{image_id}.part", "wb")
+
+    def commit(self, file, image_id: str, head: bytes) -> str:
+        extension = next((ext for signature, ext, _ in IMAGE_SIGNATURES if head.startswith(signature)), "png")
+        self.bytes_written += file.tell()
+        file.close()
+        name = f"{image_id}.{extension}"
+        os.replace(file.name, self.directory / name)
+        self.stored += 1
+        self._trim()
+        return name
+
+    async def publish(self, name: str):
+        """Make a committed image servable by the API; files in this process's directory already are"""
+
+    @staticmethod
+    def discard(file):
+        file.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(file.name)
+
+    def _trim(self):
+        files = sorted((f for f in self.directory.iterdir() if f.suffix != ".part"), key=lambda f: f.stat().st_mtime)
+        total = sum(f.stat().st_size for f in files)
+        for f in files:
+            if total <= self.max_bytes:
+                break
+            total -= f.stat().st_size
+            f.unlink(missing_ok=True)
+
+    def path(self, name: str) -> Optional[Path]:
+        if not IMAGE_NAME_PATTERN.match(name):
+            return None
+        path = self.directory / name
+        return path if path.exists() else None
+
+    async def read_response(self, response: aiohttp.ClientResponse) -> Dict[str, Any]:
+        """Parse an images response, storing each b64_json image and replacing it with its "url"."""
+        skeleton = bytearray()
+        scanned = 0
+        image: Optional[_StoredImage] = None
+        images: List[_StoredImage] = []
+        urls: Dict[str, str] = {}
+        try:
+            async for chunk in response.content.iter_chunked(IMAGE_DECODE_CHUNK):
+                while chunk:
+                    if image is not None:
+                        end = chunk.find(b'"')
+                        await image.write(chunk if end < 0 else chunk[:end])
+                        if end < 0:
+                            break
+                        urls[image.id] = await image.finish()
+                        skeleton += image.id.encode() + b'"'
+                        scanned = len(skeleton)
+                        image, chunk = None, chunk[end + 1:]
+                        continue
+
+                    skeleton += chunk
+                    chunk = b""
+                    # Look back far enough to catch a field name split across chunks
+                    match = self.B64_FIELD.search(skeleton, max(0, scanned - 32))
+                    scanned = len(skeleton)
+                    if match:
+                        chunk = bytes(skeleton[match.end():])
+                        del skeleton[match.end():]
+                        image = _StoredImage(self)
+                        images.append(image)
+            if image is not None:
+                raise ValueError("Image response ended inside base64 data")
+        except BaseException:
+            for pending in images:
+                if pending.id not in urls:
+                    pending.discard()
+            raise
+
+        data = json.loads(bytes(skeleton))
+        for item in data.get("data") or ():
+            image_id = item.pop("b64_json", None)
+            if image_id in urls:
+                item["url"] = urls[image_id]
+        return data
+
+    def describe(self) -> Dict[str, Any]:
+        files = [f for f in self.directory.iterdir() if f.suffix != ".part"] if self.directory.exists() else []
+        return {
+            "directory": str(self.directory),
+            "files": len(files),
+            "bytes": sum(f.stat().st_size for f in files),
+            "max_bytes": self.max_bytes,
+            "stored": self.stored,
+            "bytes_written": self.bytes_written
+        }
+
+def image_bucket() -> AsyncIOMotorGridFSBucket:
+    return AsyncIOMotorGridFSBucket(db, bucket_name=IMAGE_GRIDFS_BUCKET)
+
+class SharedImageStore(ImageStore):
+    """A job worker's image store: committed images move to GridFS, where every API process finds them.
+
+    The local directory only holds images while they are decoded. Images are
+    kept in the bucket as long as finished jobs are (JOB_RETENTION_HOURS);
+    older ones are pruned at most once an hour.
+    """
+
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, directory: Path, max_bytes: int):
+        super().__init__(directory, max_bytes)
+        self._pruned_at = 0.0
+
+    async def publish(self, name: str):
+        path = self.directory / name
+        with open(path, "rb") as f:
+            await image_bucket().upload_from_stream(name, f)
+        path.unlink(missing_ok=True)
+        if time.monotonic() - self._pruned_at > self.PRUNE_INTERVAL:
+            self._pruned_at = time.monotonic()
+            await self.prune()
+
+    async def prune(self) -> int:
+        bucket = image_bucket()
+        cutoff = datetime.fromtimestamp(time.time() - JOB_RETENTION_HOURS * 3600, timezone.utc)
+        pruned = 0
+        try:
+            async for stored in db[f"{IMAGE_GRIDFS_BUCKET}.files"].find({"uploadDate": {"$lt": cutoff}}, {"_id": 1}):
+                await bucket.delete(stored["_id"])
+                pruned += 1
+        except Exception as e:
+            logger.warning(f"Failed to prune stored job images: {str(e)}")
+        return pruned
+
+image_store = ImageStore(IMAGE_STORE_DIR, IMAGE_STORE_MAX_BYTES)
+
+async def _read_grid_out(grid_out):
+    while True:
+        chunk = await grid_out.readchunk()
+        if not chunk:
+            break
+        yield chunk
+
+@api_router.get("/images/{name}")
+async def get_stored_image(name: str):
+    """A generated image from local storage or GridFS; names are random, so it can be cached forever"""
+    headers = {"Cache-Control": "public, max-age=31536000, immutable"}
+    path = image_store.path(name)
+    if path is not None:
+        return FileResponse(path, media_type=IMAGE_MEDIA_TYPES[path.suffix[1:]], headers=headers)
+    if IMAGE_NAME_PATTERN.match(name):
+        # Images generated by job workers
+        try:
+            grid_out = await image_bucket().open_download_stream_by_name(name)
+        except NoFile:
+            grid_out = None
+        if grid_out is not None:
+            return StreamingResponse(
+                _read_grid_out(grid_out),
+                media_type=IMAGE_MEDIA_TYPES[name.rsplit(".", 1)[1]],
+                headers={**headers, "Content-Length": str(grid_out.length)}
+            )
+    raise HTTPException(status_code=404, detail="Image not found")
+
+@api_router.get("/debug/image-store")
+async def get_image_store_status():
+    return await asyncio.to_thread(image_store.describe)
+
+# Multi-image requests
+IMAGE_MAX_N = int(os.environ.get('IMAGE_MAX_N', '8'))
+IMAGE_FANOUT_CONCURRENCY = int(os.environ.get('IMAGE_FANOUT_CONCURRENCY', '4'))
+
+def image_count(request: BaseModel) -> int:
+    """Number of images requested: one per seed when seeds are given, else n"""
+    count = len(request.seeds) if request.seeds else (request.n or 1)
+    return max(1, min(count, IMAGE_MAX_N))
+
+def aspect_ratio_to_size(aspect_ratio: str, base_size: str = "1024x1024") -> str:
+    """Convert aspect ratio to appropriate size"""
+    aspect_ratios = {
+        "1:1": "1024x1024",
+        "16:9": "1792x1024", 
+        "9:16": "1024x1792",
+        "4:3": "1536x1152",
+        "3:4": "1152x1536",
+        "3:2": "1536x1024",
+        "2:3": "1024x1536"
+    }
+    return aspect_ratios.get(aspect_ratio, base_size)
+
+class ImageAdapter(ModalityAdapter):
+    endpoint = "image"
+    path = "/v1/images/generations"
+    label = "image generation"
+    network_error_message = "🌐 Network connection failed during image generation."
+    similarity_cacheable = True
+
+    def __init__(self):
+        # Models found to return fewer images than "n" asked for; these are fanned out
+        self.batch_unsupported: set = set()
+
+    @staticmethod
+    def accepts_seed(model_id: str) -> bool:
+        """Whether the model takes Stable Diffusion parameters such as seed"""
+        return "stable-diffusion" in model_id.lower() or "sd" in model_id.lower()
+
+    def build_payload(self, ctx: GenerationContext) -> Dict[str, Any]:
+        request = ctx.request
+
+        # Convert aspect ratio to size if needed
+        if request.aspect_ratio and request.aspect_ratio != "custom":
+            size = aspect_ratio_to_size(request.aspect_ratio, request.size)
         else:
             size = request.size
-        
-        # Build enhanced prompt with negative prompt if provided
+        ctx.state["size"] = size
+
+        # Build enhanced prompt with negative prompt and style if provided
         enhanced_prompt = request.prompt
         if request.negative_prompt:
             enhanced_prompt = f"{request.prompt} --negative {request.negative_prompt}"
-        
-        # Add style information if provided
         if request.style:
             enhanced_prompt = f"{enhanced_prompt} --style {request.style}"
-        
-        # Make real API call to A4F for image generation
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
+
         payload = {
-            "model": full_model_id,
+            "model": ctx.model_id,
             "prompt": enhanced_prompt,
             "n": 1,
             "size": size,
             "quality": request.quality,
-            "response_format": "url"
+            "response_format": request.response_format or IMAGE_RESPONSE_FORMAT
         }
-        
+
         # Add model-specific parameters if applicable
-        if "stable-diffusion" in full_model_id.lower() or "sd" in full_model_id.lower():
-            # Add Stable Diffusion specific parameters
+        if self.accepts_seed(ctx.model_id):
             payload.update({
                 "cfg_scale": request.cfg_scale,
                 "steps": request.steps,
                 "seed": request.seed
             })
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://api.a4f.co/v1/images/generations", 
-                headers=headers, 
-                json=payload,
-                timeout=aiohttp.ClientTimeout(total=120)  # Longer timeout for image generation
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if "data" in data and len(data["data"]) > 0:
-                        width, height = size.split("x")
-                        return {
-                            "success": True,
-                            "image_url": data["data"][0]["url"],
-                            "model": request.model_id,
-                            "prompt": request.prompt,
-                            "width": int(width),
-                            "height": int(height),
-                            "size": size,
-                            "aspect_ratio": request.aspect_ratio,
-                            "quality": request.quality,
-                            "style": request.style
-                        }
-                    else:
-                        return {
-                            "error": {
-                                "type": "no_image_generated",
-                                "message": "🖼️ No image was generated.",
-                                "suggestion": "Please try again with a different prompt or model.",
-                                "action": "retry"
-                            }
-                        }
-                else:
-                    error_text = await response.text()
-                    error_info = parse_a4f_error(error_text)
-                    return {"error": error_info, "status_code": response.status}
-    
-    except aiohttp.ClientError as e:
-        logger.error(f"Network error in image generation: {str(e)}")
+        return payload
+
+    async def read_images(self, ctx: GenerationContext, response: aiohttp.ClientResponse) -> Dict[str, Any]:
+        if ctx.payload["response_format"] == "b64_json":
+            return await image_store.read_response(response)
+        return await response.json()
+
+    async def parse_response(self, ctx: GenerationContext, response: aiohttp.ClientResponse) -> Dict[str, Any]:
+        data = await self.read_images(ctx, response)
+        url = self.image_url((data.get("data") or [None])[0])
+        if url:
+            return self.summary(ctx, [{"index": 0, "image_url": url, "seed": ctx.request.seed}])
+        return {"error": self.no_image_error()}
+
+    @staticmethod
+    def image_url(item: Any) -> Optional[str]:
+        """URL of one upstream data entry, or None if the provider left it out"""
+        return item.get("url") if isinstance(item, dict) else None
+
+    @staticmethod
+    def no_image_error() -> Dict[str, str]:
+        return {
+            "type": "no_image_generated",
+            "message": "🖼️ No image was generated.",
+            "suggestion": "Please try again with a different prompt or model.",
+            "action": "retry"
+        }
+
+    def summary(self, ctx: GenerationContext, images: List[Dict[str, Any]],
+                errors: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """The response for a finished request; image_url is the first image for older clients"""
+        request = ctx.request
+        size = ctx.state["size"]
+        width, height = size.split("x")
+        images = sorted(images, key=lambda image: image["index"])
+        result = {
+            "success": True,
+            "image_url": images[0]["image_url"],
+            "model": request.model_id,
+            "prompt": request.prompt,
+            "width": int(width),
+            "height": int(height),
+            "size": size,
+            "aspect_ratio": request.aspect_ratio,
+            "quality": request.quality,
+            "style": request.style
+        }
+        if image_count(request) > 1:
+            result["images"] = images
+            if errors:
+                result["errors"] = sorted(errors, key=lambda error: error["index"])
+        return result
+
+    def fans_out(self, ctx: GenerationContext) -> bool:
+        return image_count(ctx.request) > 1
+
+    def jobs(self, ctx: GenerationContext) -> List[tuple]:
+        """Split the request into (indices, seeds, payload) upstream calls.
+
+        Without per-image seeds a model that honours "n" gets a single call;
+        otherwise each image is its own call so they can run concurrently.
+        Seeds are only sent to models that take them, as in build_payload.
+        """
+        request = ctx.request
+        count = image_count(request)
+        if not self.accepts_seed(ctx.model_id):
+            seeds = [None] * count
+        elif request.seeds:
+            seeds = list(request.seeds[:count])
+        elif request.seed is not None:
+            seeds = [request.seed + index for index in range(count)]
+        else:
+            seeds = [None] * count
+
+        if seeds[0] is None and ctx.model_id not in self.batch_unsupported:
+            return [(list(range(count)), seeds, {**ctx.payload, "n": count})]
+        return [([index], [seed], self.seeded(ctx.payload, seed)) for index, seed in enumerate(seeds)]
+
+    @staticmethod
+    def seeded(payload: Dict[str, Any], seed: Optional[int]) -> Dict[str, Any]:
+        payload = {**payload, "n": 1}
+        if seed is not None:
+            payload["seed"] = seed
+        return payload
+
+    @contextlib.asynccontextmanager
+    async def call_slot(self, ctx: GenerationContext):
+        """Scheduler slot for one fanned-out call.
+
+        The slot the request took through @scheduled serves one call at a time.
+        Further calls run concurrently only while the scheduler has a free
+        image slot, and otherwise wait for the request's own slot, so a fan-out
+        stays within the endpoint limit without queueing while holding a slot.
+        """
+        own_slot = ctx.state["own_slot"]
+        if not own_slot.locked() or not upstream_scheduler.try_acquire(self.endpoint, request_priority.get()):
+            async with own_slot:
+                yield
+        else:
+            try:
+                yield
+            finally:
+                upstream_scheduler.release(self.endpoint)
+
+    async def call(self, ctx: GenerationContext, indices: List[int], seeds: List[Optional[int]],
+                   payload: Dict[str, Any], emit):
+        """Make one upstream call and emit an image or error entry for each index it covers"""
+        try:
+            async with ctx.state["fan_out"], self.call_slot(ctx), upstream_post(
+                http_session(), self.endpoint, ctx.model_id,
+                self.path,
+                headers=ctx.headers,
+                json=payload
+            ) as response:
+                if response.status != 200:
+                    error_info = parse_a4f_error(await response.text())
+                    await key_pool.report(ctx.key_id, error_info["type"])
+                    for index in indices:
+                        emit({"index": index, "error": error_info, "status_code": response.status})
+                    return
+                await key_pool.report(ctx.key_id)
+                data = (await self.read_images(ctx, response)).get("data") or []
+        except asyncio.TimeoutError:
+            logger.error(f"Timeout in {self.label}")
+            for index in indices:
+                emit({"index": index, "error": {
+                    "type": "timeout",
+                    "message": "⏱️ The model took too long to respond.",
+                    "suggestion": "Please try again or use a faster model.",
+                    "action": "retry"
+                }})
+            return
+        except aiohttp.ClientError as e:
+            logger.error(f"Network error in {self.label}: {str(e)}")
+            for index in indices:
+                emit({"index": index, "error": {
+                    "type": "network_error",
+                    "message": self.network_error_message,
+                    "suggestion": "Please check your internet connection and try again.",
+                    "action": "check_connection"
+                }})
+            return
+        except ValueError as e:
+            # Malformed JSON or base64 in the response
+            logger.error(f"Invalid response in {self.label}: {str(e)}")
+            for index in indices:
+                emit({"index": index, "error": self.no_image_error()})
+            return
+        except RequestRejected as e:
+            # e.g. the deadline passed while the call waited for a fan-out slot
+            for index in indices:
+                emit({"index": index, "error": e.payload["error"], "status_code": e.status_code})
+            return
+        except Exception as e:
+            # as_completed waits for an entry per index, so every failure must emit one
+            logger.error(f"Error in {self.label}: {str(e)}")
+            for index in indices:
+                emit({"index": index, "error": {
+                    "type": "unexpected_error",
+                    "message": f"⚠️ Unexpected error occurred: {str(e)[:100]}",
+                    "suggestion": "Please try again or contact support if the issue persists.",
+                    "action": "retry"
+                }})
+            return
+
+        for index, seed, item in zip(indices, seeds, data):
+            url = self.image_url(item)
+            emit({"index": index, "image_url": url, "seed": seed} if url else {"index": index, "error": self.no_image_error()})
+
+        # The model ignored "n": remember that and fan out whatever is missing
+        missing = list(zip(indices, seeds))[len(data):]
+        if missing and len(indices) > 1:
+            self.batch_unsupported.add(ctx.model_id)
+            await asyncio.gather(*(
+                self.call(ctx, [index], [seed], self.seeded(payload, seed), emit)
+                for index, seed in missing
+            ))
+        else:
+            for index, _ in missing:
+                emit({"index": index, "error": self.no_image_error()})
+
+    async def as_completed(self, ctx: GenerationContext):
+        """Yield image and error entries in the order the upstream calls finish"""
+        queue: asyncio.Queue = asyncio.Queue()
+        ctx.state["fan_out"] = asyncio.Semaphore(IMAGE_FANOUT_CONCURRENCY)
+        ctx.state["own_slot"] = asyncio.Lock()
+        tasks = [asyncio.create_task(self.call(ctx, *job, queue.put_nowait)) for job in self.jobs(ctx)]
+        try:
+            for _ in range(image_count(ctx.request)):
+                yield await queue.get()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def fan_out(self, ctx: GenerationContext) -> Dict[str, Any]:
+        images, errors = [], []
+        async for entry in self.as_completed(ctx):
+            (errors if "error" in entry else images).append(entry)
+        if not images:
+            first = min(errors, key=lambda error: error["index"])
+            return {"error": first["error"], "status_code": first.get("status_code", 500)}
+        return self.summary(ctx, images, errors)
+
+    def streams(self, ctx: GenerationContext) -> bool:
+        return bool(ctx.request.stream)
+
+    async def stream(self, ctx: GenerationContext):
+        """Send each image to the client as soon as it is ready, as SSE or NDJSON"""
+        ndjson = ctx.request.stream_format == "ndjson"
+        return StreamingResponse(
+            self.relay(ctx, usage_context.get(), ndjson),
+            media_type="application/x-ndjson" if ndjson else "text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    async def relay(self, ctx: GenerationContext, context: Optional[Dict[str, Any]], ndjson: bool):
+        encode = (lambda data: json.dumps(data) + "\n") if ndjson else sse_event
+        images, errors = [], []
+        async for entry in self.as_completed(ctx):
+            (errors if "error" in entry else images).append(entry)
+            yield encode(entry)
+
+        if images:
+            result = self.summary(ctx, images, errors)
+        else:
+            result = {"error": min(errors, key=lambda error: error["index"])["error"]}
+        if context is not None:
+            context["stream_result"] = result
+        yield encode({"done": True, **result} if "success" in result else result)
+
+# Audio streaming cache
+AUDIO_CACHE_DIR = Path(os.environ.get('AUDIO_CACHE_DIR', str(ROOT_DIR / 'audio_cache')))
+AUDIO_CACHE_MAX_BYTES = int(os.environ.get('AUDIO_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+AUDIO_CHUNK_SIZE = int(os.environ.get('AUDIO_CHUNK_SIZE', str(16 * 1024)))
+
+AUDIO_MEDIA_TYPES = {
+    "mp3": "audio/mpeg",
+    "wav": "audio/wav",
+    "flac": "audio/flac",
+    "opus": "audio/ogg",
+    "aac": "audio/aac",
+    "pcm": "audio/pcm"
+}
+
+class AudioCache:
+    """Finished TTS audio on disk, keyed by everything that determines the output.
+
+    Files are written to a .part file while the audio streams to the client
+    and only renamed into place once the upstream response completed, so a
+    disconnect or upstream error never leaves a truncated entry. The directory
+    is trimmed oldest-first to AUDIO_CACHE_MAX_BYTES.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(request: BaseModel) -> str:
+        params = request.model_dump(include={"model_id", "prompt", "voice", "speed", "format", "language"})
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key: str, audio_format: str) -> Path:
+        return self.directory / f"{key}.{audio_format}"
+
+    def lookup(self, request: BaseModel) -> Optional[Path]:
+        path = self.path(self.key(request), request.format)
+        if path.exists():
+            self.hits += 1
+            return path
+        self.misses += 1
+        return None
+
+    def _open(self, path: Path):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Unique per writer: identical requests may stream concurrently, and the last rename wins
+        return open(self.directory / f"{path.stem}.{uuid.uuid4().hex}.part", "wb")
+
+    def _commit(self, file, path: Path):
+        file.close()
+        os.replace(file.name, path)
+        self._trim()
+
+    @staticmethod
+    def _discard(file):
+        file.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(file.name)
+
+    def _trim(self):
+        entries = []
+        for f in self.directory.iterdir():
+            if f.suffix == ".part":
+                continue
+            # A concurrent trim may remove files between listing and stat
+            with contextlib.suppress(FileNotFoundError):
+                stat = f.stat()
+                entries.append((stat.st_mtime, stat.st_size, f))
+        entries.sort(key=lambda entry: entry[0])
+        total = sum(size for _, size, _ in entries)
+        for _, size, f in entries:
+            if total <= self.max_bytes:
+                break
+            total -= size
+            f.unlink(missing_ok=True)
+
+    async def tee(self, chunks, path: Path):
+        """Pass chunks through while writing them to the cache entry for path"""
+        file = await asyncio.to_thread(self._open, path)
+        try:
+            async for chunk in chunks:
+                await asyncio.to_thread(file.write, chunk)
+                yield chunk
+        except BaseException:
+            await asyncio.to_thread(self._discard, file)
+            raise
+        await asyncio.to_thread(self._commit, file, path)
+
+    @staticmethod
+    async def read(path: Path):
+        with open(path, "rb") as f:
+            while chunk := await asyncio.to_thread(f.read, AUDIO_CHUNK_SIZE):
+                yield chunk
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES)
+
+class AudioAdapter(ModalityAdapter):
+    endpoint = "audio"
+    path = "/v1/audio/speech"
+    label = "audio generation"
+    network_error_message = "🌐 Network connection failed during audio generation."
+
+    def build_payload(self, ctx: GenerationContext) -> Dict[str, Any]:
+        request = ctx.request
+        payload = {
+            "model": ctx.model_id,
+            "input": request.prompt,
+            "voice": request.voice,
+            "speed": request.speed,
+            "response_format": request.format
+        }
+        if request.language:
+            payload["language"] = request.language
+        return payload
+
+    async def parse_response(self, ctx: GenerationContext, response: aiohttp.ClientResponse) -> Dict[str, Any]:
+        request = ctx.request
+
+        # For audio, the response might be binary or a URL
+        content_type = response.headers.get('content-type', '')
+        if 'application/json' in content_type:
+            data = await response.json()
+            return {
+                "success": True,
+                "audio_url": data.get("url") or data.get("audio_url"),
+                "model": request.model_id,
+                "voice": request.voice,
+                "format": request.format,
+                "duration": data.get("duration"),
+            }
+
+        # Binary audio response - would need to save and return URL
+        return {
+            "error": {
+                "type": "response_format_error",
+                "message": "🎵 Audio response format not supported.",
+                "suggestion": "Use stream mode, or try a different audio model that returns URL responses.",
+                "action": "switch_model"
+            }
+        }
+
+    def streams(self, ctx: GenerationContext) -> bool:
+        return bool(ctx.request.stream)
+
+    async def stream(self, ctx: GenerationContext):
+        """Pipe upstream audio to the client as it arrives, teeing it into the audio cache.
+
+        Each chunk is read from upstream only after the previous one was handed
+        to the client, so a slow client slows the upstream read rather than
+        growing a buffer here.
+        """
+        request = ctx.request
+        started = time.monotonic()
+        try:
+            response = await upstream_request(
+                http_session(), self.endpoint, ctx.model_id, self.path,
+                headers=ctx.headers,
+                json=ctx.payload
+            )
+        except asyncio.TimeoutError:
+            latency_tracker.observe_timeout(self.endpoint, ctx.model_id, time.monotonic() - started)
+            raise
+
+        if response.status != 200:
+            error_text = await response.text()
+            response.release()
+            error_info = parse_a4f_error(error_text)
+            await key_pool.report(ctx.key_id, error_info["type"])
+            return {"error": error_info, "status_code": response.status}
+
+        await key_pool.report(ctx.key_id)
+        content_type = response.headers.get('content-type', '')
+        if 'application/json' in content_type:
+            try:
+                return await self.parse_response(ctx, response)
+            finally:
+                response.release()
+
+        path = audio_cache.path(audio_cache.key(request), request.format)
+        return StreamingResponse(
+            self.relay(ctx, response, usage_context.get(), started, time.monotonic() - started, path),
+            media_type=content_type or AUDIO_MEDIA_TYPES.get(request.format, "application/octet-stream"),
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Audio-Cache": "miss"}
+        )
+
+    async def relay(self, ctx: GenerationContext, response: aiohttp.ClientResponse,
+                    context: Optional[Dict[str, Any]], started: float, ttfb: float, path: Path):
+        size = 0
+        try:
+            async for chunk in audio_cache.tee(response.content.iter_chunked(AUDIO_CHUNK_SIZE), path):
+                size += len(chunk)
+                yield chunk
+            latency_tracker.observe(self.endpoint, ctx.model_id, ttfb, time.monotonic() - started)
+            result = self.stream_summary(ctx, size)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Headers are already sent, so the client sees a truncated body
+            logger.error(f"Stream error in audio generation: {str(e)}")
+            result = {"error": {"type": "network_error"}}
+        finally:
+            response.release()
+        if context is not None:
+            context["stream_result"] = result
+
+    def stream_summary(self, ctx: GenerationContext, size: int, cached: bool = False) -> Dict[str, Any]:
+        request = ctx.request
+        result = {
+            "success": True,
+            "model": request.model_id,
+            "voice": request.voice,
+            "format": request.format,
+            "bytes": size
+        }
+        if cached:
+            result["cached"] = True
+        return result
+
+    async def replay(self, ctx: GenerationContext, path: Path, context: Optional[Dict[str, Any]]):
+        size = 0
+        async for chunk in audio_cache.read(path):
+            size += len(chunk)
+            yield chunk
+        if context is not None:
+            context["stream_result"] = self.stream_summary(ctx, size, cached=True)
+
+class VideoAdapter(ModalityAdapter):
+    endpoint = "video"
+    path = "/v1/videos/generations"
+    label = "video generation"
+    network_error_message = "🌐 Network connection failed during video generation."
+
+    def build_payload(self, ctx: GenerationContext) -> Dict[str, Any]:
+        request = ctx.request
+
+        # Convert aspect ratio to resolution if needed
+        if request.aspect_ratio:
+            aspect_ratios = {
+                "16:9": "1920x1080",
+                "9:16": "1080x1920",
+                "1:1": "1024x1024",
+                "4:3": "1024x768"
+            }
+            resolution = aspect_ratios.get(request.aspect_ratio, request.resolution)
+        else:
+            resolution = request.resolution
+        ctx.state["resolution"] = resolution
+
+        payload = {
+            "model": ctx.model_id,
+            "prompt": request.prompt,
+            "size": resolution,
+            "duration": request.duration,
+        }
+        if request.fps:
+            payload["fps"] = request.fps
+        if request.style:
+            payload["style"] = request.style
+        return payload
+
+    async def parse_response(self, ctx: GenerationContext, response: aiohttp.ClientResponse) -> Dict[str, Any]:
+        request = ctx.request
+        data = await response.json()
+
+        # Check if response has the video URL or generation ID
+        if "data" in data and len(data["data"]) > 0:
+            video_data = data["data"][0]
+            return {
+                "success": True,
+                "video_url": video_data.get("url") or video_data.get("video_url"),
+                "thumbnail_url": video_data.get("thumbnail"),
+                "model": request.model_id,
+                "resolution": ctx.state["resolution"],
+                "duration": request.duration,
+                "fps": request.fps,
+            }
+        return {
+            "success": True,
+            "video_url": data.get("url") or data.get("video_url"),
+            "model": request.model_id,
+            "resolution": ctx.state["resolution"],
+            "duration": request.duration,
+        }
+
+chat_adapter = ChatAdapter()
+image_adapter = ImageAdapter()
+audio_adapter = AudioAdapter()
+video_adapter = VideoAdapter()
+
+async def audio_replay_stage(ctx: GenerationContext):
+    """Serve streamed audio from the local cache without a key or upstream call"""
+    if ctx.adapter is not audio_adapter or not ctx.adapter.streams(ctx):
+        return None
+    path = audio_cache.lookup(ctx.request)
+    if path is None:
+        return None
+    return StreamingResponse(
+        audio_adapter.replay(ctx, path, usage_context.get()),
+        media_type=AUDIO_MEDIA_TYPES.get(ctx.request.format, "application/octet-stream"),
+        headers={"Content-Length": str(path.stat().st_size), "X-Audio-Cache": "hit"}
+    )
+
+async def resolve_key_stage(ctx: GenerationContext):
+    """Get API key from the chat session, the request or the stored key pool"""
+    ctx.api_key, ctx.key_id = session_api_key.get() or await resolve_api_key(ctx.request.api_key)
+    if not ctx.api_key:
+        return await missing_api_key_error()
+
+async def resolve_model_stage(ctx: GenerationContext):
+    """Get the full model ID with provider prefix"""
+    ctx.model_id = await get_full_model_id(ctx.request.model_id, ctx.request.provider_id)
+    annotate_usage(provider=ctx.model_id, key_id=ctx.key_id)
+
+async def build_request_stage(ctx: GenerationContext):
+    ctx.headers = {
+        "Authorization": f"Bearer {ctx.api_key}",
+        "Content-Type": "application/json"
+    }
+    ctx.payload = ctx.adapter.build_payload(ctx)
+
+async def upstream_stage(ctx: GenerationContext):
+    """Call the A4F API and translate its response"""
+    adapter = ctx.adapter
+    if adapter.streams(ctx):
+        return await adapter.stream(ctx)
+    if adapter.fans_out(ctx):
+        return await adapter.fan_out(ctx)
+
+    async with upstream_post(
+        http_session(), adapter.endpoint, ctx.model_id,
+        adapter.path,
+        headers=ctx.headers,
+        json=ctx.payload
+    ) as response:
+        if response.status == 200:
+            await key_pool.report(ctx.key_id)
+            return await adapter.parse_response(ctx, response)
+
+        error_text = await response.text()
+        error_info = parse_a4f_error(error_text)
+        await key_pool.report(ctx.key_id, error_info["type"])
+        return {"error": error_info, "status_code": response.status}
+
+class PipelineStats:
+    """Per-endpoint timing of each pipeline stage"""
+
+    def __init__(self):
+        self.stages: Dict[tuple, Dict[str, float]] = {}
+
+    def observe(self, endpoint: str, stage: str, seconds: float):
+        stats = self.stages.setdefault((endpoint, stage), {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        ms = seconds * 1000
+        stats["count"] += 1
+        stats["total_ms"] += ms
+        stats["max_ms"] = max(stats["max_ms"], ms)
+
+    def describe(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        breakdown: Dict[str, Dict[str, Dict[str, float]]] = {}
+        for (endpoint, stage), stats in self.stages.items():
+            breakdown.setdefault(endpoint, {})[stage] = {
+                "count": stats["count"],
+                "avg_ms": round(stats["total_ms"] / stats["count"], 2),
+                "max_ms": round(stats["max_ms"], 2)
+            }
+        return breakdown
+
+pipeline_stats = PipelineStats()
+
+class GenerationPipeline:
+    """Ordered, named stages shared by every generation endpoint.
+
+    Each stage receives the GenerationContext; the first stage that returns a
+    value ends the pipeline with that response, which is then passed to the
+    result hooks. Cross-cutting features are added once with insert_before,
+    insert_after or add_result_hook and then apply to every modality.
+    """
+
+    def __init__(self, stages: List[tuple]):
+        self.stages = list(stages)
+        self.result_hooks: List[Any] = []
+
+    def _index(self, name: str) -> int:
+        for index, (stage_name, _) in enumerate(self.stages):
+            if stage_name == name:
+                return index
+        raise KeyError(name)
+
+    def insert_before(self, name: str, stage_name: str, stage):
+        self.stages.insert(self._index(name), (stage_name, stage))
+
+    def insert_after(self, name: str, stage_name: str, stage):
+        self.stages.insert(self._index(name) + 1, (stage_name, stage))
+
+    def add_result_hook(self, hook):
+        """Register hook(ctx, result), called with every response the stages produce"""
+        self.result_hooks.append(hook)
+
+    async def run(self, adapter: ModalityAdapter, request: BaseModel):
+        ctx = GenerationContext(adapter, request)
+        try:
+            for name, stage in self.stages:
+                started = time.monotonic()
+                try:
+                    result = await stage(ctx)
+                finally:
+                    ctx.timings[name] = time.monotonic() - started
+                    pipeline_stats.observe(adapter.endpoint, name, ctx.timings[name])
+                if result is not None:
+                    for hook in self.result_hooks:
+                        hook(ctx, result)
+                    return result
+            raise RuntimeError("Generation pipeline produced no response")
+
+        except RequestRejected:
+            raise
+        except asyncio.TimeoutError:
+            logger.error(f"Timeout in {adapter.label}")
+            return {
+                "error": {
+                    "type": "timeout",
+                    "message": "⏱️ The model took too long to respond.",
+                    "suggestion": "Please try again or use a faster model.",
+                    "action": "retry"
+                }
+            }
+        except aiohttp.ClientError as e:
+            logger.error(f"Network error in {adapter.label}: {str(e)}")
+            return {
+                "error": {
+                    "type": "network_error",
+                    "message": adapter.network_error_message,
+                    "suggestion": "Please check your internet connection and try again.",
+                    "action": "check_connection"
+                }
+            }
+        except Exception as e:
+            logger.error(f"Error in {adapter.label}: {str(e)}")
+            return {
+                "error": {
+                    "type": "unexpected_error",
+                    "message": f"⚠️ Unexpected error occurred: {str(e)[:100]}",
+                    "suggestion": "Please try again or contact support if the issue persists.",
+                    "action": "retry"
+                }
+            }
+
+generation_pipeline = GenerationPipeline([
+    ("resolve_key", resolve_key_stage),
+    ("resolve_model", resolve_model_stage),
+    ("build_request", build_request_stage),
+    ("upstream", upstream_stage),
+])
+generation_pipeline.insert_before("resolve_key", "audio_replay", audio_replay_stage)
+
+# Near-duplicate prompt cache
+SIMILARITY_CACHE_ENABLED = os.environ.get('SIMILARITY_CACHE', 'false').lower() == 'true'
+SIMILARITY_THRESHOLD = float(os.environ.get('SIMILARITY_THRESHOLD', '0.92'))
+SIMILARITY_DIMENSIONS = int(os.environ.get('SIMILARITY_DIMENSIONS', '1024'))
+SIMILARITY_NGRAM = int(os.environ.get('SIMILARITY_NGRAM', '3'))
+SIMILARITY_BUCKET_CAPACITY = int(os.environ.get('SIMILARITY_BUCKET_CAPACITY', '256'))
+SIMILARITY_MAX_ENTRIES = int(os.environ.get('SIMILARITY_MAX_ENTRIES', '4096'))
+SIMILARITY_MAX_BYTES = int(os.environ.get('SIMILARITY_MAX_BYTES', str(64 * 1024 * 1024)))  # Bucket matrices, across buckets
+SIMILARITY_TTL = float(os.environ.get('SIMILARITY_TTL', '3600'))  # Image URLs expire upstream
+
+# Request fields that do not change the generated result. The API key is kept: results are
+# only shared between requests made with the same key (or both with the server's key).
+SIMILARITY_IGNORED_FIELDS = {"prompt", "stream", "similarity_cache"}
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_prompt(prompt: str) -> str:
+    """Lowercase, drop punctuation and collapse whitespace"""
+    return _WHITESPACE.sub(" ", _PUNCTUATION.sub(" ", prompt.lower())).strip()
+
+class _SimilarityBucket:
+    """Cached prompts for one model and parameter set, as rows of a float32 matrix"""
+
+    __slots__ = ("vectors", "results", "prompts", "last_used", "stored_at", "size")
+
+    def __init__(self, dimensions: int):
+        # Most buckets only ever see one prompt; rows double as needed up to the capacity
+        rows = 1
+        self.vectors = np.zeros((rows, dimensions), dtype=np.float32)
+        self.results: List[Optional[Dict[str, Any]]] = [None] * rows
+        self.prompts: List[Optional[str]] = [None] * rows
+        self.last_used = np.zeros(rows, dtype=np.float64)
+        self.stored_at = np.zeros(rows, dtype=np.float64)
+        self.size = 0
+
+    def _grow(self, capacity: int):
+        rows = min(len(self.results) * 2, capacity)
+        extra = rows - len(self.results)
+        self.vectors = np.vstack([self.vectors, np.zeros((extra, self.vectors.shape[1]), dtype=np.float32)])
+        self.results.extend([None] * extra)
+        self.prompts.extend([None] * extra)
+        self.last_used = np.concatenate([self.last_used, np.zeros(extra)])
+        self.stored_at = np.concatenate([self.stored_at, np.zeros(extra)])
+
+    def best(self, vector: np.ndarray) -> tuple:
+        """Row index and cosine similarity of the closest cached prompt"""
+        scores = self.vectors[:self.size] @ vector
+        index = int(np.argmax(scores))
+        return index, float(scores[index])
+
+    def add(self, vector: np.ndarray, prompt: str, result: Dict[str, Any], capacity: int, now: float) -> bool:
+        """Store a row; returns True if a new row was used rather than an old one evicted"""
+        if self.size == len(self.results) and self.size < capacity:
+            self._grow(capacity)
+        if self.size < len(self.results):
+            index = self.size
+            self.size += 1
+            grew = True
+        else:
+            index = int(np.argmin(self.last_used[:self.size]))
+            grew = False
+        self.vectors[index] = vector
+        self.prompts[index] = prompt
+        self.results[index] = result
+        self.last_used[index] = now
+        self.stored_at[index] = now
+        return grew
+
+    def remove(self, index: int):
+        """Remove a row by moving the last row into its place"""
+        last = self.size - 1
+        if index != last:
+            self.vectors[index] = self.vectors[last]
+            self.prompts[index] = self.prompts[last]
+            self.results[index] = self.results[last]
+            self.last_used[index] = self.last_used[last]
+            self.stored_at[index] = self.stored_at[last]
+        self.prompts[last] = None
+        self.results[last] = None
+        self.size = last
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes + self.last_used.nbytes + self.stored_at.nbytes
+
+class SimilarityCache:
+    """Near-duplicate cache keyed on hashed character n-gram vectors of the prompt.
+
+    Prompts are normalized and turned into L2-normalized count vectors of
+    hashed character n-grams. Entries are bucketed per endpoint, model and
+    non-prompt parameters (including the API key and conversation history,
+    hashed), and a lookup is one matrix-vector product over the bucket
+    followed by argmax. Rows are evicted LRU from the least recently used
+    buckets once SIMILARITY_MAX_ENTRIES rows are cached, whole buckets once
+    their matrices take more than SIMILARITY_MAX_BYTES, and rows within a
+    full bucket LRU as well.
+    """
+
+    def __init__(self, threshold: float, dimensions: int, ngram: int, bucket_capacity: int, max_entries: int, ttl: float,
+                 max_bytes: int = SIMILARITY_MAX_BYTES):
+        self.threshold = threshold
+        self.dimensions = dimensions
+        self.ngram = ngram
+        self.bucket_capacity = bucket_capacity
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = 0
+        self.nbytes = 0
+        self.buckets: "OrderedDict[tuple, _SimilarityBucket]" = OrderedDict()
+        self.stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"hits": 0, "misses": 0, "stores": 0})
+        self.recent_scores: deque = deque(maxlen=200)
+
+    def embed(self, prompt: str) -> np.ndarray:
+        padded = f" {normalize_prompt(prompt)} "
+        n = self.ngram
+        grams = [padded[i:i + n] for i in range(max(len(padded) - n + 1, 1))]
+        indices = np.fromiter((zlib.crc32(gram.encode()) for gram in grams), dtype=np.uint32, count=len(grams))
+        vector = np.bincount(indices % self.dimensions, minlength=self.dimensions).astype(np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def bucket_key(endpoint: str, request: BaseModel) -> tuple:
+        params = request.model_dump(exclude=SIMILARITY_IGNORED_FIELDS)
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).digest()
+        return endpoint, request.model_id, digest
+
+    def _drop_bucket(self, key: tuple):
+        bucket = self.buckets.pop(key)
+        self.entries -= bucket.size
+        self.nbytes -= bucket.nbytes
+
+    def lookup(self, endpoint: str, request: BaseModel) -> Optional[Dict[str, Any]]:
+        stats = self.stats[endpoint]
+        key = self.bucket_key(endpoint, request)
+        bucket = self.buckets.get(key)
+        if bucket is None or bucket.size == 0:
+            stats["misses"] += 1
+            return None
+
+        now = time.time()
+        index, score = bucket.best(self.embed(request.prompt))
+        self.recent_scores.append(round(score, 4))
+        if score < self.threshold:
+            stats["misses"] += 1
+            return None
+        if now - bucket.stored_at[index] > self.ttl:
+            bucket.remove(index)
+            self.entries -= 1
+            if bucket.size == 0:
+                self._drop_bucket(key)
+            stats["misses"] += 1
+            return None
+
+        bucket.last_used[index] = now
+        self.buckets.move_to_end(key)
+        stats["hits"] += 1
+        return {
+            **bucket.results[index],
+            "cached": True,
+            "similarity": round(score, 4),
+            "cached_prompt": bucket.prompts[index]
+        }
+
+    def store(self, endpoint: str, request: BaseModel, result: Dict[str, Any]):
+        key = self.bucket_key(endpoint, request)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = _SimilarityBucket(self.dimensions)
+        else:
+            self.nbytes -= bucket.nbytes
+        self.buckets.move_to_end(key)
+
+        if bucket.add(self.embed(request.prompt), request.prompt, result, self.bucket_capacity, time.time()):
+            self.entries += 1
+        self.nbytes += bucket.nbytes
+        self.stats[endpoint]["stores"] += 1
+
+        # Evict from the least recently used buckets until within bounds
+        while self.entries > self.max_entries:
+            oldest_key, oldest = next(iter(self.buckets.items()))
+            if oldest.size:
+                oldest.remove(int(np.argmin(oldest.last_used[:oldest.size])))
+                self.entries -= 1
+            if oldest.size == 0:
+                self._drop_bucket(oldest_key)
+        # Removing rows doesn't shrink a bucket's matrix, so the byte cap drops whole buckets
+        while self.nbytes > self.max_bytes and self.buckets:
+            self._drop_bucket(next(iter(self.buckets)))
+
+    def describe(self) -> Dict[str, Any]:
+        endpoints = {}
+        for endpoint, stats in self.stats.items():
+            lookups = stats["hits"] + stats["misses"]
+            endpoints[endpoint] = {**stats, "hit_rate": round(stats["hits"] / lookups, 4) if lookups else 0.0}
+        scores = np.array(self.recent_scores, dtype=np.float32)
+        return {
+            "enabled": SIMILARITY_CACHE_ENABLED,
+            "threshold": self.threshold,
+            "entries": self.entries,
+            "max_entries": self.max_entries,
+            "buckets": len(self.buckets),
+            "memory_bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "endpoints": endpoints,
+            "recent_scores": {
+                "count": int(scores.size),
+                "mean": round(float(scores.mean()), 4) if scores.size else None,
+                "p50": round(float(np.percentile(scores, 50)), 4) if scores.size else None,
+                "p90": round(float(np.percentile(scores, 90)), 4) if scores.size else None,
+                "above_threshold": int((scores >= self.threshold).sum())
+            }
+        }
+
+similarity_cache = SimilarityCache(
+    SIMILARITY_THRESHOLD, SIMILARITY_DIMENSIONS, SIMILARITY_NGRAM,
+    SIMILARITY_BUCKET_CAPACITY, SIMILARITY_MAX_ENTRIES, SIMILARITY_TTL
+)
+
+def similarity_cache_applies(ctx: GenerationContext) -> bool:
+    if not ctx.adapter.similarity_cacheable or ctx.adapter.streams(ctx):
+        return False
+    enabled = getattr(ctx.request, "similarity_cache", None)
+    return SIMILARITY_CACHE_ENABLED if enabled is None else enabled
+
+async def similarity_lookup_stage(ctx: GenerationContext):
+    """Answer from the near-duplicate cache before any key or upstream work"""
+    if similarity_cache_applies(ctx):
+        return similarity_cache.lookup(ctx.adapter.endpoint, ctx.request)
+
+def similarity_store_hook(ctx: GenerationContext, result: Any):
+    if isinstance(result, dict) and result.get("success") and not result.get("cached") and similarity_cache_applies(ctx):
+        similarity_cache.store(ctx.adapter.endpoint, ctx.request, result)
+
+generation_pipeline.insert_before("resolve_key", "similarity_lookup", similarity_lookup_stage)
+generation_pipeline.add_result_hook(similarity_store_hook)
+
+@api_router.get("/cache/similarity")
+async def get_similarity_cache_stats():
+    """Near-duplicate cache hit rates, recent similarity scores and memory use"""
+    return similarity_cache.describe()
+
+@api_router.get("/debug/pipeline")
+async def get_pipeline_timings():
+    """Stage-level timing breakdown of the generation pipeline per endpoint"""
+    return {
+        "stages": [name for name, _ in generation_pipeline.stages],
+        "timings": pipeline_stats.describe()
+    }
+
+@api_router.post("/chat")
+@resumable
+@cancellable
+@track_usage("chat")
+@scheduled("chat")
+async def chat_with_model(request: TextModelRequest):
+    """Chat with a text model with enhanced options"""
+    return await generation_pipeline.run(chat_adapter, request)
+
+@api_router.post("/generate-image")
+@cancellable
+@track_usage("image")
+@scheduled("image")
+async def generate_image(request: ImageModelRequest):
+    """Generate image with enhanced options"""
+    return await generation_pipeline.run(image_adapter, request)
+
+@api_router.post("/generate-audio")
+@cancellable
+@track_usage("audio")
+@scheduled("audio")
+async def generate_audio(request: AudioModelRequest):
+    """Generate audio with enhanced options"""
+    return await generation_pipeline.run(audio_adapter, request)
+
+@api_router.post("/generate-video")
+@cancellable
+@track_usage("video")
+@scheduled("video")
+async def generate_video(request: VideoModelRequest):
+    """Generate video with enhanced options"""
+    return await generation_pipeline.run(video_adapter, request)
+
+# Model health
+MODEL_PROBE_ENABLED = os.environ.get('MODEL_PROBE', 'false').lower() == 'true'
+MODEL_PROBE_RATE = float(os.environ.get('MODEL_PROBE_RATE', '6'))  # Synthetic requests per minute, across all models
+MODEL_PROBE_INTERVAL = float(os.environ.get('MODEL_PROBE_INTERVAL', '900'))  # Minimum seconds between probes of one provider
+# Only chat is probed by default: a 1-token completion is cheap, generating media is not
+MODEL_PROBE_CATEGORIES = set(os.environ.get('MODEL_PROBE_CATEGORIES', 'text').split(','))
+MODEL_HEALTH_WINDOW = int(os.environ.get('MODEL_HEALTH_WINDOW', '10'))
+MODEL_HEALTH_TTL = float(os.environ.get('MODEL_HEALTH_TTL', '3600'))  # Outcomes older than this are forgotten
+MODEL_HEALTH_PUBLISH_INTERVAL = float(os.environ.get('MODEL_HEALTH_PUBLISH_INTERVAL', '15'))
+MODEL_TRAFFIC_HALF_LIFE = float(os.environ.get('MODEL_TRAFFIC_HALF_LIFE', '1800'))
+
+# Error types that say something about the model rather than the key, plan or request
+MODEL_FAILURE_TYPES = {
+    "model_not_found", "model_unavailable", "server_error", "timeout", "network_error",
+    "no_response", "no_image_generated", "unknown_error"
+}
+
+class _ProviderHealth:
+    __slots__ = ("outcomes", "latencies", "last_probe")
+
+    def __init__(self):
+        self.outcomes: deque = deque(maxlen=MODEL_HEALTH_WINDOW)  # (timestamp, ok, error type)
+        self.latencies: deque = deque(maxlen=50)
+        self.last_probe = 0.0
+
+    def status(self, now: float) -> str:
+        recent = [outcome for outcome in self.outcomes if now - outcome[0] < MODEL_HEALTH_TTL]
+        if not recent:
+            return "unknown"
+        if len(recent) >= 2 and not recent[-1][1] and not recent[-2][1]:
+            return "down"
+        if recent[-1][2] == "model_not_found":
+            return "down"
+        successes = sum(1 for outcome in recent if outcome[1])
+        return "healthy" if successes / len(recent) >= 0.8 else "degraded"
+
+    def p50_ms(self) -> Optional[float]:
+        if not self.latencies:
+            return None
+        return round(sorted(self.latencies)[len(self.latencies) // 2] * 1000, 1)
+
+class ModelHealthMonitor:
+    """Availability and latency per model provider, from real traffic and synthetic probes.
+
+    Every generation result is observed through a pipeline result hook. When
+    MODEL_PROBE is enabled, a background task also sends a 1-token chat
+    completion to one provider at a time, at most MODEL_PROBE_RATE per minute
+    and at batch priority, preferring the providers that are stalest and whose
+    models get the most traffic. Summaries are attached to the catalog's
+    /models entries every MODEL_HEALTH_PUBLISH_INTERVAL seconds.
+
+    Workers serving the shared catalog cannot attach anything to it, so on
+    the same interval they drop the outcomes they observed into files beside
+    CATALOG_SHARED_PATH, which the refresher replays before publishing.
+    """
+
+    STATUS_RANK = {"healthy": 3, "degraded": 2, "unknown": 1, "down": 0}
+
+    def __init__(self):
+        self.providers: Dict[tuple, _ProviderHealth] = defaultdict(_ProviderHealth)
+        self.traffic: Dict[str, tuple] = {}  # model -> (decayed request count, updated at)
+        self.probes_sent = 0
+        self.probes_skipped = 0
+        self.outbox: deque = deque(maxlen=1000)  # Outcomes a worker has yet to hand to the refresher
+        self._task: Optional[asyncio.Task] = None
+        self._publisher: Optional[asyncio.Task] = None
+
+    def observe(self, model: str, provider: str, ok: bool, error_type: Optional[str] = None,
+                latency: Optional[float] = None, probe: bool = False, at: Optional[float] = None):
+        health = self.providers[(model, provider)]
+        now = at or time.time()
+        health.outcomes.append((now, ok, error_type))
+        if ok and latency is not None:
+            health.latencies.append(latency)
+        if probe:
+            health.last_probe = now
+        else:
+            count, updated = self.traffic.get(model, (0.0, now))
+            self.traffic[model] = (count * 0.5 ** (max(now - updated, 0) / MODEL_TRAFFIC_HALF_LIFE) + 1, max(now, updated))
+            if isinstance(model_catalog, SharedModelCatalog):
+                self.outbox.append((model, provider, ok, error_type, latency, now))
+
+    def traffic_weight(self, model: str, now: float) -> float:
+        count, updated = self.traffic.get(model, (0.0, now))
+        return count * 0.5 ** ((now - updated) / MODEL_TRAFFIC_HALF_LIFE)
+
+    def next_target(self) -> Optional[tuple]:
+        """The (model, provider) most in need of a probe, or None if all are fresh"""
+        now = time.time()
+        best, best_score = None, 0.0
+        for model in model_catalog.models():
+            if model.category not in MODEL_PROBE_CATEGORIES:
+                continue
+            weight = 1 + self.traffic_weight(model.name, now)
+            for provider in model.provider_ids:
+                age = now - self.providers[(model.name, provider)].last_probe
+                if age < MODEL_PROBE_INTERVAL:
+                    continue
+                score = min(age, MODEL_HEALTH_TTL) / MODEL_PROBE_INTERVAL * weight
+                if score > best_score:
+                    best, best_score = (model.name, provider), score
+        return best
+
+    async def probe(self, model: str, provider: str):
+        api_key, key_id = await resolve_api_key(None)
+        if not api_key:
+            self.probes_skipped += 1
+            return
+        self.probes_sent += 1
+        started = time.monotonic()
+        try:
+            async with upstream_scheduler.slot("chat", "batch" if "batch" in SCHEDULER_PRIORITY_WEIGHTS else DEFAULT_PRIORITY):
+                async with upstream_post(
+                    http_session(), "chat", provider,
+                    chat_adapter.path,
+                    record_latency=False,
+                    headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+                    json={"model": provider, "messages": [{"role": "user", "content": "ping"}], "max_tokens": 1}
+                ) as response:
+                    if response.status == 200:
+                        await response.read()
+                        await key_pool.report(key_id)
+                        self.observe(model, provider, True, latency=time.monotonic() - started, probe=True)
+                        return
+                    error_type = parse_a4f_error(await response.text())["type"]
+                    await key_pool.report(key_id, error_type)
+        except RequestRejected:
+            self.probes_skipped += 1
+            return
+        except asyncio.TimeoutError:
+            error_type = "timeout"
+        except aiohttp.ClientError:
+            error_type = "network_error"
+
+        if error_type in MODEL_FAILURE_TYPES:
+            self.observe(model, provider, False, error_type, probe=True)
+        else:
+            # Key or plan problems say nothing about the model; just don't probe it again too soon
+            self.providers[(model, provider)].last_probe = time.time()
+
+    def summaries(self) -> Dict[str, Dict[str, Any]]:
+        """Per model: the best provider's status and its median latency"""
+        now = time.time()
+        models: Dict[str, Dict[str, Any]] = {}
+        for (model, provider), health in self.providers.items():
+            summary = {"status": health.status(now), "p50_ms": health.p50_ms(), "provider": provider}
+            current = models.get(model)
+            if current is None or self.STATUS_RANK[summary["status"]] > self.STATUS_RANK[current["status"]]:
+                models[model] = summary
+        return models
+
+    def describe(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "probing": self._task is not None,
+            "probe_rate_per_minute": MODEL_PROBE_RATE,
+            "probes_sent": self.probes_sent,
+            "probes_skipped": self.probes_skipped,
+            "models": self.summaries(),
+            "providers": {
+                f"{model}|{provider}": {
+                    "status": health.status(now),
+                    "p50_ms": health.p50_ms(),
+                    "outcomes": [{"at": round(at), "ok": ok, "error": error} for at, ok, error in health.outcomes],
+                    "last_probe": round(health.last_probe) or None
+                }
+                for (model, provider), health in self.providers.items()
+            }
+        }
+
+    async def _probe_forever(self):
+        while True:
+            await asyncio.sleep(60 / MODEL_PROBE_RATE)
+            try:
+                target = self.next_target()
+                if target:
+                    await self.probe(*target)
+            except Exception as e:
+                logger.warning(f"Model probe failed: {str(e)}")
+
+    def export_outcomes(self, shared_path: Path):
+        """Worker side: write the outcomes observed since the last export for the refresher to pick up"""
+        if not self.outbox:
+            return
+        outcomes = list(self.outbox)
+        self.outbox.clear()
+        path = shared_path.with_name(f"{shared_path.name}.health.{os.getpid()}.{time.time_ns()}.json")
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(_json_bytes(outcomes))
+        os.replace(tmp_path, path)
+
+    def import_outcomes(self, shared_path: Path) -> int:
+        """Refresher side: replay and remove the outcome files the workers exported"""
+        imported = 0
+        for path in sorted(shared_path.parent.glob(f"{shared_path.name}.health.*.json")):
+            try:
+                with open(path, "rb") as f:
+                    outcomes = json.loads(f.read())
+                path.unlink(missing_ok=True)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable worker health file {path}: {str(e)}")
+                path.unlink(missing_ok=True)
+                continue
+            for model, provider, ok, error_type, latency, at in outcomes:
+                self.observe(model, provider, ok, error_type, latency, at=at)
+            imported += len(outcomes)
+        return imported
+
+    async def _publish_forever(self):
+        while True:
+            await asyncio.sleep(MODEL_HEALTH_PUBLISH_INTERVAL)
+            try:
+                if isinstance(model_catalog, SharedModelCatalog):
+                    self.export_outcomes(model_catalog.shared.path)
+                    continue
+                if isinstance(model_catalog, PublishingModelCatalog):
+                    self.import_outcomes(model_catalog.shared_path)
+                model_catalog.set_health(self.summaries())
+            except Exception as e:
+                logger.warning(f"Failed to publish model health: {str(e)}")
+
+    def start(self, probe: bool = MODEL_PROBE_ENABLED):
+        if self._publisher is None:
+            self._publisher = asyncio.create_task(self._publish_forever())
+        if probe and self._task is None:
+            self._task = asyncio.create_task(self._probe_forever())
+
+    async def stop(self):
+        for task in (self._task, self._publisher):
+            if task:
+                task.cancel()
+        self._task = self._publisher = None
+
+model_health = ModelHealthMonitor()
+
+def model_health_hook(ctx: GenerationContext, result: Any):
+    """Record the outcome of every generation request that reached a provider"""
+    if not ctx.model_id or "upstream" not in ctx.timings:
+        return
+    if isinstance(result, dict):
+        if "error" in result:
+            error_type = result["error"].get("type")
+            if error_type in MODEL_FAILURE_TYPES:
+                model_health.observe(ctx.request.model_id, ctx.model_id, False, error_type)
+        elif not result.get("cached"):
+            model_health.observe(ctx.request.model_id, ctx.model_id, True, latency=ctx.timings["upstream"])
+    elif isinstance(result, StreamingResponse):
+        # The stream started, so the provider answered; its time to first byte is the latency
+        model_health.observe(ctx.request.model_id, ctx.model_id, True, latency=ctx.timings["upstream"])
+
+generation_pipeline.add_result_hook(model_health_hook)
+
+@api_router.get("/model-health")
+async def get_model_health():
+    """Health status, median latency and recent outcomes per model and provider"""
+    return model_health.describe()
+
+# Event loop monitor
+LOOP_MONITOR_INTERVAL = float(os.environ.get('LOOP_MONITOR_INTERVAL', '0.1'))
+LOOP_LAG_THRESHOLD = float(os.environ.get('LOOP_LAG_THRESHOLD', '0.1'))  # Seconds before a stall is captured
+LOOP_STACK_DEPTH = int(os.environ.get('LOOP_STACK_DEPTH', '25'))
+# Debug mode times every callback and attributes slow ones to the request route
+LOOP_DEBUG = os.environ.get('LOOP_DEBUG', 'false').lower() == 'true'
+LOOP_SLOW_CALLBACK = float(os.environ.get('LOOP_SLOW_CALLBACK', '0.05'))
+
+# "METHOD /path" of the request a task or callback belongs to, for slow callback reports
+request_route: ContextVar[Optional[str]] = ContextVar("request_route", default=None)
+
+class LoopMonitor:
+    """Measures event loop lag continuously and captures what is blocking it.
+
+    A task sleeps LOOP_MONITOR_INTERVAL and records how late it wakes up. A
+    watchdog thread watches that task's heartbeat; once the loop has been
+    stuck for LOOP_LAG_THRESHOLD it grabs the loop thread's current stack,
+    which is the blocking code itself. With LOOP_DEBUG every callback run
+    by the loop is timed and slow ones are counted per request route.
+    """
+
+    def __init__(self):
+        self.samples: deque = deque(maxlen=600)
+        self.total_samples = 0
+        self.max_lag = 0.0
+        self.stalls: deque = deque(maxlen=20)
+        self.stalls_total = 0
+        self.slow_callbacks: Dict[str, Dict[str, Any]] = {}
+        self.heartbeat = time.monotonic()
+        self._captured: Optional[float] = None
+        self._thread_id: Optional[int] = None
+        self._stop = threading.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._original_handle_run = None
+
+    def observe(self, lag: float):
+        self.samples.append(lag)
+        self.total_samples += 1
+        self.max_lag = max(self.max_lag, lag)
+        if lag >= LOOP_LAG_THRESHOLD and self.stalls and self.stalls[-1]["duration_ms"] is None:
+            self.stalls[-1]["duration_ms"] = round((lag + LOOP_MONITOR_INTERVAL) * 1000, 1)
+
+    async def _run(self):
+        while True:
+            expected = time.monotonic() + LOOP_MONITOR_INTERVAL
+            await asyncio.sleep(LOOP_MONITOR_INTERVAL)
+            now = time.monotonic()
+            self.heartbeat = now
+            self.observe(max(0.0, now - expected))
+
+    def _watch(self):
+        while not self._stop.wait(LOOP_MONITOR_INTERVAL / 2):
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat - LOOP_MONITOR_INTERVAL
+            if blocked < LOOP_LAG_THRESHOLD or self._captured == heartbeat:
+                continue
+            self._captured = heartbeat
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = traceback.format_stack(frame)[-LOOP_STACK_DEPTH:]
+            self.stalls_total += 1
+            self.stalls.append({
+                "detected_at": datetime.now(timezone.utc).isoformat(),
+                "blocked_ms_at_capture": round(blocked * 1000, 1),
+                "duration_ms": None,
+                "stack": [line.rstrip() for line in stack]
+            })
+            logger.warning(f"Event loop blocked for {blocked:.3f}s at:\n{''.join(stack[-3:]).rstrip()}")
+
+    def _instrument_callbacks(self):
+        """Time every Handle the loop runs; the handle's context carries the request route"""
+        original = self._original_handle_run = asyncio.events.Handle._run
+        monitor = self
+
+        def timed_run(handle):
+            started = time.perf_counter()
+            original(handle)
+            elapsed = time.perf_counter() - started
+            if elapsed >= LOOP_SLOW_CALLBACK:
+                route = handle._context.get(request_route) if handle._context is not None else None
+                monitor.slow_callback(route or "background", elapsed, handle)
+
+        asyncio.events.Handle._run = timed_run
+
+    def slow_callback(self, route: str, elapsed: float, handle):
+        stats = self.slow_callbacks.get(route)
+        if stats is None:
+            stats = self.slow_callbacks[route] = {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "slowest": None}
+        ms = elapsed * 1000
+        stats["count"] += 1
+        stats["total_ms"] += ms
+        if ms > stats["max_ms"]:
+            stats["max_ms"] = ms
+            stats["slowest"] = repr(handle)[:300]
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._run())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        if LOOP_DEBUG:
+            self._instrument_callbacks()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._original_handle_run is not None:
+            asyncio.events.Handle._run = self._original_handle_run
+            self._original_handle_run = None
+
+    def recent_lag(self, seconds: float = 5.0) -> float:
+        """Worst lag over roughly the last few seconds"""
+        window = max(1, int(seconds / LOOP_MONITOR_INTERVAL))
+        recent = list(self.samples)[-window:]
+        return max(recent) if recent else 0.0
+
+    def describe(self) -> Dict[str, Any]:
+        lags = np.array(self.samples, dtype=np.float64) * 1000
         return {
-            "error": {
-                "type": "network_error",
-                "message": "🌐 Network connection failed during image generation.",
-                "suggestion": "Please check your internet connection and try again.",
-                "action": "check_connection"
+            "interval_ms": LOOP_MONITOR_INTERVAL * 1000,
+            "threshold_ms": LOOP_LAG_THRESHOLD * 1000,
+            "debug": LOOP_DEBUG,
+            "samples": self.total_samples,
+            "lag_ms": {
+                "last": round(float(lags[-1]), 2) if lags.size else None,
+                "mean": round(float(lags.mean()), 2) if lags.size else None,
+                "p50": round(float(np.percentile(lags, 50)), 2) if lags.size else None,
+                "p99": round(float(np.percentile(lags, 99)), 2) if lags.size else None,
+                "max_window": round(float(lags.max()), 2) if lags.size else None,
+                "max_ever": round(self.max_lag * 1000, 2)
+            },
+            "stalls_total": self.stalls_total,
+            "recent_stalls": list(self.stalls),
+            "slow_callbacks": {
+                route: {**stats, "total_ms": round(stats["total_ms"], 1), "max_ms": round(stats["max_ms"], 1)}
+                for route, stats in sorted(self.slow_callbacks.items(), key=lambda item: -item[1]["total_ms"])
             }
         }
-    except Exception as e:
-        logger.error(f"Error in image generation: {str(e)}")
-        return {
-            "error": {
-                "type": "unexpected_error",
-                "message": f"⚠️ Unexpected error occurred: {str(e)[:100]}",
-                "suggestion": "Please try again or contact support if the issue persists.",
-                "action": "retry"
+
+loop_monitor = LoopMonitor()
+
+@api_router.get("/debug/loop")
+async def get_loop_stats():
+    """Event loop lag percentiles, captured stall stacks and (in debug mode) slow callbacks per route"""
+    return loop_monitor.describe()
+
+# Health and readiness probes
+PROBE_CACHE_TTL = float(os.environ.get('PROBE_CACHE_TTL', '2'))
+PROBE_TIMEOUT = float(os.environ.get('PROBE_TIMEOUT', '2'))
+PROBE_MAX_LOOP_LAG = float(os.environ.get('PROBE_MAX_LOOP_LAG', '0.5'))  # Seconds
+
+PROCESS_STARTED = time.time()
+
+class ReadinessProbe:
+    """Dependency checks behind /readyz, cached for PROBE_CACHE_TTL.
+
+    Concurrent probes share one in-progress check, so a burst of load
+    balancer probes costs a single Mongo ping and upstream request.
+    """
+
+    def __init__(self):
+        self.result: Optional[Dict[str, Any]] = None
+        self.checked_at = 0.0
+        self._running: Optional[asyncio.Task] = None
+        self.latencies: Dict[str, deque] = defaultdict(lambda: deque(maxlen=60))
+
+    async def _timed(self, name: str, check) -> Dict[str, Any]:
+        started = time.monotonic()
+        try:
+            detail = await asyncio.wait_for(check(), timeout=PROBE_TIMEOUT)
+            outcome = {"ok": True, **(detail or {})}
+        except asyncio.TimeoutError:
+            outcome = {"ok": False, "error": f"timed out after {PROBE_TIMEOUT}s"}
+        except Exception as e:
+            outcome = {"ok": False, "error": str(e)[:200]}
+        latency = time.monotonic() - started
+        self.latencies[name].append(latency)
+        outcome["latency_ms"] = round(latency * 1000, 2)
+        return outcome
+
+    @staticmethod
+    async def check_mongo():
+        await db.command("ping")
+
+    @staticmethod
+    async def check_catalog():
+        if not model_catalog.loaded:
+            raise RuntimeError(model_catalog.last_error or "Model catalog not loaded")
+        return {"source": model_catalog.source, "stale": model_catalog.stale}
+
+    @staticmethod
+    async def check_upstream():
+        session = http_session()
+        if isinstance(session, CassetteSession):
+            return {"mode": UPSTREAM_CASSETTE_MODE}
+        # Any HTTP response means DNS, TCP and TLS to A4F work through the shared pool
+        async with await api_upstream.request(session, "GET", "", allow_redirects=False) as response:
+            return {"status": response.status, "endpoint": str(response.url)}
+
+    @staticmethod
+    async def check_event_loop():
+        lag = loop_monitor.recent_lag()
+        if lag > PROBE_MAX_LOOP_LAG:
+            raise RuntimeError(f"Event loop lag {lag:.3f}s exceeds {PROBE_MAX_LOOP_LAG}s")
+        return {"lag_ms": round(lag * 1000, 2)}
+
+    async def _check(self) -> Dict[str, Any]:
+        names = ("mongo", "catalog", "upstream", "event_loop")
+        outcomes = await asyncio.gather(
+            self._timed("mongo", self.check_mongo),
+            self._timed("catalog", self.check_catalog),
+            self._timed("upstream", self.check_upstream),
+            self._timed("event_loop", self.check_event_loop)
+        )
+        checks = dict(zip(names, outcomes))
+        self.result = {"ready": all(check["ok"] for check in outcomes), "checks": checks}
+        self.checked_at = time.monotonic()
+        return self.result
+
+    async def check(self) -> Dict[str, Any]:
+        if self.result is not None and time.monotonic() - self.checked_at < PROBE_CACHE_TTL:
+            return self.result
+        if self._running is None or self._running.done():
+            self._running = asyncio.create_task(self._check())
+        return await asyncio.shield(self._running)
+
+    def current(self) -> Optional[Dict[str, Any]]:
+        """The last result without waiting; starts a check in the background if it has expired"""
+        if self.result is None or time.monotonic() - self.checked_at >= PROBE_CACHE_TTL:
+            if self._running is None or self._running.done():
+                self._running = asyncio.create_task(self._check())
+        return self.result
+
+    def describe_latencies(self) -> Dict[str, Dict[str, float]]:
+        report = {}
+        for name, samples in self.latencies.items():
+            values = sorted(samples)
+            report[name] = {
+                "samples": len(values),
+                "last_ms": round(samples[-1] * 1000, 2),
+                "p50_ms": round(values[len(values) // 2] * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2)
             }
-        }
+        return report
 
-@api_router.post("/generate-audio")
-async def generate_audio(request: AudioModelRequest):
-    """Generate audio with enhanced options"""
-    try:
-        # Get API key from request or stored keys
-        api_key = request.api_key
-        if not api_key:
-            stored_key = await db.api_keys.find_one({"provider": "a4f"}, {"_id": 0})
-            if stored_key:
-                api_key = stored_key["api_key"]
-        
-        if not api_key:
-            return {
-                "error": {
-                    "type": "no_api_key",
-                    "message": "🔐 No API key configured.",
-                    "suggestion": "Please add your A4F API key in Settings to use the models.",
-                    "action": "add_api_key"
-                }
+readiness_probe = ReadinessProbe()
+
+@app.get("/healthz")
+@api_router.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving requests"""
+    return {
+        "status": "ok",
+        "uptime_seconds": round(time.time() - PROCESS_STARTED),
+        "draining": drain_controller.draining
+    }
+
+@app.get("/readyz")
+@api_router.get("/readyz")
+async def readyz():
+    """Readiness: dependencies reachable and not draining; 503 otherwise"""
+    result = await readiness_probe.check()
+    ready = result["ready"] and not drain_controller.draining
+    body = {
+        "status": "ready" if ready else "not_ready",
+        "draining": drain_controller.draining,
+        "checked_seconds_ago": round(time.monotonic() - readiness_probe.checked_at, 2),
+        "checks": result["checks"],
+        "latencies": readiness_probe.describe_latencies()
+    }
+    return JSONResponse(status_code=200 if ready else 503, content=body)
+
+# Frontend bootstrap
+# Model fields the UI needs for its first paint; everything else stays behind /api/models
+BOOTSTRAP_MODEL_FIELDS = (
+    "name", "type", "plan", "description", "base_model", "logoUrl",
+    "context_window", "features", "proxy_providers", "health"
+)
+BOOTSTRAP_GZIP_MIN_BYTES = 1024
+
+# Per-modality request defaults, taken from the request models so they never drift
+BOOTSTRAP_DEFAULTS = {
+    category: {
+        name: field.default
+        for name, field in request_model.model_fields.items()
+        if name not in ("model_id", "prompt", "provider_id", "api_key") and not field.is_required()
+    }
+    for category, request_model in (
+        ("text", TextModelRequest), ("image", ImageModelRequest),
+        ("audio", AudioModelRequest), ("video", VideoModelRequest)
+    )
+}
+
+class BootstrapCache:
+    """The /bootstrap response, rebuilt only when one of its inputs changes.
+
+    The slim catalog is derived from the catalog's prebuilt /models JSON once
+    per catalog version. The full body, its gzip encoding and its ETag are
+    kept for the current inputs (catalog version and status, key status,
+    readiness), so repeated page loads cost a dictionary lookup and a bytes
+    write. Catalog status is part of the inputs because it turns stale with
+    time alone, and readiness is refreshed in the background rather than
+    left to whoever calls /readyz.
+    """
+
+    def __init__(self):
+        self._catalog_version = None
+        self._catalog: Optional[Dict[str, Any]] = None
+        self._inputs = None
+        self.body = b""
+        self.gzipped = b""
+        self.etag = ""
+
+    def slim_catalog(self) -> Dict[str, Any]:
+        version = model_catalog.version
+        if version != self._catalog_version:
+            full = json.loads(model_catalog.response_body())
+            categories = {}
+            for category, entries in full["categorized"].items():
+                for entry in entries:
+                    categories[entry["name"]] = category
+            self._catalog = {
+                "total_models": full["total_models"],
+                "models": [
+                    {
+                        **{field: model[field] for field in BOOTSTRAP_MODEL_FIELDS if field in model},
+                        "category": categories.get(model["name"], "other")
+                    }
+                    for model in full["models"]
+                ],
+                "categories": {category: len(entries) for category, entries in full["categorized"].items()}
             }
-        
-        # Get the full model ID with provider prefix
-        full_model_id = await get_full_model_id(request.model_id, request.provider_id)
-        
-        # Make real API call to A4F for audio generation
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "model": full_model_id,
-            "input": request.prompt,
-            "voice": request.voice,
-            "speed": request.speed,
-            "response_format": request.format
-        }
-        
-        # Add language if provided
-        if request.language:
-            payload["language"] = request.language
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://api.a4f.co/v1/audio/speech",
-                json=payload,
-                headers=headers
+            self._catalog_version = version
+        return self._catalog
+
+    async def build(self):
+        await model_catalog.ensure_loaded()
+        keys = await key_pool.keys("a4f")
+        statuses = [KeyPool.health(key) for key in keys]
+        readiness = readiness_probe.current()
+        # age_seconds would go stale in the cached body; clients can derive it from fetched_at
+        catalog_status = {key: value for key, value in model_catalog.status().items() if key != "age_seconds"}
+        inputs = (
+            model_catalog.version,
+            tuple(catalog_status.items()),
+            tuple(statuses),
+            None if readiness is None else readiness["ready"],
+            drain_controller.draining
+        )
+        if inputs == self._inputs:
+            return
+
+        body = _json_bytes({
+            "catalog": {**self.slim_catalog(), "status": catalog_status},
+            "api_key": {
+                "configured": bool(keys),
+                "total_keys": len(keys),
+                "active_keys": statuses.count("active")
+            },
+            "health": {
+                "ready": None if readiness is None else readiness["ready"] and not drain_controller.draining,
+                "draining": drain_controller.draining
+            },
+            "defaults": BOOTSTRAP_DEFAULTS,
+            "features": {
+                "similarity_cache": SIMILARITY_CACHE_ENABLED,
+                "image_max_n": IMAGE_MAX_N,
+                "audio_streaming": True,
+                "chat_streaming": True
+            }
+        })
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=6) if len(body) >= BOOTSTRAP_GZIP_MIN_BYTES else b""
+        self.etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+        self._inputs = inputs
+
+bootstrap_cache = BootstrapCache()
+
+@api_router.get("/bootstrap")
+async def get_bootstrap(request: Request):
+    """Everything the UI needs for its first paint: slim catalog, key status (never the key), health and defaults"""
+    try:
+        await bootstrap_cache.build()
+    except Exception as e:
+        logger.error(f"Error building bootstrap: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error building bootstrap: {str(e)}")
+
+    gzipped = bool(bootstrap_cache.gzipped) and "gzip" in request.headers.get("accept-encoding", "")
+    etag = bootstrap_cache.etag[:-1] + '-gzip"' if gzipped else bootstrap_cache.etag
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in if_none_match or bootstrap_cache.etag in if_none_match:
+        return Response(status_code=304, headers=headers)
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=bootstrap_cache.gzipped, media_type="application/json", headers=headers)
+    return Response(content=bootstrap_cache.body, media_type="application/json", headers=headers)
+
+# Prewarm
+PREWARM_TTL = float(os.environ.get('PREWARM_TTL', '300'))  # Seconds a model's resolution is reused
+# An idle pooled connection lives for UPSTREAM_KEEPALIVE_TIMEOUT; re-warm once it may be gone
+PREWARM_CONNECTION_TTL = float(os.environ.get('PREWARM_CONNECTION_TTL', str(UPSTREAM_KEEPALIVE_TIMEOUT / 2)))
+
+class PrewarmRequest(BaseModel):
+    model_id: str
+    provider_id: Optional[str] = None
+
+class Prewarmer:
+    """Does the first request's setup work while the user is still typing.
+
+    Prewarming resolves the model's full provider ID from the catalog
+    (loading it if needed), loads the key pool from MongoDB and opens a
+    keep-alive connection to the upstream endpoint requests will be sent
+    to, so the first generation request skips all three. Resolutions are
+    kept per model for PREWARM_TTL (or until the catalog changes) and the
+    connection is warmed at most once per PREWARM_CONNECTION_TTL; concurrent
+    prewarms share the work in progress. Repeated calls cost a dict lookup.
+    """
+
+    def __init__(self):
+        self.resolved: Dict[tuple, tuple] = {}  # (model, provider) -> (resolved at, catalog version, full model ID)
+        self._resolving: Dict[tuple, asyncio.Task] = {}
+        self.connection: Dict[str, Any] = {}
+        self.connection_warmed_at = 0.0
+        self._connecting: Optional[asyncio.Task] = None
+        self.counts = {"requests": 0, "resolutions": 0, "connections": 0}
+
+    async def _resolve(self, key: tuple) -> str:
+        self.counts["resolutions"] += 1
+        model_id = await get_full_model_id(*key)
+        await key_pool.keys("a4f")
+        self.resolved[key] = (time.monotonic(), model_catalog.version, model_id)
+        return model_id
+
+    async def resolve(self, model: str, provider: Optional[str]) -> tuple:
+        """(full model ID, whether it was already warm)"""
+        key = (model, provider)
+        cached = self.resolved.get(key)
+        if cached and time.monotonic() - cached[0] < PREWARM_TTL and cached[1] == model_catalog.version:
+            return cached[2], True
+        if key not in self._resolving or self._resolving[key].done():
+            self._resolving[key] = asyncio.create_task(self._resolve(key))
+            self._resolving[key].add_done_callback(lambda _: self._resolving.pop(key, None))
+        return await asyncio.shield(self._resolving[key]), False
+
+    async def _connect(self) -> Dict[str, Any]:
+        self.counts["connections"] += 1
+        session = http_session()
+        if isinstance(session, CassetteSession):
+            return {"mode": UPSTREAM_CASSETTE_MODE}
+        started = time.monotonic()
+        try:
+            # Reading the body hands the connection back to the pool, ready for the next request
+            async with await api_upstream.request(
+                session, "GET", "", allow_redirects=False, timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)
             ) as response:
-                if response.status == 200:
-                    # For audio, the response might be binary or a URL
-                    content_type = response.headers.get('content-type', '')
-                    
-                    if 'application/json' in content_type:
-                        data = await response.json()
-                        return {
-                            "success": True,
-                            "audio_url": data.get("url") or data.get("audio_url"),
-                            "model": request.model_id,
-                            "voice": request.voice,
-                            "format": request.format,
-                            "duration": data.get("duration"),
-                        }
-                    else:
-                        # Binary audio response - would need to save and return URL
-                        # For now, return error suggesting URL-based response
-                        return {
-                            "error": {
-                                "type": "response_format_error",
-                                "message": "🎵 Audio response format not supported.",
-                                "suggestion": "Please try a different audio model that returns URL responses.",
-                                "action": "switch_model"
-                            }
-                        }
-                else:
-                    error_text = await response.text()
-                    error_info = parse_a4f_error(error_text)
-                    return {"error": error_info, "status_code": response.status}
-    
-    except aiohttp.ClientError as e:
-        logger.error(f"Network error in audio generation: {str(e)}")
+                await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return {"ok": False, "error": str(e)[:200] or type(e).__name__}
+        self.connection_warmed_at = time.monotonic()
+        self.connection = {"ok": True, "endpoint": str(response.url.origin()), "ms": round((time.monotonic() - started) * 1000, 1)}
+        return self.connection
+
+    async def warm_connection(self) -> tuple:
+        """(connection details, whether it was already warm)"""
+        if time.monotonic() - self.connection_warmed_at < PREWARM_CONNECTION_TTL:
+            return self.connection, True
+        if self._connecting is None or self._connecting.done():
+            self._connecting = asyncio.create_task(self._connect())
+        return await asyncio.shield(self._connecting), False
+
+    async def prewarm(self, model: str, provider: Optional[str]) -> Dict[str, Any]:
+        self.counts["requests"] += 1
+        (model_id, model_warm), (connection, connection_warm) = await asyncio.gather(
+            self.resolve(model, provider), self.warm_connection()
+        )
         return {
-            "error": {
-                "type": "network_error",
-                "message": "🌐 Network connection failed during audio generation.",
-                "suggestion": "Please check your internet connection and try again.",
-                "action": "check_connection"
-            }
+            "model": model,
+            "model_id": model_id,
+            "connection": connection,
+            "already_warm": model_warm and connection_warm
         }
-    except Exception as e:
-        logger.error(f"Error in audio generation: {str(e)}")
+
+    def describe(self) -> Dict[str, Any]:
         return {
-            "error": {
-                "type": "unexpected_error",
-                "message": f"⚠️ Unexpected error occurred: {str(e)[:100]}",
-                "suggestion": "Please try again or contact support if the issue persists.",
-                "action": "retry"
-            }
+            **self.counts,
+            "models": len(self.resolved),
+            "connection": self.connection,
+            "connection_age": round(time.monotonic() - self.connection_warmed_at, 1) if self.connection_warmed_at else None
         }
 
-@api_router.post("/generate-video")
-async def generate_video(request: VideoModelRequest):
-    """Generate video with enhanced options"""
+prewarmer = Prewarmer()
+
+@api_router.post("/prewarm")
+async def prewarm_model(request: PrewarmRequest):
+    """Resolve a model, load the key pool and warm the upstream connection before the first request"""
+    return await prewarmer.prewarm(request.model_id, request.provider_id)
+
+@api_router.get("/prewarm")
+async def get_prewarm_status():
+    return prewarmer.describe()
+
+# WebSocket chat sessions
+CHAT_WS_PATH = "/api/chat/ws"
+CHAT_WS_MAX_HISTORY = int(os.environ.get('CHAT_WS_MAX_HISTORY', '50'))  # Messages kept per session
+CHAT_WS_IDLE_TIMEOUT = float(os.environ.get('CHAT_WS_IDLE_TIMEOUT', '900'))
+
+# TextModelRequest fields a session's start and update messages may set
+CHAT_SESSION_SETTINGS = (
+    "model_id", "provider_id", "system_prompt", "temperature", "max_tokens",
+    "top_p", "frequency_penalty", "presence_penalty", "similarity_cache"
+)
+
+# (api_key, key_id) resolved once per WebSocket session; resolve_key_stage uses it instead of the pool
+session_api_key: ContextVar[Optional[tuple]] = ContextVar("session_api_key", default=None)
+
+class ChatSession:
+    """Server-side state of one WebSocket chat: settings, history and API key.
+
+    Settings and the key are resolved once, when the session starts or is
+    updated, and every turn only sends its new message. Turns go through the
+    same /chat handler as HTTP requests (scheduler, usage, caches, health),
+    always streaming, with deltas forwarded as frames. Only one turn runs at a
+    time and a cancel message stops it; cancelled turns leave no history.
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.id = str(uuid.uuid4())
+        self.websocket = websocket
+        self.settings: Dict[str, Any] = {}
+        self.history: List[Dict[str, str]] = []
+        self.api_key: Optional[str] = None  # Supplied by the client, if any
+        self.key: Optional[tuple] = None
+        self.turn: Optional[asyncio.Task] = None
+        self.turns = 0
+        self._send_lock = asyncio.Lock()
+
+    async def send(self, message: Dict[str, Any]):
+        # Turns and control replies are sent from different tasks
+        async with self._send_lock:
+            await self.websocket.send_text(json.dumps(message))
+
+    async def error(self, error_type: str, message: str, suggestion: str, action: str = "retry"):
+        await self.send({"type": "error", "error": {
+            "type": error_type, "message": message, "suggestion": suggestion, "action": action
+        }})
+
+    async def configure(self, message: Dict[str, Any], fresh: bool = False):
+        updates = {name: message[name] for name in CHAT_SESSION_SETTINGS if name in message}
+        if "model_id" in updates and "provider_id" not in updates:
+            # A different model starts from its own default provider
+            updates["provider_id"] = None
+        try:
+            validated = TextModelRequest(prompt="", **{**self.settings, **updates})
+        except ValidationError as e:
+            await self.error("invalid_parameters", f"⚙️ Invalid session settings: {str(e)[:200]}", "Please check your settings.", "check_parameters")
+            return
+
+        settings = validated.model_dump(include=set(CHAT_SESSION_SETTINGS))
+        if "model_id" in updates or "provider_id" in updates:
+            # A full "provider/model" ID is used as is by every turn, skipping the catalog lookup
+            settings["provider_id"] = await get_full_model_id(validated.model_id, validated.provider_id)
+        if "api_key" in message:
+            self.api_key = message["api_key"] or None
+            self.key = None
+        self.settings = settings
+        if fresh:
+            self.history.clear()
+
+        if self.key is None:
+            self.key = await resolve_api_key(self.api_key)
+        await self.send({
+            "type": "ready",
+            "session_id": self.id,
+            "model": settings["model_id"],
+            "model_id": settings["provider_id"],
+            "api_key": {"configured": bool(self.key[0]), "own_key": bool(self.api_key)},
+            "history": len(self.history)
+        })
+
+    async def run_turn(self, content: str):
+        self.turns += 1
+        turn = self.turns
+        if not self.key or not self.key[0]:
+            self.key = await resolve_api_key(self.api_key)
+            if not self.key[0]:
+                await self.send({"type": "error", "turn": turn, **await missing_api_key_error()})
+                return
+        if not drain_controller.admit(CHAT_WS_PATH):
+            rejection = ServerDraining()
+            await self.send({"type": "error", "turn": turn, **rejection.payload})
+            await self.websocket.close(code=1012, reason="Server restarting")
+            return
+
+        session_api_key.set(self.key)
+        # Settings were validated when they were set; skip re-validating the whole history every turn
+        request = TextModelRequest.model_construct(
+            **self.settings, prompt=content, stream=True, conversation_history=self.history, api_key=None
+        )
+        reply: List[str] = []
+        try:
+            try:
+                result = await chat_with_model(request)
+            except RequestRejected as e:
+                result = e.payload
+            if isinstance(result, StreamingResponse):
+                async with contextlib.aclosing(result.body_iterator) as events:
+                    async for frame in events:
+                        event = json.loads(frame[len("data: "):])
+                        if "delta" in event:
+                            reply.append(event["delta"])
+                            await self.send({"type": "delta", "turn": turn, "delta": event["delta"]})
+                        else:
+                            result = event
+            elif "response" in result:
+                # Answered without streaming, e.g. from the similarity cache
+                reply.append(result["response"])
+                await self.send({"type": "delta", "turn": turn, "delta": result["response"]})
+        finally:
+            drain_controller.release(CHAT_WS_PATH)
+
+        if "error" in result:
+            error_type = result["error"].get("type")
+            if self.key[1] and (error_type in KEY_QUARANTINE_SECONDS or error_type in KEY_DISABLING_ERRORS):
+                # The pool took the key out of rotation; pick another one next turn
+                self.key = None
+            await self.send({"type": "error", "turn": turn, "error": result["error"]})
+            return
+
+        self.history.append({"role": "user", "content": content})
+        self.history.append({"role": "assistant", "content": "".join(reply)})
+        del self.history[:-CHAT_WS_MAX_HISTORY]
+        await self.send({
+            "type": "done",
+            "turn": turn,
+            "usage": result.get("usage"),
+            "finish_reason": result.get("finish_reason"),
+            "cached": bool(result.get("cached"))
+        })
+
+    async def _run_turn(self, content: str):
+        try:
+            await self.run_turn(content)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in chat session {self.id}: {str(e)}")
+            with contextlib.suppress(Exception):
+                await self.error("unexpected_error", f"⚠️ Unexpected error occurred: {str(e)[:100]}",
+                                 "Please try again or contact support if the issue persists.")
+
+    async def cancel(self) -> bool:
+        if self.turn is None or self.turn.done():
+            return False
+        self.turn.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self.turn
+        return True
+
+    async def handle(self, message: Dict[str, Any]):
+        kind = message.get("type")
+        if kind in ("start", "update"):
+            if self.turn is not None and not self.turn.done():
+                await self.error("busy", "⏳ A response is still being generated.", "Wait for it to finish or cancel it first.", "wait")
+                return
+            # start begins a new conversation; update keeps the history
+            await self.configure(message, fresh=kind == "start")
+        elif kind == "message":
+            if not self.settings:
+                await self.error("invalid_parameters", "⚙️ The session has not been started.", "Send a start message with a model_id first.", "check_parameters")
+            elif self.turn is not None and not self.turn.done():
+                await self.error("busy", "⏳ A response is still being generated.", "Wait for it to finish or cancel it first.", "wait")
+            elif not isinstance(message.get("content"), str) or not message["content"].strip():
+                await self.error("invalid_parameters", "⚙️ The message is empty.", "Please enter a message.", "check_parameters")
+            else:
+                self.turn = asyncio.create_task(self._run_turn(message["content"]))
+        elif kind == "cancel":
+            await self.send({"type": "cancelled", "turn": self.turns, "was_running": await self.cancel()})
+        elif kind == "reset":
+            await self.cancel()
+            self.history.clear()
+            await self.send({"type": "reset"})
+        else:
+            await self.error("invalid_parameters", f"⚙️ Unknown message type '{kind}'.", "Use start, update, message, cancel or reset.", "check_parameters")
+
+@api_router.websocket("/chat/ws")
+async def chat_websocket(websocket: WebSocket):
+    """Multi-turn chat over one WebSocket.
+
+    Client messages: {"type": "start", "model_id": ..., <other TextModelRequest settings>, "api_key"?}
+    (a new conversation), {"type": "update", ...} (keeps the history), {"type": "message", "content": ...}, {"type": "cancel"} and {"type": "reset"}.
+    Server frames: ready, delta, done, cancelled, reset and error, with turn numbers on turn events.
+    """
+    await websocket.accept()
+    request_route.set(f"WS {CHAT_WS_PATH}")
+    session = ChatSession(websocket)
     try:
-        # Get API key from request or stored keys
-        api_key = request.api_key
-        if not api_key:
-            stored_key = await db.api_keys.find_one({"provider": "a4f"}, {"_id": 0})
-            if stored_key:
-                api_key = stored_key["api_key"]
-        
-        if not api_key:
-            return {
-                "error": {
-                    "type": "no_api_key",
-                    "message": "🔐 No API key configured.",
-                    "suggestion": "Please add your A4F API key in Settings to use the models.",
-                    "action": "add_api_key"
-                }
-            }
-        
-        # Get the full model ID with provider prefix
-        full_model_id = await get_full_model_id(request.model_id, request.provider_id)
-        
-        # Convert aspect ratio to resolution if needed
-        if request.aspect_ratio:
-            aspect_ratios = {
-                "16:9": "1920x1080",
-                "9:16": "1080x1920",
-                "1:1": "1024x1024",
-                "4:3": "1024x768"
+        while True:
+            try:
+                text = await asyncio.wait_for(websocket.receive_text(), CHAT_WS_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                await websocket.close(code=1000, reason="Idle timeout")
+                break
+            try:
+                message = json.loads(text)
+            except ValueError:
+                message = None
+            if not isinstance(message, dict):
+                await session.error("invalid_parameters", "⚙️ Messages must be JSON objects.", "Send a JSON object with a type.", "check_parameters")
+                continue
+            await session.handle(message)
+    except (WebSocketDisconnect, RuntimeError):
+        # RuntimeError: the socket was already closed, e.g. by a drain
+        pass
+    finally:
+        await session.cancel()
+
+# Durable job queue
+# Offline generation jobs are stored in the jobs collection and run by worker processes
+# (python server.py --job-worker), which claim them with an atomic lease
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', '120'))  # Visibility timeout of a claimed job
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_RETRY_BACKOFF = float(os.environ.get('JOB_RETRY_BACKOFF', '10'))  # Seconds before the first retry, doubling after each
+JOB_WORKER_CONCURRENCY = int(os.environ.get('JOB_WORKER_CONCURRENCY', '8'))  # Jobs in flight per worker process
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '1'))  # Idle wait of a worker slot when nothing is queued
+JOB_SUBMIT_MAX = int(os.environ.get('JOB_SUBMIT_MAX', '5000'))  # Requests accepted per submission
+JOB_RETENTION_HOURS = float(os.environ.get('JOB_RETENTION_HOURS', '168'))  # Finished jobs are then removed by a TTL index
+JOB_PRIORITY = "batch" if "batch" in SCHEDULER_PRIORITY_WEIGHTS else DEFAULT_PRIORITY
+
+# Error types worth another attempt: the key pool, the provider or the network may have recovered
+JOB_RETRYABLE_ERRORS = {
+    "rate_limit", "model_unavailable", "server_error", "timeout", "network_error", "no_response",
+    "unknown_error", "unexpected_error", "overloaded", "queue_timeout", "deadline_exceeded", "server_draining",
+    "lease_expired"
+}
+
+# Request model and handler per job kind; handlers are called without an HTTP request
+JOB_KINDS = {
+    "chat": (TextModelRequest, chat_with_model),
+    "image": (ImageModelRequest, generate_image),
+    "audio": (AudioModelRequest, generate_audio),
+    "video": (VideoModelRequest, generate_video),
+}
+
+# Job fields returned by the status endpoints; the request (and any API key in it) stays private
+JOB_STATUS_FIELDS = {
+    "_id": 0, "id": 1, "batch_id": 1, "kind": 1, "model": 1, "status": 1, "attempts": 1, "max_attempts": 1,
+    "error": 1, "worker": 1, "created_at": 1, "started_at": 1, "finished_at": 1, "available_at": 1
+}
+
+class JobSubmission(BaseModel):
+    kind: str  # chat, image, audio or video
+    requests: List[Dict[str, Any]]  # Bodies as accepted by the matching generation endpoint
+    max_attempts: Optional[int] = None
+
+class JobQueue:
+    """Durable generation jobs in MongoDB with lease-based claiming.
+
+    A worker claims a job with one find_one_and_update that picks the oldest
+    claimable job and moves its available_at to the end of a fresh lease, so
+    any number of worker processes on any number of machines can poll the
+    collection without handing a job out twice. The worker extends the lease
+    while the job runs; if the worker dies, the lease expires and the job
+    becomes claimable again. Every claim counts as an attempt. Retryable
+    errors are retried with exponential backoff until max_attempts, after
+    which the job is dead-lettered; other errors fail the job at once.
+    """
+
+    async def start(self):
+        try:
+            await db.jobs.create_index("id", unique=True)
+            await db.jobs.create_index([("status", 1), ("available_at", 1)])
+            await db.jobs.create_index("batch_id")
+            await db.jobs.create_index("expires_at", expireAfterSeconds=0)
+        except Exception as e:
+            logger.warning(f"Failed to create job indexes: {str(e)}")
+
+    async def submit(self, kind: str, requests: List[BaseModel], max_attempts: int) -> Dict[str, Any]:
+        now = time.time()
+        batch_id = str(uuid.uuid4())
+        jobs = [
+            {
+                "id": str(uuid.uuid4()),
+                "batch_id": batch_id,
+                "kind": kind,
+                "model": request.model_id,
+                "request": request.model_dump(),
+                "status": "queued",
+                "attempts": 0,
+                "max_attempts": max_attempts,
+                "available_at": now,
+                "lease_id": None,
+                "worker": None,
+                "error": None,
+                "result": None,
+                "history": [],
+                "created_at": now,
+                "started_at": None,
+                "finished_at": None,
+                "expires_at": None
             }
-            resolution = aspect_ratios.get(request.aspect_ratio, request.resolution)
-        else:
-            resolution = request.resolution
-        
-        # Make real API call to A4F for video generation
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "model": full_model_id,
-            "prompt": request.prompt,
-            "size": resolution,
-            "duration": request.duration,
-        }
-        
-        # Add optional parameters
-        if request.fps:
-            payload["fps"] = request.fps
-        if request.style:
-            payload["style"] = request.style
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://api.a4f.co/v1/videos/generations",
-                json=payload,
-                headers=headers
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    # Check if response has the video URL or generation ID
-                    if "data" in data and len(data["data"]) > 0:
-                        video_data = data["data"][0]
-                        return {
-                            "success": True,
-                            "video_url": video_data.get("url") or video_data.get("video_url"),
-                            "thumbnail_url": video_data.get("thumbnail"),
-                            "model": request.model_id,
-                            "resolution": resolution,
-                            "duration": request.duration,
-                            "fps": request.fps,
-                        }
-                    else:
-                        return {
-                            "success": True,
-                            "video_url": data.get("url") or data.get("video_url"),
-                            "model": request.model_id,
-                            "resolution": resolution,
-                            "duration": request.duration,
-                        }
-                else:
-                    error_text = await response.text()
-                    error_info = parse_a4f_error(error_text)
-                    return {"error": error_info, "status_code": response.status}
-    
-    except aiohttp.ClientError as e:
-        logger.error(f"Network error in video generation: {str(e)}")
+            for request in requests
+        ]
+        await db.jobs.insert_many(jobs, ordered=False)
+        return {"batch_id": batch_id, "job_ids": [job["id"] for job in jobs], "submitted": len(jobs)}
+
+    async def claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        """Lease the oldest queued job, or a running one whose lease has expired"""
+        now = time.time()
+        return await db.jobs.find_one_and_update(
+            {"status": {"$in": ["queued", "running"]}, "available_at": {"$lte": now}},
+            {
+                "$set": {
+                    "status": "running",
+                    "available_at": now + JOB_LEASE_SECONDS,
+                    "lease_id": str(uuid.uuid4()),
+                    "worker": worker,
+                    "started_at": now
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("available_at", 1)],
+            projection={"result": 0, "history": 0},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _update_leased(self, job: Dict[str, Any], update: Dict[str, Any]) -> bool:
+        # Only the holder of the current lease may touch a running job
+        result = await db.jobs.update_one({"id": job["id"], "lease_id": job["lease_id"], "status": "running"}, update)
+        return result.matched_count == 1
+
+    async def extend(self, job: Dict[str, Any]) -> bool:
+        return await self._update_leased(job, {"$set": {"available_at": time.time() + JOB_LEASE_SECONDS}})
+
+    async def release(self, job: Dict[str, Any]) -> bool:
+        """Give a job back without counting the attempt, e.g. when its worker shuts down"""
+        return await self._update_leased(job, {
+            "$set": {"status": "queued", "available_at": time.time(), "lease_id": None, "worker": None},
+            "$inc": {"attempts": -1}
+        })
+
+    def _finished(self, status: str, **fields) -> Dict[str, Any]:
+        now = time.time()
         return {
-            "error": {
-                "type": "network_error",
-                "message": "🌐 Network connection failed during video generation.",
-                "suggestion": "Please check your internet connection and try again.",
-                "action": "check_connection"
-            }
+            "status": status,
+            "lease_id": None,
+            "finished_at": now,
+            "expires_at": datetime.fromtimestamp(now + JOB_RETENTION_HOURS * 3600, timezone.utc),
+            **fields
         }
-    except Exception as e:
-        logger.error(f"Error in video generation: {str(e)}")
-        return {
-            "error": {
-                "type": "unexpected_error",
-                "message": f"⚠️ Unexpected error occurred: {str(e)[:100]}",
-                "suggestion": "Please try again or contact support if the issue persists.",
-                "action": "retry"
+
+    async def complete(self, job: Dict[str, Any], result: Dict[str, Any]) -> bool:
+        return await self._update_leased(job, {"$set": self._finished("succeeded", result=result, error=None)})
+
+    async def fail(self, job: Dict[str, Any], error: Dict[str, Any]) -> str:
+        """Record a failed attempt; returns the job's new status"""
+        retryable = error.get("type") in JOB_RETRYABLE_ERRORS
+        if retryable and job["attempts"] < job["max_attempts"]:
+            status = "queued"
+            fields = {
+                "status": status,
+                "available_at": time.time() + JOB_RETRY_BACKOFF * 2 ** (job["attempts"] - 1),
+                "lease_id": None,
+                "error": error
             }
-        }
+        else:
+            status = "dead_letter" if retryable else "failed"
+            fields = self._finished(status, error=error)
+
+        attempt = {"attempt": job["attempts"], "worker": job["worker"], "error": error.get("type"), "at": time.time()}
+        updated = await self._update_leased(job, {
+            "$set": fields,
+            "$push": {"history": {"$each": [attempt], "$slice": -20}}
+        })
+        return status if updated else "lease_lost"
+
+    async def retry(self, job_id: str) -> bool:
+        """Requeue a failed or dead-lettered job with a fresh set of attempts"""
+        result = await db.jobs.update_one(
+            {"id": job_id, "status": {"$in": ["failed", "dead_letter"]}},
+            {"$set": {
+                "status": "queued", "attempts": 0, "available_at": time.time(),
+                "error": None, "finished_at": None, "expires_at": None
+            }}
+        )
+        return result.matched_count == 1
+
+    async def get(self, job_id: str, projection: Dict[str, int]) -> Optional[Dict[str, Any]]:
+        return await db.jobs.find_one({"id": job_id}, projection)
+
+    async def counts(self, match: Dict[str, Any]) -> Dict[str, int]:
+        counts = dict.fromkeys(("queued", "running", "succeeded", "failed", "dead_letter"), 0)
+        async for row in db.jobs.aggregate([{"$match": match}, {"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+            counts[row["_id"]] = row["count"]
+        return counts
+
+    async def oldest_queued_seconds(self, match: Dict[str, Any]) -> Optional[float]:
+        oldest = await db.jobs.find_one(
+            {**match, "status": "queued", "available_at": {"$lte": time.time()}},
+            {"_id": 0, "available_at": 1},
+            sort=[("available_at", 1)]
+        )
+        return round(time.time() - oldest["available_at"], 1) if oldest else None
+
+job_queue = JobQueue()
+
+class JobWorker:
+    """Runs queued jobs in this process, up to `concurrency` at a time.
+
+    Each slot claims a job, runs it through the same decorated handler as the
+    HTTP endpoint (so scheduling, usage tracking, key rotation and the
+    pipeline behave identically) at batch priority, and records the outcome.
+    Throughput scales with the number of worker processes; the upstream
+    scheduler still bounds the calls each process makes.
+    """
+
+    def __init__(self, concurrency: int = JOB_WORKER_CONCURRENCY):
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.concurrency = concurrency
+        self.outcomes: Dict[str, int] = defaultdict(int)
+        self._stopping: Optional[asyncio.Event] = None
+
+    async def _call(self, job: Dict[str, Any]) -> Any:
+        request_model, handler = JOB_KINDS[job["kind"]]
+        # Runs in its own task, so these stay local to the job
+        request_priority.set(JOB_PRIORITY)
+        request_route.set(f"JOB {job['kind']}")
+        try:
+            return await handler(request_model(**job["request"]))
+        except RequestRejected as e:
+            return e.payload
+
+    async def execute(self, job: Dict[str, Any]):
+        work = asyncio.ensure_future(self._call(job))
+        try:
+            while not work.done():
+                await asyncio.wait({work}, timeout=JOB_LEASE_SECONDS / 3)
+                if not work.done() and not await job_queue.extend(job):
+                    # Another worker holds the job now; stop spending upstream calls on it
+                    logger.warning(f"Lost the lease on job {job['id']}, abandoning it")
+                    work.cancel()
+                    self.outcomes["lease_lost"] += 1
+                    return
+            result = work.result()
+        except asyncio.CancelledError:
+            work.cancel()
+            await asyncio.shield(job_queue.release(job))
+            raise
+        except Exception as e:
+            logger.error(f"Error running job {job['id']}: {str(e)}")
+            result = {
+                "error": {
+                    "type": "unexpected_error",
+                    "message": f"⚠️ Unexpected error occurred: {str(e)[:100]}",
+                    "suggestion": "The job will be retried if it has attempts left.",
+                    "action": "retry"
+                }
+            }
+
+        if isinstance(result, dict) and "error" in result:
+            status = await job_queue.fail(job, result["error"])
+        elif isinstance(result, dict):
+            status = "succeeded" if await job_queue.complete(job, result) else "lease_lost"
+        else:
+            status = await job_queue.fail(job, error_response("unknown_error", error_message="Unsupported job response"))
+        self.outcomes[status] += 1
+
+    async def _slot(self):
+        while not self._stopping.is_set():
+            try:
+                job = await job_queue.claim(self.name)
+            except Exception as e:
+                logger.warning(f"Failed to claim a job: {str(e)}")
+                job = None
+
+            if job is None:
+                # Jitter keeps idle workers from polling in lockstep
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._stopping.wait(), JOB_POLL_INTERVAL * random.uniform(0.5, 1.5))
+            elif job["attempts"] > job["max_attempts"]:
+                # Its lease expired on every attempt, e.g. it keeps crashing or stalling its worker
+                self.outcomes[await job_queue.fail(job, {
+                    "type": "lease_expired",
+                    "message": "⏱️ The job did not finish within its lease on any attempt.",
+                    "suggestion": "Check the worker logs, then retry the job.",
+                    "action": "retry"
+                })] += 1
+            else:
+                await self.execute(job)
+
+    def stop(self):
+        if self._stopping:
+            self._stopping.set()
+
+    async def run(self, grace_period: float = DRAIN_GRACE_PERIOD):
+        """Run until stop() is called, then let running jobs finish for up to grace_period seconds"""
+        self._stopping = asyncio.Event()
+        await job_queue.start()
+        logger.info(f"Job worker {self.name} started with concurrency {self.concurrency}")
+        slots = [asyncio.create_task(self._slot()) for _ in range(self.concurrency)]
+        await self._stopping.wait()
+
+        _, pending = await asyncio.wait(slots, timeout=grace_period)
+        for slot in pending:
+            # Cancelled jobs are released so another worker picks them up right away
+            slot.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        logger.info(f"Job worker {self.name} stopped: {dict(self.outcomes)}")
+
+def run_job_worker(concurrency: int = JOB_WORKER_CONCURRENCY):
+    """Standalone worker process that runs queued jobs until SIGTERM or SIGINT"""
+    global image_store
+
+    async def work():
+        worker = JobWorker(concurrency)
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, worker.stop)
+
+        api_upstream.start()
+        catalog_upstream.start()
+        model_catalog.start()
+        await usage_ledger.start()
+        await latency_tracker.start()
+        try:
+            await worker.run()
+        finally:
+            await model_catalog.stop()
+            await latency_tracker.stop()
+            await usage_ledger.stop()
+            await api_upstream.stop()
+            await catalog_upstream.stop()
+            await close_http_session()
+            client.close()
+
+    # Workers need not share a disk with the API, so b64_json images are kept in GridFS
+    image_store = SharedImageStore(IMAGE_STORE_DIR, IMAGE_STORE_MAX_BYTES)
+
+    asyncio.run(work())
+
+def job_view(job: Dict[str, Any]) -> Dict[str, Any]:
+    if job["status"] == "queued" and job["available_at"] > time.time():
+        job["retry_at"] = job["available_at"]
+    del job["available_at"]
+    return job
+
+@api_router.post("/jobs")
+async def submit_jobs(submission: JobSubmission):
+    """Queue generation requests to be run by the job workers"""
+    if submission.kind not in JOB_KINDS:
+        raise HTTPException(status_code=400, detail=f"Unknown job kind '{submission.kind}'. Use one of: {', '.join(JOB_KINDS)}")
+    if not 0 < len(submission.requests) <= JOB_SUBMIT_MAX:
+        raise HTTPException(status_code=400, detail=f"Submit between 1 and {JOB_SUBMIT_MAX} requests at a time")
+
+    request_model = JOB_KINDS[submission.kind][0]
+    requests = []
+    for index, body in enumerate(submission.requests):
+        try:
+            request = request_model(**body)
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=f"Request {index} is invalid: {str(e)}")
+        if "stream" in request_model.model_fields:
+            # Results are stored, not relayed
+            request.stream = False
+        requests.append(request)
+
+    return await job_queue.submit(submission.kind, requests, submission.max_attempts or JOB_MAX_ATTEMPTS)
+
+@api_router.get("/jobs")
+async def list_jobs(batch_id: Optional[str] = None, status: Optional[str] = None, limit: int = 50):
+    """Job counts per status and queue lag, optionally for one batch, plus the most recent jobs"""
+    match = {"batch_id": batch_id} if batch_id else {}
+    query = {**match, "status": status} if status else match
+    jobs = await db.jobs.find(query, JOB_STATUS_FIELDS).sort("created_at", -1).limit(min(limit, 500)).to_list(None)
+    counts = await job_queue.counts(match)
+    return {
+        "counts": counts,
+        "total": sum(counts.values()),
+        "done": counts["queued"] == counts["running"] == 0,
+        "oldest_queued_seconds": await job_queue.oldest_queued_seconds(match),
+        "jobs": [job_view(job) for job in jobs]
+    }
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await job_queue.get(job_id, JOB_STATUS_FIELDS)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_view(job)
+
+@api_router.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """The job's response once it has succeeded; 202 with its status while it is still pending"""
+    job = await job_queue.get(job_id, {**JOB_STATUS_FIELDS, "result": 1})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] in ("queued", "running"):
+        job.pop("result", None)
+        return JSONResponse(status_code=202, content=job_view(job))
+    if job["status"] == "succeeded":
+        return job["result"]
+    return {"error": job["error"], "status": job["status"]}
+
+@api_router.post("/jobs/{job_id}/retry")
+async def retry_job(job_id: str):
+    """Requeue a failed or dead-lettered job"""
+    if not await job_queue.retry(job_id):
+        raise HTTPException(status_code=404, detail="No failed or dead-lettered job with this id")
+    return {"id": job_id, "status": "queued"}
 
 # Include the router in the main app
 app.include_router(api_router)
 
+@app.exception_handler(RequestRejected)
+async def request_rejected_handler(request, exc: RequestRejected):
+    headers = {"Retry-After": str(exc.retry_after)} if exc.retry_after is not None else None
+    return JSONResponse(status_code=exc.status_code, content=exc.payload, headers=headers)
+
+app.add_middleware(RequestContextMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Stream-ID"],
 )
 
 # Configure logging
@@ -905,6 +5869,90 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def start_background_services():
+    if not DrainingServer.signals_installed:
+        logger.warning("Not served through DrainingServer: SIGTERM closes the listeners before in-flight requests drain")
+    loop_monitor.start()
+    api_upstream.start()
+    catalog_upstream.start()
+    model_catalog.start()
+    # Workers leave probing to the refresher and only export what their traffic observed
+    model_health.start(probe=MODEL_PROBE_ENABLED and CATALOG_ROLE != "worker")
+    await usage_ledger.start()
+    await latency_tracker.start()
+    await job_queue.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    # Under DrainingServer SIGTERM already drained before uvicorn closed its listeners; this covers other exits.
+    # Let in-flight upstream calls and streams finish before tearing anything down, then stop background work (flushing usage) before the HTTP session and Mongo go
+    await drain_controller.drain(DRAIN_GRACE_PERIOD)
+    await stream_replays.stop()
+    await model_health.stop()
+    await model_catalog.stop()
+    await latency_tracker.stop()
+    await usage_ledger.stop()
+    await api_upstream.stop()
+    await catalog_upstream.stop()
+    await close_http_session()
+    await loop_monitor.stop()
+    client.close()
+
+def run_catalog_refresher():
+    """Refresher process for multi-worker mode: fetches the catalog and publishes it for the workers"""
+    global model_catalog
+
+    async def refresh_forever():
+        api_upstream.start()
+        catalog_upstream.start()
+        model_catalog.start()
+        model_health.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await model_health.stop()
+            await model_catalog.stop()
+            await api_upstream.stop()
+            await catalog_upstream.stop()
+            await close_http_session()
+
+    model_catalog = PublishingModelCatalog(CATALOG_SNAPSHOT_PATH, CATALOG_SHARED_PATH)
+
+    asyncio.run(refresh_forever())
+
+if __name__ == "__main__":
+    import argparse
+    import multiprocessing
+
+    parser = argparse.ArgumentParser(description="AI Models Hub API")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--job-worker", action="store_true", help="Run queued jobs instead of serving HTTP")
+    parser.add_argument("--concurrency", type=int, default=JOB_WORKER_CONCURRENCY, help="Jobs in flight per job worker")
+    args = parser.parse_args()
+
+    if args.job_worker:
+        run_job_worker(args.concurrency)
+        sys.exit(0)
+
+    if args.workers > 1:
+        # One refresher process talks to A4F; the workers map its catalog file read-only
+        refresher = multiprocessing.Process(target=run_catalog_refresher, name="catalog-refresher", daemon=True)
+        refresher.start()
+        os.environ["CATALOG_ROLE"] = "worker"
+        os.environ["CATALOG_SHARED_PATH"] = str(CATALOG_SHARED_PATH)
+
+    # Take the server class from the "server" module uvicorn imports the app from, not from
+    # __main__, so its SIGTERM handling drains the app's own controller
+    sys.path.insert(0, str(ROOT_DIR))
+    import server as served
+    from uvicorn.supervisors import Multiprocess
+
+    config = uvicorn.Config("server:app", host=args.host, port=args.port, workers=args.workers)
+    http_server = served.DrainingServer(config)
+    if config.workers > 1:
+        Multiprocess(config, target=http_server.run, sockets=[config.bind_socket()]).run()
+    else:
+        http_server.run()
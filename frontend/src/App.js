@@ -1,7 +1,6 @@
 import { useState, useEffect } from "react";
 import "@/App.css";
 import { BrowserRouter, Routes, Route } from "react-router-dom";
-import axios from "axios";
 import { Toaster } from "@/components/ui/sonner";
 import { toast } from "sonner";
 
@@ -13,9 +12,7 @@ import ImagePlayground from "./components/ImagePlayground";
 import AudioPlayground from "./components/AudioPlayground";
 import VideoPlayground from "./components/VideoPlayground";
 import Settings from "./components/Settings";
-
-const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
-const API = `${BACKEND_URL}/api`;
+import { getBootstrap } from "./lib/bootstrap";
 
 const Home = () => {
   const [models, setModels] = useState(null);
@@ -23,13 +20,17 @@ const Home = () => {
   const [selectedTier, setSelectedTier] = useState("all");
   const [selectedCategory, setSelectedCategory] = useState("all");
   const [searchQuery, setSearchQuery] = useState("");
-  const [apiKey, setApiKey] = useState("");
+  const [apiKeyConfigured, setApiKeyConfigured] = useState(false);
 
-  const fetchModels = async () => {
+  const fetchBootstrap = async (refresh = false) => {
     try {
       setLoading(true);
-      const response = await axios.get(`${API}/models`);
-      setModels(response.data);
+      // One request for the first paint: slim catalog, key status and health
+      const { catalog, api_key } = await getBootstrap(refresh);
+      const categorized = { text: [], image: [], audio: [], video: [], other: [] };
+      catalog.models.forEach(model => categorized[model.category]?.push(model));
+      setModels({ total_models: catalog.total_models, models: catalog.models, categorized });
+      setApiKeyConfigured(api_key.configured);
     } catch (error) {
       console.error("Error fetching models:", error);
       toast.error("Failed to fetch models from A4F API");
@@ -38,20 +39,8 @@ const Home = () => {
     }
   };
 
-  const fetchApiKey = async () => {
-    try {
-      const response = await axios.get(`${API}/api-keys/a4f`);
-      if (response.data && response.data.api_key) {
-        setApiKey(response.data.api_key);
-      }
-    } catch (error) {
-      // No API key stored, that's fine
-    }
-  };
-
   useEffect(() => {
-    fetchModels();
-    fetchApiKey();
+    fetchBootstrap();
   }, []);
 
   const filteredModels = models ? (() => {
@@ -216,8 +205,8 @@ const Home = () => {
         <ModelsList 
           models={filteredModels} 
           loading={loading} 
-          onRefresh={fetchModels}
-          apiKey={apiKey}
+          onRefresh={() => fetchBootstrap(true)}
+          apiKeyConfigured={apiKeyConfigured}
         />
       </main>
       
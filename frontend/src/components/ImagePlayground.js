@@ -72,11 +72,17 @@ const ImagePlayground = () => {
 
       const response = await axios.post(`${API}/generate-image`, payload);
 
-      if (response.data.success) {
+      if (response.data.success && !response.data.image_url) {
+        toast.error("No image was generated");
+      } else if (response.data.success) {
+        // Images stored by the backend come back as /api/images/... paths
+        const imageUrl = response.data.image_url.startsWith("/")
+          ? `${BACKEND_URL}${response.data.image_url}`
+          : response.data.image_url;
         const newImage = {
           id: Date.now(),
           prompt: prompt,
-          url: response.data.image_url,
+          url: imageUrl,
           model: selectedModel?.name || "Unknown",
           timestamp: new Date().toLocaleTimeString(),
           ...response.data,
@@ -7,6 +7,7 @@ import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from "@
 import { Input } from "@/components/ui/input";
 import { RefreshCw, Zap, Info, Search, ChevronDown } from "lucide-react";
 import { toast } from "sonner";
+import { getBootstrap } from "@/lib/bootstrap";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
@@ -18,26 +19,26 @@ const ModelSelector = ({ selectedModel, onModelChange, modelType = "all", classN
   const [searchQuery, setSearchQuery] = useState("");
   const [selectedProvider, setSelectedProvider] = useState(null);
 
-  const fetchModels = async () => {
+  const fetchModels = async (refresh = false) => {
     try {
       setLoading(true);
       setError(null);
-      const response = await axios.get(`${API}/models`);
+      // The slim catalog from the bootstrap response the rest of the page shares
+      const { catalog } = await getBootstrap(refresh);
       
-      if (response.data && response.data.models) {
-        let filteredModels = response.data.models;
+      if (catalog && catalog.models) {
+        let filteredModels = catalog.models;
         
         // Filter by model type if specified
         if (modelType !== "all") {
-          const categorized = response.data.categorized;
-          if (categorized && categorized[modelType]) {
-            const categoryModelNames = categorized[modelType].map(m => m.name);
-            filteredModels = filteredModels.filter(model => 
-              categoryModelNames.includes(model.name)
-            );
-          }
+          filteredModels = filteredModels.filter(model => model.category === modelType);
         }
-        
+
+        // Models the health monitor reports as down stay selectable but go last and are flagged;
+        // the report may come from transient network errors and is not re-tested unless probing is on
+        const isDown = (model) => model.health?.status === "down";
+        filteredModels = [...filteredModels.filter(model => !isDown(model)), ...filteredModels.filter(isDown)];
+
         setModels(filteredModels);
       } else {
         setError("No models found");
@@ -104,7 +105,7 @@ const ModelSelector = ({ selectedModel, onModelChange, modelType = "all", classN
         <CardContent>
           <div className="text-center py-4">
             <p className="text-red-600 mb-3">{error}</p>
-            <Button onClick={fetchModels} variant="outline" size="sm">
+            <Button onClick={() => fetchModels(true)} variant="outline" size="sm">
               <RefreshCw className="w-4 h-4 mr-2" />
               Retry
             </Button>
@@ -127,6 +128,11 @@ const ModelSelector = ({ selectedModel, onModelChange, modelType = "all", classN
   const availableProviders = selectedModelData?.proxy_providers || [];
   const currentProvider = selectedProvider || (availableProviders.length > 0 ? availableProviders[0] : null);
 
+  // Warm up model resolution and the upstream connection while the user writes a prompt
+  const prewarm = (modelName, provider) => {
+    axios.post(`${API}/prewarm`, { model_id: modelName, provider_id: provider?.id }).catch(() => {});
+  };
+
   // Handle model change with provider
   const handleModelChange = (modelName) => {
     const model = models.find(m => m.name === modelName);
@@ -135,6 +141,7 @@ const ModelSelector = ({ selectedModel, onModelChange, modelType = "all", classN
       const firstProvider = model.proxy_providers?.[0];
       setSelectedProvider(firstProvider);
       onModelChange({ ...model, selectedProvider: firstProvider });
+      prewarm(model.name, firstProvider);
     }
   };
 
@@ -143,6 +150,7 @@ const ModelSelector = ({ selectedModel, onModelChange, modelType = "all", classN
     setSelectedProvider(provider);
     if (selectedModelData) {
       onModelChange({ ...selectedModelData, selectedProvider: provider });
+      prewarm(selectedModelData.name, provider);
     }
   };
 
@@ -154,7 +162,7 @@ const ModelSelector = ({ selectedModel, onModelChange, modelType = "all", classN
             <Zap className="w-5 h-5" />
             <span>Model Selection</span>
           </CardTitle>
-          <Button onClick={fetchModels} variant="outline" size="sm">
+          <Button onClick={() => fetchModels(true)} variant="outline" size="sm">
             <RefreshCw className="w-4 h-4" />
           </Button>
         </div>
@@ -212,6 +220,11 @@ const ModelSelector = ({ selectedModel, onModelChange, modelType = "all", classN
                             <span>{model.description || model.type}</span>
                           </div>
                         </div>
+                        {model.health?.status === "down" && (
+                          <Badge className="text-xs bg-red-100 text-red-800 border-red-200 ml-2" title="Recent requests to this model failed">
+                            DOWN
+                          </Badge>
+                        )}
                         <Badge className={`text-xs ${getTierColor(model.plan)} ml-2`}>
                           {model.plan?.toUpperCase() || 'UNKNOWN'}
                         </Badge>
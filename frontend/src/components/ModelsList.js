@@ -5,7 +5,7 @@ import { Badge } from "@/components/ui/badge";
 import { RefreshCw, Play, ExternalLink, Eye, Zap, BarChart3 } from "lucide-react";
 import { Link } from "react-router-dom";
 
-const ModelsList = ({ models, loading, onRefresh, apiKey }) => {
+const ModelsList = ({ models, loading, onRefresh, apiKeyConfigured }) => {
   const [selectedModel, setSelectedModel] = useState(null);
 
   const getTierColor = (plan) => {
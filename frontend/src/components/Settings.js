@@ -7,6 +7,7 @@ import { Input } from "@/components/ui/input";
 import { Badge } from "@/components/ui/badge";
 import { ArrowLeft, Key, Save, Trash2, Eye, EyeOff, CheckCircle, AlertCircle, Settings as SettingsIcon } from "lucide-react";
 import { toast } from "sonner";
+import { getBootstrap } from "@/lib/bootstrap";
 import Header from "./Header";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
@@ -23,8 +24,14 @@ const Settings = () => {
     fetchStoredKey();
   }, []);
 
-  const fetchStoredKey = async () => {
+  const fetchStoredKey = async (refresh = false) => {
     try {
+      // Key status comes with the shared bootstrap response; only fetch the key itself if there is one
+      const { api_key } = await getBootstrap(refresh);
+      if (!api_key.configured) {
+        setStoredKey(null);
+        return;
+      }
       const response = await axios.get(`${API}/api-keys/a4f`);
       if (response.data) {
         setStoredKey(response.data);
@@ -48,7 +55,7 @@ const Settings = () => {
       
       toast.success("API key saved successfully!");
       setApiKey("");
-      await fetchStoredKey();
+      await fetchStoredKey(true);
     } catch (error) {
       console.error("Error saving API key:", error);
       toast.error("Failed to save API key");
@@ -64,6 +71,7 @@ const Settings = () => {
       await axios.delete(`${API}/api-keys/a4f`);
       toast.success("API key deleted successfully!");
       setStoredKey(null);
+      getBootstrap(true).catch(() => {});
     } catch (error) {
       console.error("Error deleting API key:", error);
       toast.error("Failed to delete API key");
@@ -0,0 +1,22 @@
+import axios from "axios";
+
+const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
+const API = `${BACKEND_URL}/api`;
+
+// Health and key status in a reused response are at most this old
+const MAX_AGE_MS = 60 * 1000;
+
+let pending = null;
+let fetchedAt = 0;
+
+// One /bootstrap request shared by every page and model selector; pass refresh to force a new one
+export function getBootstrap(refresh = false) {
+  if (!pending || refresh || Date.now() - fetchedAt > MAX_AGE_MS) {
+    fetchedAt = Date.now();
+    pending = axios.get(`${API}/bootstrap`).then(response => response.data);
+    pending.catch(() => {
+      pending = null;
+    });
+  }
+  return pending;
+}
@@ -0,0 +1,40 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+class MockDatabase:
+    """mongomock-motor database returning one object per collection, so tests can patch collection methods"""
+
+    def __init__(self, database):
+        self._database = database
+        self._collections = {}
+
+    def __getattr__(self, name):
+        if name not in self._collections:
+            attribute = getattr(self._database, name)
+            if not hasattr(attribute, "find_one"):
+                return attribute
+            self._collections[name] = attribute
+        return self._collections[name]
+
+    __getitem__ = __getattr__
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """In-memory MongoDB in place of the server's database"""
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    database = MockDatabase(mongomock_motor.AsyncMongoMockClient()["test_database"])
+    monkeypatch.setattr(server, "db", database)
+    return database
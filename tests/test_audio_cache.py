@@ -0,0 +1,64 @@
+import asyncio
+import os
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def chunks(payload, delay=0.0, fail=False):
+    for i in range(0, len(payload), 4):
+        await asyncio.sleep(delay)
+        yield payload[i:i + 4]
+    if fail:
+        raise ConnectionError("upstream went away")
+
+
+async def drain(iterator):
+    return b"".join([chunk async for chunk in iterator])
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return server.AudioCache(tmp_path, max_bytes=1024)
+
+
+async def test_concurrent_identical_streams_both_complete(cache):
+    path = cache.path("key", "mp3")
+    first, second = await asyncio.gather(
+        drain(cache.tee(chunks(b"first writer audio", 0.001), path)),
+        drain(cache.tee(chunks(b"second writer audio", 0.001), path))
+    )
+
+    assert (first, second) == (b"first writer audio", b"second writer audio")
+    assert path.read_bytes() in (first, second)
+    assert not list(cache.directory.glob("*.part"))
+
+
+async def test_failed_stream_leaves_no_entry(cache):
+    path = cache.path("key", "mp3")
+    with pytest.raises(ConnectionError):
+        await drain(cache.tee(chunks(b"partial audio", fail=True), path))
+
+    assert not path.exists()
+    assert not list(cache.directory.glob("*.part"))
+
+
+async def test_lookup_hits_after_a_completed_stream(cache):
+    request = server.AudioModelRequest(model_id="tts-1", prompt="hello")
+    assert cache.lookup(request) is None
+    await drain(cache.tee(chunks(b"hello audio"), cache.path(cache.key(request), request.format)))
+    assert await drain(cache.read(cache.lookup(request))) == b"hello audio"
+
+
+def test_trim_removes_oldest_entries_and_keeps_partial_files(tmp_path):
+    cache = server.AudioCache(tmp_path, max_bytes=10)
+    for i, name in enumerate(["a.mp3", "b.mp3", "c.mp3"]):
+        (tmp_path / name).write_bytes(b"x" * 5)
+        os.utime(tmp_path / name, (1000 + i, 1000 + i))
+    (tmp_path / "d.0123.part").write_bytes(b"x" * 50)
+
+    cache._trim()
+    assert sorted(f.name for f in tmp_path.iterdir()) == ["b.mp3", "c.mp3", "d.0123.part"]
@@ -0,0 +1,82 @@
+import json
+import time
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+MODELS = [{"name": "gpt-4o", "type": "chat", "proxy_providers": [{"id": "provider-1/gpt-4o"}]}]
+
+
+class FakeReadiness:
+    def __init__(self, result=None):
+        self.result = result
+        self.calls = 0
+
+    def current(self):
+        self.calls += 1
+        return self.result
+
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch, db):
+    catalog = server.ModelCatalog(tmp_path / "snapshot.json")
+    catalog._install({"free": catalog._parse("free", MODELS)}, time.time(), "upstream")
+    monkeypatch.setattr(server, "model_catalog", catalog)
+    monkeypatch.setattr(server, "key_pool", server.KeyPool())
+    return catalog
+
+
+async def build(cache):
+    await cache.build()
+    return json.loads(cache.body)
+
+
+async def test_catalog_turns_stale_without_a_new_version(catalog, monkeypatch):
+    monkeypatch.setattr(server, "readiness_probe", FakeReadiness({"ready": True}))
+    cache = server.BootstrapCache()
+    assert not (await build(cache))["catalog"]["status"]["stale"]
+
+    catalog.fetched_at -= server.CATALOG_MAX_AGE + 1
+    body = await build(cache)
+    assert body["catalog"]["status"]["stale"]
+    assert body["catalog"]["total_models"] == 1
+
+
+async def test_failed_refresh_shows_up_in_the_cached_body(catalog, monkeypatch):
+    monkeypatch.setattr(server, "readiness_probe", FakeReadiness({"ready": True}))
+    cache = server.BootstrapCache()
+    etag = (await build(cache), cache.etag)[1]
+
+    catalog.last_error = "A4F catalog unreachable"
+    assert (await build(cache))["catalog"]["status"]["last_error"] == "A4F catalog unreachable"
+    assert cache.etag != etag
+
+
+async def test_readiness_is_refreshed_by_bootstrap_itself(catalog, monkeypatch):
+    readiness = FakeReadiness()
+    monkeypatch.setattr(server, "readiness_probe", readiness)
+    cache = server.BootstrapCache()
+    assert (await build(cache))["health"]["ready"] is None
+
+    readiness.result = {"ready": True}
+    assert (await build(cache))["health"]["ready"] is True
+    assert readiness.calls == 2
+
+
+async def test_readiness_probe_current_starts_a_background_check(monkeypatch):
+    probe = server.ReadinessProbe()
+    checked = []
+
+    async def check():
+        checked.append(True)
+        probe.result, probe.checked_at = {"ready": True}, time.monotonic()
+        return probe.result
+
+    monkeypatch.setattr(probe, "_check", check)
+    assert probe.current() is None
+    await probe._running
+    assert probe.current() == {"ready": True}
+    assert checked == [True]
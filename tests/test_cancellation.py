@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from starlette.requests import Request
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def upstream(monkeypatch):
+    """A stub upstream that never answers in time; records whether the server saw the request abandoned"""
+    abandoned = asyncio.Event()
+
+    async def handle(request):
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            abandoned.set()
+            raise
+        return web.json_response({"ok": True})
+
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", handle)
+    async with TestServer(app) as test_server:
+        monkeypatch.setattr(server, "api_upstream", server.UpstreamPool("test", str(test_server.make_url("")).rstrip("/"), "ordered"))
+        monkeypatch.setattr(server, "latency_tracker", server.LatencyTracker())
+        test_server.abandoned = abandoned
+        yield test_server
+
+
+@pytest.fixture
+async def session():
+    async with aiohttp.ClientSession() as session:
+        yield session
+
+
+def disconnecting_request(after: float) -> Request:
+    async def receive():
+        await asyncio.sleep(after)
+        return {"type": "http.disconnect"}
+
+    return Request({"type": "http", "method": "POST", "path": "/api/chat", "headers": []}, receive)
+
+
+async def test_client_disconnect_cancels_the_upstream_call(upstream, session):
+    @server.cancellable
+    async def handler():
+        async with server.upstream_post(session, "chat", "model", "/v1/chat", json={}):
+            pass
+
+    started = time.monotonic()
+    response = await handler(http_request=disconnecting_request(0.1))
+
+    assert response.status_code == 499
+    assert time.monotonic() - started < 5
+    await asyncio.wait_for(upstream.abandoned.wait(), 5)
+
+
+async def test_deadline_caps_the_upstream_call(upstream, session):
+    token = server.request_deadline.set(time.time() + 0.2)
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            async with server.upstream_post(session, "chat", "model", "/v1/chat", json={}):
+                pass
+    finally:
+        server.request_deadline.reset(token)
+    await asyncio.wait_for(upstream.abandoned.wait(), 5)
+
+
+async def test_passed_deadline_rejects_before_calling_upstream(upstream, session):
+    token = server.request_deadline.set(time.time() - 1)
+    try:
+        with pytest.raises(server.DeadlineExceeded):
+            async with server.upstream_post(session, "chat", "model", "/v1/chat", json={}):
+                pass
+    finally:
+        server.request_deadline.reset(token)
+    assert not upstream.abandoned.is_set()
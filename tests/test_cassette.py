@@ -0,0 +1,87 @@
+import asyncio
+import json
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def upstream():
+    """A stub upstream: /v1/chat answers JSON, /v1/stream sends SSE lines in chunks, /slow stalls"""
+    async def chat(request):
+        body = await request.json()
+        return web.json_response({"echo": body["prompt"]}, headers={"X-Upstream": "stub"})
+
+    async def stream(request):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for chunk in (b"data: one\n\nda", b"ta: two\n\n", b"data: [DONE]\n\n"):
+            await response.write(chunk)
+            await asyncio.sleep(0.01)
+        return response
+
+    async def slow(request):
+        await asyncio.sleep(1)
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post("/v1/chat", chat)
+    app.router.add_post("/v1/stream", stream)
+    app.router.add_post("/slow", slow)
+    async with TestServer(app) as test_server:
+        test_server.base = str(test_server.make_url("")).rstrip("/")
+        yield test_server
+
+
+async def exchange(session, base):
+    """The same calls against a live or replaying session; returns what the caller saw"""
+    seen = []
+    async with session.post(f"{base}/v1/chat", json={"prompt": "hi"}, headers={"Authorization": "Bearer secret"}) as response:
+        seen.append((response.status, response.headers["X-Upstream"], await response.json()))
+    async with session.post(f"{base}/v1/stream", json={"prompt": "hi"}) as response:
+        seen.append([line async for line in response.content])
+    with pytest.raises(asyncio.TimeoutError):
+        await session.post(f"{base}/slow", json={}, timeout=aiohttp.ClientTimeout(total=0.1))
+    return seen
+
+
+async def test_recorded_traffic_replays_without_the_network(upstream, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "UPSTREAM_CASSETTE_TIMING", "fast")
+    path = tmp_path / "upstream.jsonl"
+
+    recorder = server.CassetteSession(server.Cassette(path), aiohttp.ClientSession())
+    try:
+        live = await exchange(recorder, upstream.base)
+    finally:
+        await recorder.close()
+
+    interactions = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [interaction.get("error") for interaction in interactions] == [None, None, "timeout"]
+    assert interactions[0]["request_headers"]["Authorization"] == "REDACTED"
+    assert "secret" not in path.read_text()
+
+    await upstream.close()
+    cassette = server.Cassette(path)
+    cassette.load()
+    replayed = await exchange(server.CassetteSession(cassette), upstream.base)
+
+    assert replayed == live
+    assert live[1] == [b"data: one\n", b"\n", b"data: two\n", b"\n", b"data: [DONE]\n", b"\n"]
+    assert (cassette.replayed, cassette.misses) == (3, 0)
+
+
+async def test_unrecorded_request_fails_like_a_connection_error(tmp_path):
+    path = tmp_path / "upstream.jsonl"
+    path.write_text("")
+    cassette = server.Cassette(path)
+    cassette.load()
+
+    with pytest.raises(aiohttp.ClientConnectionError):
+        await server.CassetteSession(cassette).post("http://upstream/v1/chat", json={})
+    assert cassette.misses == 1
@@ -0,0 +1,165 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeWebSocket:
+    """Feeds queued client messages to the handler and collects the frames it sends"""
+
+    def __init__(self):
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.frames = []
+        self.sent = asyncio.Event()
+
+    async def accept(self):
+        pass
+
+    async def receive_text(self):
+        message = await self.incoming.get()
+        if message is None:
+            raise WebSocketDisconnect()
+        return json.dumps(message)
+
+    async def send_text(self, text):
+        self.frames.append(json.loads(text))
+        self.sent.set()
+
+    async def close(self, code=1000, reason=None):
+        pass
+
+    async def frame(self, kind):
+        """Wait for the next frame of a kind"""
+        while True:
+            for index, frame in enumerate(self.frames):
+                if frame["type"] == kind:
+                    return self.frames.pop(index)
+            self.sent.clear()
+            await asyncio.wait_for(self.sent.wait(), 2)
+
+
+class FakeChat:
+    """Stands in for chat_with_model: streams the given deltas, or holds until released"""
+
+    def __init__(self):
+        self.requests = []
+        self.histories = []
+        self.error = None
+        self.release = None
+
+    async def __call__(self, request):
+        self.requests.append(request)
+        self.histories.append(list(request.conversation_history))
+        if self.error:
+            return {"error": {"type": self.error}}
+        return StreamingResponse(self.events(request.prompt))
+
+    async def events(self, prompt):
+        yield f"data: {json.dumps({'delta': 're: '})}\n\n"
+        if self.release is not None:
+            await self.release.wait()
+        yield f"data: {json.dumps({'delta': prompt})}\n\n"
+        yield f"data: {json.dumps({'done': True, 'finish_reason': 'stop'})}\n\n"
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    fake = FakeChat()
+    resolved = []
+
+    async def resolve_api_key(api_key):
+        resolved.append(api_key)
+        return "secret", f"key-{len(resolved)}"
+
+    async def get_full_model_id(model, provider=None):
+        return f"provider-1/{model}"
+
+    monkeypatch.setattr(server, "chat_with_model", fake)
+    monkeypatch.setattr(server, "resolve_api_key", resolve_api_key)
+    monkeypatch.setattr(server, "get_full_model_id", get_full_model_id)
+    monkeypatch.setattr(server, "drain_controller", server.DrainController())
+    fake.resolved = resolved
+    return fake
+
+
+@pytest.fixture
+async def session(chat):
+    session = server.ChatSession(FakeWebSocket())
+    await session.handle({"type": "start", "model_id": "gpt-4o"})
+    assert (await session.websocket.frame("ready"))["model_id"] == "provider-1/gpt-4o"
+    yield session
+    await session.cancel()
+
+
+async def turn(session, content):
+    await session.handle({"type": "message", "content": content})
+    await session.turn
+    return session.websocket.frames.pop()
+
+
+async def test_message_during_a_turn_is_rejected_as_busy(chat):
+    chat.release = asyncio.Event()
+    websocket = FakeWebSocket()
+    handler = asyncio.create_task(server.chat_websocket(websocket))
+
+    await websocket.incoming.put({"type": "start", "model_id": "gpt-4o"})
+    await websocket.frame("ready")
+    await websocket.incoming.put({"type": "message", "content": "first"})
+    await websocket.frame("delta")
+    await websocket.incoming.put({"type": "message", "content": "second"})
+    assert (await websocket.frame("error"))["error"]["type"] == "busy"
+
+    chat.release.set()
+    assert (await websocket.frame("done"))["turn"] == 1
+    await websocket.incoming.put(None)
+    await asyncio.wait_for(handler, 2)
+    assert [request.prompt for request in chat.requests] == ["first"]
+
+
+async def test_cancelled_turn_leaves_no_history(session, chat):
+    chat.release = asyncio.Event()
+    await session.handle({"type": "message", "content": "first"})
+    await session.websocket.frame("delta")
+
+    await session.handle({"type": "cancel"})
+    assert (await session.websocket.frame("cancelled"))["was_running"]
+    assert session.history == []
+    assert server.drain_controller.in_flight == 0
+
+    chat.release = None
+    assert (await turn(session, "second"))["type"] == "done"
+    assert session.history == [{"role": "user", "content": "second"}, {"role": "assistant", "content": "re: second"}]
+
+
+async def test_history_keeps_only_the_latest_messages(session, chat, monkeypatch):
+    monkeypatch.setattr(server, "CHAT_WS_MAX_HISTORY", 4)
+    for content in ("one", "two", "three"):
+        assert (await turn(session, content))["type"] == "done"
+
+    assert [message["content"] for message in session.history] == ["two", "re: two", "three", "re: three"]
+    # The last turn was sent with the history as trimmed after the turn before it
+    assert [message["content"] for message in chat.histories[-1]] == ["one", "re: one", "two", "re: two"]
+    assert chat.requests[-1].prompt == "three"
+
+
+async def test_key_is_dropped_after_a_quarantine_error(session, chat):
+    chat.error = "rate_limit"
+    assert (await turn(session, "first"))["error"]["type"] == "rate_limit"
+    assert session.key is None
+    assert session.history == []
+
+    chat.error = None
+    assert (await turn(session, "second"))["type"] == "done"
+    assert session.key == ("secret", "key-2")
+
+
+async def test_other_errors_keep_the_key(session, chat):
+    chat.error = "server_error"
+    assert (await turn(session, "first"))["error"]["type"] == "server_error"
+    assert session.key == ("secret", "key-1")
@@ -0,0 +1,84 @@
+import asyncio
+import signal
+
+import pytest
+import uvicorn
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import server
+
+
+def request(host="127.0.0.1", headers=()):
+    return Request({
+        "type": "http",
+        "method": "POST",
+        "path": "/api/drain",
+        "headers": [(name.encode(), value.encode()) for name, value in headers],
+        "client": (host, 50000)
+    })
+
+
+def test_cancel_reopens_a_manual_drain():
+    drain = server.DrainController()
+    drain.begin()
+    assert not drain.admit("/api/chat")
+    assert drain.cancel()
+    assert drain.admit("/api/chat")
+
+
+def test_cancel_refused_once_stopping():
+    drain = server.DrainController()
+    drain.begin()
+    drain.stopping = True
+    assert not drain.cancel()
+    assert drain.draining
+
+
+def test_loopback_clients_may_drain_without_token(monkeypatch):
+    monkeypatch.setattr(server, "DRAIN_TOKEN", "")
+    server.require_drain_access(request())
+    for denied in (request("10.0.0.7"), request(headers=[("x-forwarded-for", "203.0.113.9")])):
+        with pytest.raises(HTTPException) as info:
+            server.require_drain_access(denied)
+        assert info.value.status_code == 403
+
+
+def test_token_required_when_configured(monkeypatch):
+    monkeypatch.setattr(server, "DRAIN_TOKEN", "secret")
+    server.require_drain_access(request("10.0.0.7", [("x-drain-token", "secret")]))
+    for denied in (request(), request(headers=[("x-drain-token", "wrong")])):
+        with pytest.raises(HTTPException):
+            server.require_drain_access(denied)
+
+
+@pytest.fixture
+def drain(monkeypatch):
+    controller = server.DrainController()
+    monkeypatch.setattr(server, "drain_controller", controller)
+    return controller
+
+
+@pytest.mark.anyio
+async def test_sigterm_drains_before_uvicorn_exits(drain):
+    http_server = server.DrainingServer(uvicorn.Config(server.app))
+    drain.track("/api/chat")
+
+    http_server.handle_exit(signal.SIGTERM, None)
+    await asyncio.sleep(0.01)
+    assert drain.draining and not http_server.should_exit
+
+    drain.release("/api/chat")
+    await drain.drain_task
+    assert http_server.should_exit
+
+
+@pytest.mark.anyio
+async def test_second_sigterm_exits_without_waiting(drain):
+    http_server = server.DrainingServer(uvicorn.Config(server.app))
+    drain.track("/api/chat")
+
+    http_server.handle_exit(signal.SIGTERM, None)
+    http_server.handle_exit(signal.SIGTERM, None)
+    assert http_server.should_exit
+    drain.drain_task.cancel()
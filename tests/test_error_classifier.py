@@ -0,0 +1,36 @@
+import json
+from pathlib import Path
+
+import pytest
+
+import server
+
+CORPUS = json.loads((Path(server.__file__).parent / "error_corpus.json").read_text())
+
+
+@pytest.mark.parametrize("case", CORPUS, ids=[case["name"] for case in CORPUS])
+def test_corpus_body_is_classified_as_recorded(case):
+    server._parse_a4f_error_text.cache_clear()
+    assert server.parse_a4f_error(case["body"]) == case["expected"]
+
+
+def test_memoized_results_are_copies():
+    body = CORPUS[0]["body"]
+    server.parse_a4f_error(body)["message"] = "changed"
+    assert server.parse_a4f_error(body) == CORPUS[0]["expected"]
+
+
+@pytest.mark.parametrize("code, message, error_type, expected", [
+    # Context overflows arrive as invalid_request_error; the earlier rule wins
+    ("", "This model's maximum context length is 8192 tokens", "invalid_request_error", "context_limit"),
+    ("", "Unsupported value", "invalid_request_error", "invalid_parameters"),
+    # Every needle of a condition must occur
+    ("", "token budget exceeded", "", "unknown_error"),
+    ("", "Token LIMIT exceeded", "", "context_limit"),
+    # "type=" compares the whole type, case-sensitively
+    ("", "", "api_error", "server_error"),
+    ("", "", "API_ERROR", "unknown_error"),
+    ("", "", "", "unknown_error"),
+])
+def test_rules_apply_in_order(code, message, error_type, expected):
+    assert server.error_classifier.classify(code, message, error_type) == expected
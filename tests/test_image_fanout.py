@@ -0,0 +1,125 @@
+import asyncio
+import contextlib
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeResponse:
+    status = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    async def json(self):
+        return self.data
+
+    async def text(self):
+        return ""
+
+
+class FakeUpstream:
+    """Stands in for upstream_post; fail maps a seed to the exception its call raises"""
+
+    def __init__(self, delay=0.0, fail=None, data=None):
+        self.delay = delay
+        self.fail = fail or {}
+        self.data = data
+        self.active = 0
+        self.max_active = 0
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, session, endpoint, model, path, json, **kwargs):
+        seed = json.get("seed")
+        if seed in self.fail:
+            raise self.fail[seed]
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            yield FakeResponse(self.data if self.data is not None else {"data": [{"url": f"http://cdn/{seed}.png"}]})
+        finally:
+            self.active -= 1
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    fake = FakeUpstream()
+    monkeypatch.setattr(server, "upstream_post", fake)
+    monkeypatch.setattr(server, "http_session", lambda: None)
+    return fake
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    sched = server.UpstreamScheduler(10, {"image": 2}, {"interactive": 4, "batch": 1}, 100, 5.0)
+    monkeypatch.setattr(server, "upstream_scheduler", sched)
+    return sched
+
+
+def context(model="stable-diffusion-xl", **fields):
+    request = server.ImageModelRequest(model_id=model, prompt="a cat", response_format="url", **fields)
+    ctx = server.GenerationContext(server.image_adapter, request)
+    ctx.model_id = f"provider-3/{model}"
+    ctx.payload = server.image_adapter.build_payload(ctx)
+    return ctx
+
+
+async def fan_out(ctx, sched):
+    # The request's own slot, as taken by @scheduled("image")
+    async with sched.slot("image"):
+        return await asyncio.wait_for(server.image_adapter.fan_out(ctx), 2)
+
+
+async def test_failing_call_is_reported_as_an_error_entry(upstream, scheduler):
+    upstream.fail = {2: server.DeadlineExceeded(), 3: RuntimeError("boom")}
+    result = await fan_out(context(seeds=[1, 2, 3]), scheduler)
+
+    assert [image["seed"] for image in result["images"]] == [1]
+    assert [error["error"]["type"] for error in result["errors"]] == ["deadline_exceeded", "unexpected_error"]
+    assert scheduler.active == 0
+
+
+async def test_all_calls_failing_returns_the_first_error(upstream, scheduler):
+    upstream.fail = {1: server.DeadlineExceeded(), 2: server.DeadlineExceeded()}
+    result = await fan_out(context(seeds=[1, 2]), scheduler)
+    assert result["error"]["type"] == "deadline_exceeded"
+    assert result["status_code"] == 504
+
+
+async def test_fanned_out_calls_stay_within_the_endpoint_limit(upstream, scheduler):
+    upstream.delay = 0.02
+    result = await fan_out(context(seeds=[1, 2, 3, 4, 5, 6]), scheduler)
+
+    assert len(result["images"]) == 6
+    assert upstream.max_active == 2
+    assert scheduler.active == 0
+
+
+async def test_fan_out_runs_in_the_own_slot_when_the_endpoint_is_full(upstream, scheduler):
+    upstream.delay = 0.01
+    async with scheduler.slot("image"):
+        result = await fan_out(context(seeds=[1, 2, 3]), scheduler)
+
+    assert len(result["images"]) == 3
+    assert upstream.max_active == 1
+
+
+async def test_upstream_item_without_url_becomes_an_error_entry(upstream, scheduler):
+    upstream.data = {"data": [{"revised_prompt": "a cat"}]}
+    result = await fan_out(context(seeds=[1, 2]), scheduler)
+    assert result["error"]["type"] == "no_image_generated"
+
+
+async def test_models_without_seeds_get_a_single_batched_call(upstream, scheduler):
+    ctx = context(model="flux", seeds=[1, 2, 3])
+    assert server.image_adapter.jobs(ctx) == [([0, 1, 2], [None, None, None], {**ctx.payload, "n": 3})]
+
+    server.image_adapter.batch_unsupported.add(ctx.model_id)
+    try:
+        assert all("seed" not in payload for _, _, payload in server.image_adapter.jobs(ctx))
+    finally:
+        server.image_adapter.batch_unsupported.discard(ctx.model_id)
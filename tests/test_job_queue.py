@@ -0,0 +1,127 @@
+import base64
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def submit(count=1, max_attempts=3):
+    requests = [server.TextModelRequest(model_id="gpt-4o", prompt=f"prompt {i}") for i in range(count)]
+    return await server.job_queue.submit("chat", requests, max_attempts)
+
+
+async def stored(job_id):
+    return await server.db.jobs.find_one({"id": job_id}, {"_id": 0})
+
+
+async def test_claim_hands_each_job_out_once(db):
+    submitted = await submit(2)
+    first = await server.job_queue.claim("worker-a")
+    second = await server.job_queue.claim("worker-b")
+
+    assert {first["id"], second["id"]} == set(submitted["job_ids"])
+    assert first["attempts"] == second["attempts"] == 1
+    assert await server.job_queue.claim("worker-c") is None
+
+
+async def test_expired_lease_moves_the_job_to_another_worker(db, monkeypatch):
+    await submit()
+    monkeypatch.setattr(server, "JOB_LEASE_SECONDS", -1)
+    stalled = await server.job_queue.claim("worker-a")
+    taken_over = await server.job_queue.claim("worker-b")
+
+    assert taken_over["id"] == stalled["id"] and taken_over["attempts"] == 2
+    assert not await server.job_queue.complete(stalled, {"response": "late"})
+    assert await server.job_queue.complete(taken_over, {"response": "done"})
+    assert (await stored(stalled["id"]))["result"] == {"response": "done"}
+
+
+async def test_retryable_errors_back_off_then_dead_letter(db, monkeypatch):
+    monkeypatch.setattr(server, "JOB_RETRY_BACKOFF", 0)
+    await submit(max_attempts=2)
+    for expected in ("queued", "dead_letter"):
+        job = await server.job_queue.claim("worker-a")
+        assert await server.job_queue.fail(job, {"type": "rate_limit"}) == expected
+
+    record = await stored(job["id"])
+    assert record["status"] == "dead_letter"
+    assert [attempt["attempt"] for attempt in record["history"]] == [1, 2]
+    assert record["expires_at"] is not None
+
+
+async def test_other_errors_fail_at_once_and_can_be_retried(db):
+    await submit()
+    job = await server.job_queue.claim("worker-a")
+    assert await server.job_queue.fail(job, {"type": "auth_error"}) == "failed"
+    assert await server.job_queue.claim("worker-a") is None
+
+    assert await server.job_queue.retry(job["id"])
+    assert (await server.job_queue.claim("worker-a"))["attempts"] == 1
+
+
+async def test_release_does_not_count_the_attempt(db):
+    await submit()
+    job = await server.job_queue.claim("worker-a")
+    assert await server.job_queue.release(job)
+    assert (await server.job_queue.claim("worker-b"))["attempts"] == 1
+
+
+async def test_worker_stores_handler_results(db, monkeypatch):
+    async def handler(request):
+        if request.prompt == "prompt 1":
+            return {"error": server.error_response("auth_error")}
+        return {"success": True, "response": request.prompt.upper()}
+
+    monkeypatch.setitem(server.JOB_KINDS, "chat", (server.TextModelRequest, handler))
+    submitted = await submit(2)
+    worker = server.JobWorker(concurrency=1)
+    for _ in submitted["job_ids"]:
+        await worker.execute(await server.job_queue.claim(worker.name))
+
+    succeeded, failed = [await stored(job_id) for job_id in submitted["job_ids"]]
+    assert succeeded["status"] == "succeeded" and succeeded["result"]["response"] == "PROMPT 0"
+    assert failed["status"] == "failed" and failed["error"]["type"] == "auth_error"
+    assert dict(worker.outcomes) == {"succeeded": 1, "failed": 1}
+
+
+@pytest.fixture
+def gridfs(monkeypatch):
+    """In-memory MongoDB with GridFS; motor's bucket needs the database itself rather than a wrapper"""
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    monkeypatch.setattr(server, "db", mongomock_motor.AsyncMongoMockClient()["test_database"])
+    with mongomock_motor.enabled_gridfs_integration():
+        yield
+
+
+async def test_worker_images_are_served_by_the_api(gridfs, tmp_path, monkeypatch):
+    png = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 4
+    monkeypatch.setattr(server, "image_store", server.ImageStore(tmp_path / "api", 1 << 20))
+    worker_store = server.SharedImageStore(tmp_path / "worker", 1 << 20)
+
+    class Response:
+        class content:
+            @staticmethod
+            async def iter_chunked(size):
+                yield b'{"created":1,"data":[{"b64_json":"' + base64.b64encode(png) + b'"}]}'
+
+    data = await worker_store.read_response(Response)
+    name = data["data"][0]["url"].rsplit("/", 1)[1]
+    assert not list((tmp_path / "worker").iterdir())
+
+    response = await server.get_stored_image(name)
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    assert body == png
+    assert response.media_type == "image/png"
+
+    with pytest.raises(server.HTTPException):
+        await server.get_stored_image("0" * 32 + ".png")
+
+
+async def test_worker_images_are_pruned_with_finished_jobs(gridfs, tmp_path, monkeypatch):
+    store = server.SharedImageStore(tmp_path, 1 << 20)
+    await server.image_bucket().upload_from_stream("a" * 32 + ".png", b"\x89PNG old")
+    assert await store.prune() == 0
+    monkeypatch.setattr(server, "JOB_RETENTION_HOURS", -1)
+    assert await store.prune() == 1
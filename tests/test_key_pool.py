@@ -0,0 +1,56 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def add_keys(db, provider, *key_ids):
+    for i, key_id in enumerate(key_ids):
+        await db.api_keys.insert_one({
+            "id": key_id, "provider": provider, "api_key": f"secret-{key_id}",
+            "created_at": f"2024-01-01T00:00:0{i}+00:00"
+        })
+
+
+@pytest.fixture
+def pool(db):
+    return server.KeyPool("round_robin")
+
+
+async def test_round_robin_rotates_through_active_keys(db, pool):
+    await add_keys(db, "a4f", "k1", "k2", "k3")
+    picked = [(await pool.acquire("a4f"))["id"] for _ in range(6)]
+    assert picked == ["k1", "k2", "k3", "k1", "k2", "k3"]
+
+
+async def test_rate_limited_key_is_quarantined_until_reset(db, pool):
+    await add_keys(db, "a4f", "k1", "k2")
+    await pool.report("k1", "rate_limit")
+    assert {(await pool.acquire("a4f"))["id"] for _ in range(4)} == {"k2"}
+    assert (await db.api_keys.find_one({"id": "k1"}))["status"] == "quarantined"
+
+    assert await pool.reset("a4f", "k1")
+    assert {(await pool.acquire("a4f"))["id"] for _ in range(4)} == {"k1", "k2"}
+
+
+async def test_auth_error_disables_key(db, pool):
+    await add_keys(db, "a4f", "k1")
+    await pool.report("k1", "auth_error")
+    assert await pool.acquire("a4f") is None
+    assert (await pool.describe("a4f"))[0]["status"] == "disabled"
+
+
+async def test_reset_is_scoped_to_the_provider(db, pool):
+    await add_keys(db, "a4f", "k1")
+    await pool.report("k1", "auth_error")
+    assert not await pool.reset("openai", "k1")
+    assert (await db.api_keys.find_one({"id": "k1"}))["status"] == "disabled"
+
+
+async def test_least_rate_limited_prefers_keys_not_recently_limited(db):
+    pool = server.KeyPool("least_rate_limited")
+    await add_keys(db, "a4f", "k1", "k2")
+    await pool.acquire("a4f")
+    pool.stats("k2")["last_rate_limited_at"] = "2024-01-01T00:00:00+00:00"
+    assert (await pool.acquire("a4f"))["id"] == "k1"
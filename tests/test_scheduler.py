@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def scheduler(max_concurrency=10, limits=None, weights=None, max_queue=100, queue_timeout=2.0):
+    return server.UpstreamScheduler(
+        max_concurrency, limits or {"chat": 5, "video": 1}, weights or {"interactive": 4, "batch": 1},
+        max_queue, queue_timeout
+    )
+
+
+async def hold(sched, endpoint, release, priority="interactive", admitted=None):
+    async with sched.slot(endpoint, priority):
+        if admitted is not None:
+            admitted.append((endpoint, priority))
+        await release.wait()
+
+
+async def test_request_is_not_blocked_by_another_endpoints_queue():
+    sched = scheduler()
+    release = asyncio.Event()
+    tasks = [asyncio.create_task(hold(sched, "video", release)) for _ in range(2)]
+    await asyncio.sleep(0)
+    assert (sched.active, sched.queued) == (1, 1)
+
+    try:
+        async with sched.slot("chat", timeout=0.5):
+            assert sched.active_by_endpoint["chat"] == 1
+    finally:
+        release.set()
+        await asyncio.gather(*tasks)
+    assert sched.active == 0
+
+
+async def test_freed_slots_follow_priority_weights():
+    sched = scheduler(max_concurrency=1, limits={"chat": 1})
+    admitted = []
+    gate = asyncio.Event()
+    blocker = asyncio.create_task(hold(sched, "chat", gate))
+    await asyncio.sleep(0)
+
+    release = asyncio.Event()
+    release.set()
+    waiters = [asyncio.create_task(hold(sched, "chat", release, "batch", admitted)) for _ in range(4)]
+    waiters += [asyncio.create_task(hold(sched, "chat", release, "interactive", admitted)) for _ in range(4)]
+    await asyncio.sleep(0)
+    gate.set()
+    await asyncio.gather(blocker, *waiters)
+
+    first_five = [priority for _, priority in admitted[:5]]
+    assert first_five.count("interactive") == 4
+
+
+async def test_full_queue_sheds_requests():
+    sched = scheduler(max_concurrency=1, limits={"chat": 1}, max_queue=1)
+    release = asyncio.Event()
+    tasks = [asyncio.create_task(hold(sched, "chat", release)) for _ in range(2)]
+    await asyncio.sleep(0)
+
+    try:
+        with pytest.raises(server.SchedulerRejected) as rejected:
+            async with sched.slot("chat"):
+                pass
+        assert rejected.value.payload["error"]["type"] == "overloaded"
+    finally:
+        release.set()
+        await asyncio.gather(*tasks)
+
+
+async def test_queue_timeout_rejects_and_forgets_the_waiter():
+    sched = scheduler(max_concurrency=1, limits={"chat": 1})
+    release = asyncio.Event()
+    task = asyncio.create_task(hold(sched, "chat", release))
+    await asyncio.sleep(0)
+
+    try:
+        with pytest.raises(server.SchedulerRejected) as rejected:
+            async with sched.slot("chat", timeout=0.05):
+                pass
+        assert rejected.value.payload["error"]["type"] == "queue_timeout"
+        assert sched.queued == 0
+    finally:
+        release.set()
+        await task
+    assert sched.active == 0
+
+
+async def test_unknown_priority_uses_the_default():
+    sched = scheduler()
+    async with sched.slot("chat", "urgent"):
+        pass
+    assert sched.counters[server.DEFAULT_PRIORITY]["admitted"] == 1
+
+
+@pytest.mark.parametrize("weights", [{"batch": 1}, {"interactive": 4, "batch": 0}])
+def test_invalid_weights_are_rejected(weights):
+    with pytest.raises(ValueError):
+        scheduler(weights=weights)
@@ -0,0 +1,96 @@
+import json
+import time
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+MODELS = [
+    {"name": "gpt-4o", "type": "chat", "proxy_providers": [{"id": "provider-1/gpt-4o"}, {"id": "provider-2/gpt-4o"}]},
+    {"name": "flux", "type": "image", "proxy_providers": [{"id": "provider-3/flux"}]},
+    {"name": "tts-1", "type": "audio", "proxy_providers": [{"id": "provider-1/tts-1"}]}
+]
+
+
+@pytest.fixture
+def shared_path(tmp_path):
+    return tmp_path / "catalog.shared"
+
+
+@pytest.fixture
+def publisher(tmp_path, shared_path):
+    catalog = server.PublishingModelCatalog(tmp_path / "snapshot.json", shared_path)
+    catalog._install({"free": catalog._parse("free", MODELS)}, time.time(), "upstream")
+    return catalog
+
+
+async def test_worker_serves_a_loading_body_before_the_first_publish(shared_path):
+    worker = server.SharedModelCatalog(shared_path)
+    assert not await worker.refresh()
+
+    body = json.loads(worker.response_body())
+    assert body["total_models"] == 0
+    assert body["categorized"] == {category: [] for category in server.MODEL_CATEGORIES}
+    assert body["catalog"]["stale"]
+    assert worker.models() == []
+    assert worker.find("gpt-4o") is None
+
+
+async def test_worker_reads_the_published_catalog(publisher, shared_path):
+    worker = server.SharedModelCatalog(shared_path)
+    assert await worker.refresh()
+
+    assert json.loads(worker.response_body())["total_models"] == len(MODELS)
+    assert worker.find("gpt-4o").provider_ids == ("provider-1/gpt-4o", "provider-2/gpt-4o")
+    assert [(model.name, model.category, model.provider_ids) for model in worker.models()] == [
+        (model.name, model.category, model.provider_ids) for model in publisher.models()
+    ]
+
+
+async def test_worker_outcomes_reach_the_published_health(publisher, shared_path, monkeypatch):
+    worker_health = server.ModelHealthMonitor()
+    monkeypatch.setattr(server, "model_catalog", server.SharedModelCatalog(shared_path))
+    worker_health.observe("gpt-4o", "provider-1/gpt-4o", True, latency=0.25)
+    worker_health.observe("flux", "provider-3/flux", False, "model_not_found")
+    worker_health.export_outcomes(shared_path)
+    assert not worker_health.outbox
+
+    refresher_health = server.ModelHealthMonitor()
+    monkeypatch.setattr(server, "model_catalog", publisher)
+    assert refresher_health.import_outcomes(shared_path) == 2
+    assert not list(shared_path.parent.glob("*.health.*"))
+    assert not refresher_health.outbox
+    publisher.set_health(refresher_health.summaries())
+
+    worker = server.SharedModelCatalog(shared_path)
+    await worker.refresh()
+    health = {model["name"]: model.get("health") for model in json.loads(worker.response_body())["models"]}
+    assert health["gpt-4o"] == {"status": "healthy", "p50_ms": 250.0, "provider": "provider-1/gpt-4o"}
+    assert health["flux"]["status"] == "down"
+    assert health["tts-1"] is None
+
+
+async def test_unchanged_health_does_not_republish(publisher):
+    summaries = {"gpt-4o": {"status": "healthy", "p50_ms": 250.0, "provider": "provider-1/gpt-4o"}}
+    publisher.set_health(summaries)
+    version = publisher.version
+
+    publisher.set_health(dict(summaries))
+    assert publisher.version == version
+
+    publisher.set_health({"gpt-4o": {**summaries["gpt-4o"], "status": "degraded"}})
+    assert publisher.version != version
+
+
+async def test_response_prefix_is_copied_once_per_version(publisher, shared_path):
+    worker = server.SharedModelCatalog(shared_path)
+    await worker.refresh()
+    prefix = worker.shared.response_prefix()
+    assert worker.shared.response_prefix() is prefix
+
+    publisher.set_health({"gpt-4o": {"status": "degraded", "p50_ms": None, "provider": "provider-1/gpt-4o"}})
+    assert await worker.refresh()
+    assert worker.shared.response_prefix() is not prefix
+    assert b'"degraded"' in worker.shared.response_prefix()
@@ -0,0 +1,110 @@
+import server
+
+
+def cache(max_entries=100, ttl=3600.0, bucket_capacity=4, max_bytes=1024 * 1024):
+    return server.SimilarityCache(0.9, 256, 3, bucket_capacity, max_entries, ttl, max_bytes)
+
+
+def request(prompt, model="gpt-4o", **params):
+    return server.TextModelRequest(model_id=model, prompt=prompt, **params)
+
+
+def result(text):
+    return {"success": True, "response": text}
+
+
+def test_near_duplicate_prompt_hits():
+    similarity = cache()
+    similarity.store("chat", request("What is the capital of France?"), result("Paris"))
+
+    hit = similarity.lookup("chat", request("what is the capital of france"))
+    assert hit["response"] == "Paris" and hit["cached"]
+    assert similarity.lookup("chat", request("Write a poem about the sea")) is None
+
+
+def test_different_parameters_do_not_share_entries():
+    similarity = cache()
+    similarity.store("chat", request("What is the capital of France?"), result("Paris"))
+    assert similarity.lookup("chat", request("What is the capital of France?", temperature=0.1)) is None
+
+
+def test_expired_entry_is_dropped_with_its_empty_bucket():
+    similarity = cache(ttl=-1)
+    similarity.store("chat", request("What is the capital of France?"), result("Paris"))
+
+    assert similarity.lookup("chat", request("What is the capital of France?")) is None
+    assert (similarity.entries, len(similarity.buckets)) == (0, 0)
+
+
+def test_eviction_after_ttl_expiry():
+    similarity = cache(max_entries=1, ttl=-1)
+    similarity.store("chat", request("What is the capital of France?", model="m1"), result("Paris"))
+    similarity.lookup("chat", request("What is the capital of France?", model="m1"))
+
+    similarity.ttl = 3600
+    similarity.store("chat", request("What is the capital of Spain?", model="m2"), result("Madrid"))
+    similarity.store("chat", request("Name a large ocean", model="m2"), result("Pacific"))
+
+    assert similarity.entries == 1
+    assert similarity.lookup("chat", request("Name a large ocean", model="m2"))["response"] == "Pacific"
+
+
+def test_least_recently_used_bucket_is_evicted_first():
+    similarity = cache(max_entries=2)
+    similarity.store("chat", request("What is the capital of France?", model="m1"), result("Paris"))
+    similarity.store("chat", request("What is the capital of Spain?", model="m2"), result("Madrid"))
+    similarity.lookup("chat", request("What is the capital of France?", model="m1"))
+    similarity.store("chat", request("Name a large ocean", model="m3"), result("Pacific"))
+
+    assert similarity.lookup("chat", request("What is the capital of Spain?", model="m2")) is None
+    assert similarity.lookup("chat", request("What is the capital of France?", model="m1")) is not None
+
+
+def test_full_bucket_replaces_its_least_recently_used_row():
+    similarity = cache(bucket_capacity=2)
+    prompts = ["What is the capital of France?", "Name a large ocean", "Describe a red sunset"]
+    for prompt in prompts:
+        similarity.store("chat", request(prompt), result(prompt))
+
+    assert similarity.entries == 2
+    assert similarity.lookup("chat", request(prompts[0])) is None
+    assert similarity.lookup("chat", request(prompts[2]))["response"] == prompts[2]
+
+
+def test_entries_are_not_shared_across_api_keys():
+    similarity = cache()
+    similarity.store("chat", request("What is the capital of France?", api_key="key-a"), result("Paris"))
+
+    assert similarity.lookup("chat", request("What is the capital of France?", api_key="key-b")) is None
+    assert similarity.lookup("chat", request("What is the capital of France?", api_key="key-a")) is not None
+
+
+def test_same_conversation_history_hits():
+    history = [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello!"}]
+    similarity = cache()
+    similarity.store("chat", request("What is the capital of France?", conversation_history=history), result("Paris"))
+
+    assert similarity.lookup("chat", request("what is the capital of france", conversation_history=list(history))) is not None
+    assert similarity.lookup("chat", request("What is the capital of France?")) is None
+
+
+def test_buckets_grow_from_one_row():
+    similarity = cache()
+    similarity.store("chat", request("What is the capital of France?"), result("Paris"))
+    row_bytes = similarity.nbytes
+    assert row_bytes == 256 * 4 + 2 * 8
+
+    similarity.store("chat", request("Name a large ocean"), result("Pacific"))
+    assert similarity.nbytes == 2 * row_bytes
+
+
+def test_byte_cap_evicts_least_recently_used_buckets():
+    row_bytes = 256 * 4 + 2 * 8
+    similarity = cache(max_bytes=2 * row_bytes)
+    similarity.store("chat", request("What is the capital of France?", model="m1"), result("Paris"))
+    similarity.store("chat", request("What is the capital of Spain?", model="m2"), result("Madrid"))
+    similarity.store("chat", request("Name a large ocean", model="m3"), result("Pacific"))
+
+    assert (similarity.entries, len(similarity.buckets), similarity.nbytes) == (2, 2, 2 * row_bytes)
+    assert similarity.lookup("chat", request("What is the capital of France?", model="m1")) is None
+    assert similarity.describe()["memory_bytes"] == 2 * row_bytes
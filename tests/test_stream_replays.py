@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+from fastapi.responses import StreamingResponse
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def drain(monkeypatch):
+    controller = server.DrainController()
+    monkeypatch.setattr(server, "drain_controller", controller)
+    return controller
+
+
+@pytest.fixture
+def replays(monkeypatch):
+    registry = server.StreamReplays(ttl=60, detach_timeout=30, max_stream_bytes=1 << 20, max_bytes=1 << 20)
+    monkeypatch.setattr(server, "stream_replays", registry)
+    return registry
+
+
+@pytest.fixture
+def sched(replays):
+    scheduler = server.UpstreamScheduler(1, {}, {"interactive": 1}, 10, 2.0)
+    scheduler.on_saturated.append(replays.yield_slot)
+    return scheduler
+
+
+def upstream_stream(sched, closed):
+    """An endless upstream stream holding a scheduler slot, as a scheduled handler's body does"""
+    async def frames():
+        try:
+            async with sched.slot("chat"):
+                seq = 0
+                while True:
+                    seq += 1
+                    yield server.sse_event({"seq": seq})
+                    await asyncio.sleep(0.01)
+        finally:
+            closed.set()
+    return StreamingResponse(frames(), media_type="text/event-stream")
+
+
+async def disconnect_after(response, events):
+    """Read some events like a client would, then drop the connection"""
+    iterator = response.body_iterator
+    for _ in range(events):
+        await iterator.__anext__()
+    await iterator.aclose()
+
+
+async def test_detached_stream_gives_its_slot_to_a_queued_request(drain, replays, sched):
+    closed = asyncio.Event()
+    response = replays.buffered(upstream_stream(sched, closed))
+    await disconnect_after(response, 2)
+    assert replays.describe()["detached"] == 1
+
+    async with sched.slot("chat"):
+        assert closed.is_set()
+    assert replays.counters["detached_cancelled"] == 1
+    assert not replays.buffers
+
+
+async def test_followed_stream_keeps_its_slot(drain, replays, sched):
+    closed = asyncio.Event()
+    response = replays.buffered(upstream_stream(sched, closed))
+    follower = response.body_iterator
+    await follower.__anext__()
+
+    with pytest.raises(server.SchedulerRejected):
+        async with sched.slot("chat", timeout=0.1):
+            pass
+    assert not closed.is_set()
+    await follower.aclose()
+
+
+async def test_drain_counts_pumps_and_cancels_detached_ones(drain, replays, sched):
+    closed = asyncio.Event()
+    response = replays.buffered(upstream_stream(sched, closed))
+    await asyncio.sleep(0)
+    assert drain.describe()["in_flight_by_path"] == {server.STREAM_PUMP_PATH: 1}
+
+    await disconnect_after(response, 1)
+    drain.begin()
+    assert await drain.drain(1) == 0
+    assert closed.is_set()
+
+
+async def test_client_leaving_during_a_drain_closes_the_stream(drain, replays, sched):
+    closed = asyncio.Event()
+    response = replays.buffered(upstream_stream(sched, closed))
+    follower = response.body_iterator
+    await follower.__anext__()
+    drain.begin()
+    assert not closed.is_set()
+
+    await follower.aclose()
+    assert await drain.drain(1) == 0
+    assert closed.is_set()
+
+
+async def test_waiters_blocked_by_an_endpoint_limit_leave_detached_streams_alone(drain, replays):
+    sched = server.UpstreamScheduler(10, {"video": 1}, {"interactive": 1}, 10, 2.0)
+    sched.on_saturated.append(replays.yield_slot)
+    closed = asyncio.Event()
+    await disconnect_after(replays.buffered(upstream_stream(sched, closed)), 1)
+
+    async with sched.slot("video"):
+        with pytest.raises(server.SchedulerRejected):
+            async with sched.slot("video", timeout=0.05):
+                pass
+    assert not closed.is_set()
+    assert replays.describe()["detached"] == 1
+    await replays.stop()
+
+
+async def test_each_saturated_waiter_closes_one_detached_stream(drain, replays):
+    sched = server.UpstreamScheduler(2, {}, {"interactive": 1}, 10, 2.0)
+    sched.on_saturated.append(replays.yield_slot)
+    first, second = asyncio.Event(), asyncio.Event()
+    await disconnect_after(replays.buffered(upstream_stream(sched, first)), 1)
+    await disconnect_after(replays.buffered(upstream_stream(sched, second)), 1)
+
+    async with sched.slot("chat"):
+        assert first.is_set() and not second.is_set()
+        replays.yield_slot()
+        replays.yield_slot()
+        await second.wait()
+    assert replays.counters["detached_cancelled"] == 2
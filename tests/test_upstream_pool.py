@@ -0,0 +1,138 @@
+import asyncio
+import socket
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def closed_port_url():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{s.getsockname()[1]}"
+
+
+@pytest.fixture
+async def upstream():
+    """A stub upstream: /slow stalls before answering, /error answers 503, /stream pauses between chunks, anything else 200"""
+    calls = []
+
+    async def handle(request):
+        calls.append((request.method, request.path))
+        if request.path == "/slow":
+            await asyncio.sleep(1)
+        if request.path == "/error":
+            return web.json_response({"error": "unavailable"}, status=503)
+        if request.path == "/stream":
+            response = web.StreamResponse()
+            await response.prepare(request)
+            for chunk in (b"a", b"b"):
+                await asyncio.sleep(0.3)
+                await response.write(chunk)
+            return response
+        return web.json_response({"ok": True})
+
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", handle)
+    async with TestServer(app) as test_server:
+        test_server.calls = calls
+        test_server.base = str(test_server.make_url("")).rstrip("/")
+        yield test_server
+
+
+@pytest.fixture
+async def session():
+    async with aiohttp.ClientSession() as session:
+        yield session
+
+
+async def test_fails_over_when_the_request_was_not_sent(upstream, session):
+    pool = server.UpstreamPool("test", f"{closed_port_url()},{upstream.base}", "ordered")
+    async with await pool.request(session, "POST", "/v1/chat", json={}) as response:
+        assert response.status == 200
+
+    dead, alive = pool.endpoints
+    assert (dead.failures, alive.failures) == (1, 0)
+    assert pool.failovers == 1
+
+
+async def test_post_read_timeouts_are_not_resent_or_held_against_the_endpoint(upstream, session):
+    pool = server.UpstreamPool("test", f"{upstream.base},{upstream.base}/second", "ordered")
+    with pytest.raises(asyncio.TimeoutError):
+        await pool.request(session, "POST", "/slow", timeout=aiohttp.ClientTimeout(total=5, sock_read=0.1), json={})
+
+    assert upstream.calls == [("POST", "/slow")]
+    assert [endpoint.failures for endpoint in pool.endpoints] == [0, 0]
+    assert pool.failovers == 0
+
+
+async def test_get_timeouts_fail_over_without_counting(upstream, session):
+    pool = server.UpstreamPool("test", f"{upstream.base}/slow,{upstream.base}", "ordered")
+    async with await pool.request(session, "GET", "", timeout=aiohttp.ClientTimeout(total=5, sock_read=0.1)) as response:
+        assert response.status == 200
+
+    assert upstream.calls == [("GET", "/slow"), ("GET", "/")]
+    assert [endpoint.failures for endpoint in pool.endpoints] == [0, 0]
+
+
+async def test_server_errors_count_against_the_endpoint(upstream, session, monkeypatch):
+    monkeypatch.setattr(server, "UPSTREAM_FAILURE_THRESHOLD", 2)
+    pool = server.UpstreamPool("test", f"{upstream.base},{closed_port_url()}", "ordered")
+    for _ in range(2):
+        async with await pool.request(session, "POST", "/error", json={}) as response:
+            assert response.status == 503
+
+    assert upstream.calls == [("POST", "/error")] * 2
+    assert pool.candidates()[0] is pool.endpoints[1]
+
+
+async def test_probes_use_their_own_session(upstream, monkeypatch):
+    def shared_session():
+        raise AssertionError("probes must not use the shared upstream session")
+
+    monkeypatch.setattr(server, "http_session", shared_session)
+    monkeypatch.setattr(server, "UPSTREAM_CASSETTE_MODE", "record")
+    pool = server.UpstreamPool("test", f"{upstream.base},{closed_port_url()}")
+    pool.start()
+    try:
+        for _ in range(100):
+            if pool.endpoints[0].rtt is not None and pool.endpoints[1].failures:
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        await pool.stop()
+
+    assert pool.endpoints[0].rtt is not None
+    assert pool.endpoints[1].failures == 1
+
+
+async def test_unrecorded_posts_leave_the_latency_histograms_alone(upstream, session, monkeypatch):
+    monkeypatch.setattr(server, "api_upstream", server.UpstreamPool("test", upstream.base, "ordered"))
+    monkeypatch.setattr(server, "latency_tracker", server.LatencyTracker())
+
+    async with server.upstream_post(session, "chat", "probe-model", "/v1/chat", record_latency=False, json={}) as response:
+        assert response.status == 200
+    assert ("chat", "probe-model") not in server.latency_tracker.histograms
+
+    async with server.upstream_post(session, "chat", "probe-model", "/v1/chat", json={}) as response:
+        assert response.status == 200
+    assert server.latency_tracker.histograms[("chat", "probe-model")].samples == 1
+
+
+async def test_ttfb_limits_the_headers_but_not_pauses_within_a_stream(upstream, session, monkeypatch):
+    monkeypatch.setattr(server, "api_upstream", server.UpstreamPool("test", upstream.base, "ordered"))
+    tracker = server.LatencyTracker()
+    monkeypatch.setattr(tracker, "timeouts", lambda endpoint, model: {"connect": 5, "ttfb": 0.2, "total": 5, "adaptive": True})
+    monkeypatch.setattr(server, "latency_tracker", tracker)
+
+    response = await server.upstream_request(session, "chat", "model", "/stream", json={})
+    async with response:
+        assert await response.read() == b"ab"
+
+    with pytest.raises(asyncio.TimeoutError):
+        await server.upstream_request(session, "chat", "model", "/slow", json={})
@@ -0,0 +1,82 @@
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def record_many(ledger, count, model="gpt-4o"):
+    for _ in range(count):
+        ledger.record(modality="chat", model=model, prompt_tokens=2, completion_tokens=3, total_tokens=5)
+
+
+async def rollup_requests(db):
+    return sum(doc["requests"] for doc in await db.usage_hourly.find({}).to_list(None))
+
+
+async def test_flush_stores_records_and_rollups(db):
+    ledger = server.UsageLedger(batch_size=100, max_buffer=100)
+    record_many(ledger, 3)
+    await ledger.flush()
+
+    assert ledger.pending == 0
+    assert await db.usage_records.count_documents({}) == 3
+    [rollup] = await db.usage_hourly.find({}).to_list(None)
+    assert (rollup["requests"], rollup["total_tokens"]) == (3, 15)
+
+
+async def test_failed_rollup_is_retried_without_reinserting_records(db, monkeypatch):
+    ledger = server.UsageLedger(batch_size=100, max_buffer=100)
+    record_many(ledger, 4)
+    bulk_write = db.usage_hourly.bulk_write
+
+    async def unavailable(*args, **kwargs):
+        raise ConnectionError("mongo unavailable")
+
+    monkeypatch.setattr(db.usage_hourly, "bulk_write", unavailable)
+    await ledger.flush()
+    assert await db.usage_records.count_documents({}) == 4
+    assert await rollup_requests(db) == 0
+
+    monkeypatch.setattr(db.usage_hourly, "bulk_write", bulk_write)
+    await ledger.flush()
+    assert await db.usage_records.count_documents({}) == 4
+    assert await rollup_requests(db) == 4
+
+
+async def test_records_stored_before_a_failure_are_not_counted_twice(db, monkeypatch):
+    ledger = server.UsageLedger(batch_size=100, max_buffer=100)
+    record_many(ledger, 5)
+    insert_many = db.usage_records.insert_many
+
+    async def insert_then_fail(documents, **kwargs):
+        await insert_many(documents[:2], **kwargs)
+        raise ConnectionError("connection reset")
+
+    monkeypatch.setattr(db.usage_records, "insert_many", insert_then_fail)
+    await ledger.flush()
+    assert ledger.pending == 5
+
+    monkeypatch.setattr(db.usage_records, "insert_many", insert_many)
+    await ledger.flush()
+    assert ledger.pending == 0
+    assert await db.usage_records.count_documents({}) == 5
+    assert await rollup_requests(db) == 5
+
+
+async def test_buffer_drops_oldest_records_past_the_cap(db):
+    ledger = server.UsageLedger(batch_size=100, max_buffer=3)
+    for model in ("m1", "m2", "m3", "m4", "m5"):
+        ledger.record(modality="chat", model=model)
+
+    assert (ledger.pending, ledger.dropped) == (3, 2)
+    assert [record["model"] for record in ledger._buffer] == ["m3", "m4", "m5"]
+
+
+async def test_full_batch_flushes_in_a_referenced_task(db):
+    ledger = server.UsageLedger(batch_size=2, max_buffer=100)
+    record_many(ledger, 2)
+    assert ledger._flush_task is not None
+    await ledger._flush_task
+    assert await db.usage_records.count_documents({}) == 2